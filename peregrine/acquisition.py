@@ -13,6 +13,7 @@ to satellite acquisition.
 
 """
 
+import os
 import sys
 import numpy as np
 import pyfftw
@@ -30,6 +31,37 @@ DEFAULT_WISDOM_FILE = "fftw_wisdom"
 DEFAULT_THRESHOLD = 20.0
 """The default correlation power to consider an acquisition successful."""
 
+CODE_SPECTRA_FILE = "code_spectra_%s_%.3fHz_%d_%d_%s.npy"
+"""Filename pattern of cached code spectra, stored next to the wisdom file."""
+
+DEFAULT_COARSE_MS = 2
+"""The default number of 1 ms blocks summed in the coarse acquisition pass."""
+
+PFS_MAX_PRESUM_PHASE = 0.02
+"""Largest carrier phase rotation, in cycles, allowed within one pre-summed
+group of samples in the parallel frequency search."""
+
+PCS_FFT_COST = 0.3
+"""Cost of an inverse FFT per sample and log2 of its length, relative to the
+per-sample cost of a carrier shift and code multiplication, used by
+:meth:`Acquisition.search_costs`."""
+
+PFS_WIPEOFF_COST = 4.5
+"""Cost of the code wipe-off and pre-summing per sample and code phase,
+relative to the per-sample cost of a carrier shift and code multiplication,
+used by :meth:`Acquisition.search_costs`."""
+
+DEFAULT_CODE_PHASE_SEARCH = 2.0
+"""The default code phase search window half-width in chips, used with code
+phase priors."""
+
+DEFAULT_REACQ_DOPPLER_SEARCH = 500.0
+"""The default Doppler search window half-width in Hz for re-acquisition
+around the last tracked Doppler."""
+
+DEFAULT_BATCH_BYTES = 256 * 1024 * 1024
+"""The default memory budget in bytes for one batch of correlation spectra."""
+
 # Import progressbar if it is available.
 _progressbar_available = True
 try:
@@ -72,7 +104,21 @@ class Acquisition:
     pre-calculated data about how to most efficiently perform the FFT
     operations required on the current hardware. Using FFTW wisdom greatly
     reduces the time required to perform an acquisition. If `wisdom_file` is
-    `None` then no wisdom file is loaded or saved.
+    `None` then no wisdom file is loaded or saved. The code spectra cache of
+    :meth:`code_spectra` is kept in the same directory.
+  batched : bool, optional
+    If `True`, :meth:`acquire` computes the correlation surface for all
+    Doppler bins and nav-declobber offsets with a single multi-dimensional
+    FFTW plan instead of one inverse FFT per bin.
+  batch_bytes : int, optional
+    Upper bound on the size of the buffers used by a single batched inverse
+    FFT. Searches needing more memory are split into several batches along
+    the Doppler axis.
+  precision : {'double', 'single'}, optional
+    Floating point precision of the spectra, FFTs and correlation powers.
+    With 'single' everything is computed in complex64 / float32, which halves
+    memory traffic and roughly doubles FFTW throughput. The samples are only
+    a few bits wide, so the results are practically the same.
 
   """
 
@@ -85,7 +131,10 @@ class Acquisition:
                code_length,
                n_codes_integrate=4,
                offsets=None,
-               wisdom_file=DEFAULT_WISDOM_FILE):
+               wisdom_file=DEFAULT_WISDOM_FILE,
+               batched=False,
+               batch_bytes=DEFAULT_BATCH_BYTES,
+               precision='double'):
 
     self.signal = signal
     self.sampling_freq = sampling_freq
@@ -110,6 +159,48 @@ class Acquisition:
                          + "offsets. Specify them or generalize the technique.")
     self.offsets = offsets
 
+    if precision == 'double':
+      self.complex_dtype = np.complex128
+      self.real_dtype = np.float64
+    elif precision == 'single':
+      self.complex_dtype = np.complex64
+      self.real_dtype = np.float32
+    else:
+      raise ValueError("Unknown precision '%s'." % precision)
+    self.precision = precision
+
+    self.batched = batched
+    self.batch_bytes = batch_bytes
+    # Batched inverse FFT plans, keyed by the number of Doppler bins.
+    self.batch_iffts = {}
+
+    # When the upsampled code repeats exactly every `samples_per_code`
+    # samples, its spectrum is zero everywhere except every
+    # `n_codes_integrate`-th bin. The first `samples_per_code` correlation
+    # lags can then be computed from those bins alone with a shorter inverse
+    # FFT.
+    code_indices = self._code_indices()
+    if np.array_equal(code_indices[self.samples_per_code:],
+                      code_indices[:-self.samples_per_code]):
+      self.batch_stride = self.n_integrate // self.samples_per_code
+    else:
+      self.batch_stride = 1
+
+    # Worker pool started by `start_pool`, if any, and the code family its
+    # workers have loaded.
+    self.pool = None
+    self.pool_codes = None
+    # Whether the short sets of samples are in shared memory, see
+    # `start_pool`.
+    self.samples_shared = False
+
+    # 1 ms acquisitions used by the coarse search, keyed by number of blocks.
+    self.coarse_acqs = {}
+
+    self.wisdom_file = wisdom_file
+    # Code spectra tables, keyed by code family name.
+    self.code_spectra_cache = {}
+
     # Try to load saved FFTW wisdom.
     if wisdom_file is not None:
       try:
@@ -118,6 +209,8 @@ class Acquisition:
         logger.warning("Couldn't open FFTW wisdom file, "
                        "the first run might take longer than usual.")
 
+    # Index of the first sample in the sample stream, see `advance_samples`.
+    self.sample_index = 0
     if samples is not None:
       self.init_samples(samples)
 
@@ -125,17 +218,17 @@ class Acquisition:
 
     # Allocate aligned arrays for the code FFT.
     self.code = pyfftw.n_byte_align_empty((self.n_integrate), 16,
-                                          dtype=np.complex128)
+                                          dtype=self.complex_dtype)
     self.code_ft = pyfftw.n_byte_align_empty((self.n_integrate), 16,
-                                             dtype=np.complex128)
+                                             dtype=self.complex_dtype)
     # Create an FFTW transforms which will execute the code FFT.
     self.code_fft = pyfftw.FFTW(self.code, self.code_ft)
 
     # Allocate aligned arrays for the inverse FFT.
     self.corr_ft = pyfftw.n_byte_align_empty((self.n_integrate), 16,
-                                             dtype=np.complex128)
+                                             dtype=self.complex_dtype)
     self.corr = pyfftw.n_byte_align_empty((self.n_integrate), 16,
-                                          dtype=np.complex128)
+                                          dtype=self.complex_dtype)
 
     # Setup FFTW transforms for inverse FFT.
     self.corr_ifft = pyfftw.FFTW(self.corr_ft, self.corr,
@@ -145,7 +238,7 @@ class Acquisition:
     if wisdom_file is not None:
       self.save_wisdom(wisdom_file)
 
-  def init_samples(self, samples):
+  def init_samples(self, samples, sample_index=0):
     """
     Update the samples used for acquisition.
 
@@ -161,16 +254,86 @@ class Acquisition:
     ----------
     samples : :class:`numpy.ndarray`
       Array of samples to use for acquisition.
+    sample_index : int, optional
+      Index of the first of `samples` in the sample stream, see
+      `advance_samples` and `reacquisition`.
+
+    """
+    self._set_samples(samples, sample_index, {})
+
+  def advance_samples(self, samples, n_codes):
+    """
+    Slide the acquisition window forward along the sample stream.
+
+    Same as `init_samples` with the samples starting `n_codes` code periods
+    after the current ones, for periodic re-acquisition during long runs. The
+    spectra of the offsets that fall on the start of an offset of the current
+    window are reused instead of being computed again, e.g. with the default
+    offsets, advancing by `n_codes_integrate` code periods reuses one of the
+    two spectra.
+
+    Parameters
+    ----------
+    samples : :class:`numpy.ndarray`
+      Array of samples of the same stream, starting `n_codes` code periods
+      after the current ones.
+    n_codes : int
+      Number of code periods to advance the window by.
+
+    """
+    sample_index = self.sample_index + n_codes * self.samples_per_code
+    starts = [self.sample_index + off for off in self.offsets]
+    reusable = {}
+    for off in self.offsets:
+      if sample_index + off in starts:
+        i = starts.index(sample_index + off)
+        reusable[sample_index + off] = self.short_samples_ft[i].copy()
+    self._set_samples(samples, sample_index, reusable)
+
+  def _set_samples(self, samples, sample_index, reusable):
+    """
+    Set the samples and their spectra, taking the spectra of the windows
+    starting at the sample indices in `reusable` from it.
 
     """
     self.samples = samples
+    self.sample_index = sample_index
+
+    for coarse_acq in self.coarse_acqs.itervalues():
+      coarse_acq.init_samples(samples, sample_index)
 
     # Create some short sets of data to correlate with
-    self.short_samples = [samples[off:(off + self.n_integrate)]
-                          for off in self.offsets]
+    windows = [samples[off:(off + self.n_integrate)] for off in self.offsets]
+
+    # The spectra are stored repeated twice along the frequency axis, so that
+    # a cyclic shift of a spectrum is a plain slice (view) of this array. The
+    # pool workers see the short sets and their spectra through shared
+    # memory, so with a pool they have to be updated in place.
+    n = self.n_integrate
+    if not self.samples_shared:
+      self.short_samples = np.empty((len(self.offsets), n),
+                                    dtype=self.complex_dtype)
+      self.short_samples_ft2 = np.empty((len(self.offsets), 2 * n),
+                                        dtype=self.complex_dtype)
+    self.short_samples[:] = windows
+    short_samples_ft2 = self.short_samples_ft2
 
     # Pre-compute Fourier transforms of the short signals
-    self.short_samples_ft = [np.fft.fft(samps) for samps in self.short_samples]
+    for i, samps in enumerate(windows):
+      start = sample_index + self.offsets[i]
+      if start in reusable:
+        short_samples_ft2[i, :n] = reusable[start]
+      elif np.iscomplexobj(samples):
+        short_samples_ft2[i, :n] = np.fft.fft(samps)
+      else:
+        # The spectrum of real samples is Hermitian, so only the non-negative
+        # frequencies are computed and the rest is their mirrored conjugate.
+        half = np.fft.rfft(samps)
+        short_samples_ft2[i, :len(half)] = half
+        short_samples_ft2[i, len(half):n] = np.conj(half[1:n - n // 2][::-1])
+    short_samples_ft2[:, n:] = short_samples_ft2[:, :n]
+
+    self.short_samples_ft = short_samples_ft2[:, :n]
 
   def interpolate(self, S_0, S_1, S_2, interpolation='gaussian'):
     """
@@ -268,22 +431,330 @@ class Acquisition:
       2D array containing correlation powers at different frequencies and code
       phases. Code phase axis is in samples from zero to `samples_per_code`.
 
+    """
+    return self.correlate(self.code_spectrum(code), freqs, progress_callback)
+
+  def correlate(self, code_ft_conj, freqs, progress_callback=None,
+                noncoherent=False, all_offsets=False):
+    """
+    Perform an acquisition with a pre-computed code spectrum.
+
+    Same as `acquire` but takes the conjugate code spectrum returned by
+    `code_spectrum` instead of the code itself.
+
+    Parameters
+    ----------
+    code_ft_conj : :class:`numpy.ndarray`, shape(`n_integrate`,)
+      Conjugate spectrum of the upsampled code.
+    freqs : iterable
+      A list of carrier frequencies in Hz to search over.
+    progress_callback : callable or `None`, optional
+      A function that is called to report on the progress of the acquisition.
+    noncoherent : bool, optional
+      If `True` the correlation powers of all the offsets are summed instead
+      of keeping the offset with the best correlation.
+    all_offsets : bool, optional
+      If `True` the correlation powers of all the offsets are returned, with
+      shape(len(`offsets`), len(`freqs`), `samples_per_code`), e.g. for
+      `find_peaks`.
+
+    Returns
+    -------
+    out : :class:`numpy.ndarray`, shape(len(`freqs`), `samples_per_code`)
+      2D array containing correlation powers at different frequencies and code
+      phases.
+
     """
     # Allocate array to hold results.
-    results = np.empty((len(self.offsets), len(freqs), self.samples_per_code))
+    results = np.empty((len(self.offsets), len(freqs), self.samples_per_code),
+                       dtype=self.real_dtype)
+
+    if self.batched:
+      self._acquire_batched(code_ft_conj, freqs, results, progress_callback)
+    else:
+      self._acquire_serial(code_ft_conj, freqs, results, progress_callback)
+
+    if noncoherent:
+      return results.sum(axis=0)
+    if all_offsets:
+      return results
+
+    # Choose the nav-bit-declobber sample interval with the best correlation
+    max_indices = np.unravel_index(results.argmax(), results.shape)
+    return results[max_indices[0]]
+
+  def code_spectrum(self, code):
+    """
+    Compute the conjugate Fourier transform of an upsampled code.
 
+    Parameters
+    ----------
+    code : :class:`numpy.ndarray`, shape(`code_length`,)
+      A numpy array containing the code. Should contain one element per chip
+      with value +/- 1.
+
+    Returns
+    -------
+    out : :class:`numpy.ndarray`, shape(`n_integrate`,)
+      Conjugate spectrum of the code upsampled to the sampling frequency.
+
+    """
     # Upsample the code to our sampling frequency.
-    code_indices = np.arange(1.0, self.n_integrate + 1.0) / \
-        self.samples_per_chip
-    code_indices = np.remainder(
-        np.asarray(code_indices, np.int), self.code_length)
-    self.code[:] = code[code_indices]
+    self.code[:] = code[self._code_indices()]
 
     # Find the conjugate Fourier transform of the code which will be used to
     # perform the correlation.
     self.code_fft.execute()
-    code_ft_conj = np.conj(self.code_ft)
+    return np.conj(self.code_ft)
+
+  def code_spectra(self, codes='l1ca'):
+    """
+    Get the conjugate spectra of all the codes of a code family.
+
+    The spectra only depend on the codes, the sampling frequency,
+    `n_integrate`, `code_length` and the precision, so they are saved to a
+    file named after these in the directory of the FFTW wisdom file and
+    memory-mapped when needed again. Without a wisdom file they are only
+    cached in memory.
+
+    Parameters
+    ----------
+    codes : {'l1ca', 'l2cm', 'glo'}, optional
+      Code family: GPS L1 C/A, GPS L2C CM or GLONASS L1 C/A.
+
+    Returns
+    -------
+    out : :class:`numpy.ndarray`, shape(n_prns, `n_integrate`)
+      Conjugate spectra as returned by :meth:`code_spectrum`, indexed by PRN
+      (0-indexed).
+
+    """
+    spectra = self.code_spectra_cache.get(codes)
+    if spectra is not None:
+      return spectra
+
+    table = _code_table(codes)
+    if table.shape[1] != self.code_length:
+      raise ValueError("Code family '%s' has %d chips, expected %d."
+                       % (codes, table.shape[1], self.code_length))
+    shape = (len(table), self.n_integrate)
+
+    filename = None
+    if self.wisdom_file is not None:
+      filename = os.path.join(os.path.dirname(self.wisdom_file),
+                              CODE_SPECTRA_FILE % (codes, self.sampling_freq,
+                                                   self.n_integrate,
+                                                   self.code_length,
+                                                   self.precision))
+      try:
+        spectra = np.load(filename, mmap_mode='r')
+        if spectra.shape != shape or spectra.dtype != self.complex_dtype:
+          spectra = None
+      except (IOError, ValueError):
+        spectra = None
+
+    if spectra is None:
+      spectra = np.array([self.code_spectrum(code) for code in table])
+      if filename is not None:
+        # Write under a temporary name first so that concurrent runs never
+        # see a partially written file.
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+          with open(tmp_filename, 'wb') as f:
+            np.save(f, spectra)
+          os.rename(tmp_filename, filename)
+          spectra = np.load(filename, mmap_mode='r')
+        except (IOError, OSError):
+          logger.warning("Couldn't save code spectra file '%s'.", filename)
+
+    self.code_spectra_cache[codes] = spectra
+    return spectra
+
+  def _code_indices(self):
+    """
+    Chip indices of the code upsampled to `n_integrate` samples.
+
+    """
+    code_indices = np.arange(1.0, self.n_integrate + 1.0) / \
+        self.samples_per_chip
+    return np.remainder(np.asarray(code_indices, np.int), self.code_length)
+
+  def _freq_shift(self, freq):
+    """
+    Number of FFT bins that mix a carrier frequency down to baseband.
+
+    """
+    return int((float(freq) * self.n_integrate / self.sampling_freq) + 0.5) \
+        % self.n_integrate
+
+  def pfs_presum(self, freqs):
+    """
+    Number of samples summed together before the parallel frequency search
+    FFT.
+
+    Summing `M` samples after code wipe-off low-pass filters and decimates
+    the signal, so the Fourier transform only has to be done at the reduced
+    rate. `M` is the largest group size for which the carrier at the edge of
+    `freqs` rotates by at most `PFS_MAX_PRESUM_PHASE` cycles within a group,
+    which keeps the loss below 0.02 dB.
+
+    """
+    bins = self._pfs_bins(freqs)
+    span = max(1, np.max(np.abs(bins)))
+    return max(1, int(PFS_MAX_PRESUM_PHASE * self.n_integrate / span))
+
+  def _pfs_bins(self, freqs):
+    """
+    FFT bins of `freqs` relative to the bin of the middle one, wrapped to
+    [-`n_integrate` / 2, `n_integrate` / 2).
+
+    """
+    n = self.n_integrate
+    shifts = np.array([self._freq_shift(freq) for freq in freqs])
+    return (shifts - shifts[len(shifts) // 2] + n // 2) % n - n // 2
+
+  def correlate_pfs(self, code, freqs, code_phases, progress_callback=None):
+    """
+    Perform an acquisition with the parallel frequency search method.
+
+    For every code phase the samples are multiplied by the code (code
+    wipe-off), mixed down by the middle frequency and summed in groups of
+    :meth:`pfs_presum` samples. A Fourier transform of the sums then gives
+    the correlation at all the frequencies at once. As only a few bins are
+    needed it is computed as a product with the DFT matrix of these bins.
+    The frequencies are quantized to FFT bins exactly like in `correlate`, so
+    up to the small pre-summing loss the results match the corresponding
+    columns of `correlate`.
+
+    Parameters
+    ----------
+    code : :class:`numpy.ndarray`, shape(`code_length`,)
+      A numpy array containing the code to acquire. Should contain one element
+      per chip with value +/- 1.
+    freqs : iterable
+      A list of carrier frequencies in Hz to search over.
+    code_phases : iterable of int
+      Code phases in samples to search over.
+    progress_callback : callable or `None`, optional
+      A function that is called to report on the progress of the acquisition.
+
+    Returns
+    -------
+    out : :class:`numpy.ndarray`, shape(len(`freqs`), len(`code_phases`))
+      2D array containing correlation powers at different frequencies and code
+      phases.
+
+    """
+    n = self.n_integrate
+    code_phases = np.asarray(code_phases)
+    upsampled = code[self._code_indices()].astype(self.real_dtype)
+    presum = self.pfs_presum(freqs)
+    n_groups = (n + presum - 1) // presum
+    mid_shift = self._freq_shift(freqs[len(freqs) // 2])
+    mix = np.exp(-2j * np.pi * mid_shift * np.arange(n) / n)
+    # DFT of the group sums at the bins of `freqs`, relative to the middle
+    # one. The group at index j starts at sample j * `presum`.
+    dft = np.exp(-2j * np.pi * np.outer(np.arange(n_groups) * presum,
+                                        self._pfs_bins(freqs)) / n)
+    dft = dft.astype(self.complex_dtype)
+
+    # Everything is zero padded to a whole number of groups. The code is
+    # repeated twice, so that the code delayed by `tau` samples is the slice
+    # starting at `n - tau`.
+    length = n_groups * presum
+    replicas = np.zeros(n + length, dtype=self.real_dtype)
+    replicas[:n] = upsampled
+    replicas[n:2 * n] = upsampled
+    samples = np.zeros(length, dtype=self.complex_dtype)
+    wiped = np.empty(length, dtype=self.complex_dtype)
+    sums = np.empty((len(code_phases), n_groups), dtype=self.complex_dtype)
+
+    results = np.empty((len(self.offsets), len(freqs), len(code_phases)),
+                       dtype=self.real_dtype)
+    for offset_i in range(len(self.offsets)):
+      samples[:n] = self.short_samples[offset_i] * mix
+      for i, tau in enumerate(code_phases):
+        np.multiply(samples, replicas[n - tau:n - tau + length], out=wiped)
+        sums[i] = wiped.reshape(n_groups, presum).sum(axis=-1)
+        if progress_callback:
+          progress_callback(i + 1, len(code_phases))
+      # Scaled by `n` to match the unnormalized transforms of `correlate`.
+      spectra = np.dot(sums, dft) * n
+      results[offset_i] = np.square(np.abs(spectra)).T
+
+    # Choose the nav-bit-declobber sample interval with the best correlation
+    max_indices = np.unravel_index(results.argmax(), results.shape)
+    return results[max_indices[0]]
+
+  def search_costs(self, freqs, n_code_phases):
+    """
+    Estimate the costs of the two acquisition methods.
+
+    The parallel code phase search (`correlate`) costs one multiplication and
+    one inverse FFT per frequency, however few code phases are needed. The
+    parallel frequency search (`correlate_pfs`) costs one code wipe-off per
+    code phase, however few frequencies are needed. So the first is cheaper
+    for wide code phase windows, the second one for wide frequency windows.
+
+    Parameters
+    ----------
+    freqs : iterable
+      Carrier frequencies in Hz to search over.
+    n_code_phases : int
+      Number of code phases (in samples) to search over.
+
+    Returns
+    -------
+    out : (float, float)
+      Relative costs of the parallel code phase search and of the parallel
+      frequency search.
+
+    """
+    n = self.n_integrate
+    n_ifft = n // self.batch_stride if self.batched else n
+    pcs = len(freqs) * (n + PCS_FFT_COST * n_ifft * np.log2(n_ifft))
+    n_groups = n // self.pfs_presum(freqs)
+    pfs = n_code_phases * (PFS_WIPEOFF_COST * n + n_groups * len(freqs))
+    return len(self.offsets) * pcs, len(self.offsets) * pfs
+
+  def _search(self, prn, freqs, code_phases=None, strategy='pcs',
+              codes='l1ca', progress_callback=None):
+    """
+    Search one PRN of the code family `codes`, returning the peak found by
+    `find_peak`.
+
+    `strategy` is 'pcs' (`correlate`), 'pfs' (`correlate_pfs`) or 'auto' to
+    pick the cheaper one according to `search_costs`.
+
+    """
+    if strategy == 'auto':
+      if code_phases is None:
+        n_code_phases = self.samples_per_code
+      else:
+        n_code_phases = len(code_phases)
+      pcs, pfs = self.search_costs(freqs, n_code_phases)
+      strategy = 'pfs' if pfs < pcs else 'pcs'
+
+    if strategy == 'pfs':
+      if code_phases is None:
+        code_phases = np.arange(self.samples_per_code)
+      results = self.correlate_pfs(_code_table(codes)[prn], freqs,
+                                   code_phases,
+                                   progress_callback=progress_callback)
+    else:
+      results = self.correlate(self.code_spectra(codes)[prn], freqs,
+                               progress_callback=progress_callback)
+      if code_phases is not None:
+        results = results[:, code_phases]
+
+    return self.find_peak(freqs, results, interpolation='gaussian',
+                          code_phases=code_phases)
+
+  def _acquire_serial(self, code_ft_conj, freqs, results, progress_callback):
+    """
+    Fill `results` with one inverse FFT per frequency and offset.
 
+    """
     acq_mag = []
     for n, freq in enumerate(freqs):
       # Report on our progress
@@ -292,8 +763,7 @@ class Acquisition:
 
       # Shift the signal in the frequency domain to remove the carrier
       # i.e. mix down to baseband.
-      shift = int((float(freq) * len(self.short_samples_ft[0]) /
-                   self.sampling_freq) + 0.5)
+      shift = self._freq_shift(freq)
 
       # Search over the possible nav bit offset intervals
       for offset_i in range(len(self.offsets)):
@@ -308,18 +778,75 @@ class Acquisition:
         acq_mag = np.abs(self.corr[:self.samples_per_code])
         results[offset_i][n] = np.square(acq_mag)
 
-    # Choose the nav-bit-declobber sample interval with the best correlation
-    max_indices = np.unravel_index(results.argmax(), results.shape)
-    return results[max_indices[0]]
+  def _batch_ifft(self, n_freqs):
+    """
+    Get (creating it if needed) the batched inverse FFT for `n_freqs` bins.
+
+    The transform runs over the last axis of an array shaped
+    (offsets, `n_freqs`, `n_integrate` / `batch_stride`). Measuring a plan
+    for a batch of this size takes far longer than running it, and an
+    estimated plan is as fast per transform as the measured single one, so it
+    is only estimated.
+
+    """
+    ifft = self.batch_iffts.get(n_freqs)
+    if ifft is None:
+      shape = (len(self.offsets), n_freqs,
+               self.n_integrate // self.batch_stride)
+      corr_ft = pyfftw.n_byte_align_empty(shape, 16, dtype=self.complex_dtype)
+      corr = pyfftw.n_byte_align_empty(shape, 16, dtype=self.complex_dtype)
+      ifft = pyfftw.FFTW(corr_ft, corr, axes=(-1,),
+                         direction='FFTW_BACKWARD',
+                         flags=('FFTW_ESTIMATE',))
+      self.batch_iffts[n_freqs] = ifft
+    return ifft
+
+  def _acquire_batched(self, code_ft_conj, freqs, results, progress_callback):
+    """
+    Fill `results` using batched inverse FFTs over many Doppler bins.
+
+    """
+    n_freqs = len(freqs)
+    n = self.n_integrate
+    stride = self.batch_stride
+    code_ft_conj = code_ft_conj[::stride]
+    # Two aligned complex buffers per frequency and offset.
+    bin_bytes = 2 * np.dtype(self.complex_dtype).itemsize * \
+        (n // stride) * len(self.offsets)
+    max_batch = max(1, self.batch_bytes // bin_bytes)
+    # Split the bins into evenly sized batches, so that a single plan serves
+    # all of them. Rows past the end of the last batch are left unused.
+    n_batches = (n_freqs + max_batch - 1) // max_batch
+    batch = (n_freqs + n_batches - 1) // n_batches
+    ifft = self._batch_ifft(batch)
+    corr_ft = ifft.input_array
+
+    for first in range(0, n_freqs, batch):
+      last = min(first + batch, n_freqs)
+
+      # Shift the signal in the frequency domain to remove the carrier,
+      # i.e. mix down to baseband, and multiply by the code spectrum.
+      for i, freq in enumerate(freqs[first:last]):
+        shift = self._freq_shift(freq)
+        np.multiply(self.short_samples_ft2[:, shift:shift + n:stride],
+                    code_ft_conj, out=corr_ft[:, i, :])
+
+      ifft.execute()
+      corr = ifft.output_array[:, :last - first, :self.samples_per_code]
+      np.square(np.abs(corr), out=results[:, first:last, :])
 
-  def find_peak(self, freqs, results, interpolation='gaussian'):
+      if progress_callback:
+        progress_callback(last, n_freqs)
+
+  def find_peak(self, freqs, results, interpolation='gaussian',
+                code_phases=None):
     """
     Find the peak within an set of acquisition results.
 
     Finds the point in the acquisition results array with the greatest
     correlation power and determines the code phase and carrier frequency
     corresponding to that point. The Signal-to-Noise Ratio (SNR) of the peak is
-    also estimated.
+    also estimated. This is `find_peaks` for a single PRN and peak.
 
     Parameters
     ----------
@@ -328,6 +855,10 @@ class Acquisition:
     results : :class:`numpy.ndarray`, shape(len(`freqs`), `samples_per_code`)
       2D array containing correlation powers at different frequencies and code
       phases. Code phase axis is in samples from zero to `samples_per_code`.
+    code_phases : iterable of int or `None`, optional
+      Code phases in samples of the columns of `results`, if only some were
+      searched. The SNR is then relative to the expected noise power instead
+      of the mean of `results`.
 
     Returns
     -------
@@ -338,36 +869,243 @@ class Acquisition:
         (currently) in arbitrary units.
 
     """
-    # Find the results index of the maximum.
-    freq_index, cp_samples = np.unravel_index(results.argmax(),
-                                              results.shape)
-
-    if freq_index > 1 and freq_index < len(freqs) - 1:
-      delta = self.interpolate(
-          results[freq_index - 1][cp_samples],
-          results[freq_index][cp_samples],
-          results[freq_index + 1][cp_samples],
-          interpolation
-      )
-      if delta > 0:
-        freq = freqs[freq_index] + \
-            (freqs[freq_index + 1] - freqs[freq_index]) * delta
+    code_phase, freq, snr = self.find_peaks(freqs, results[np.newaxis],
+                                            interpolation=interpolation,
+                                            code_phases=code_phases)
+    return (code_phase[0, 0], freq[0, 0], snr[0, 0])
+
+  def find_peaks(self, freqs, results, k=1, interpolation='gaussian',
+                 code_phases=None):
+    """
+    Find the strongest peaks for many PRNs at once.
+
+    For every PRN, the code phases are ranked by the power of their best
+    frequency (and offset). The `k` strongest ones that are more than one
+    chip away from any stronger peak are returned, i.e. the main peak and
+    the strongest secondary peaks, e.g. for cross-correlation checks. The
+    frequency of each peak is interpolated between the neighbouring bins like
+    in `find_peak`, and its SNR is its power relative to the mean power of
+    the PRN's results.
+
+    Parameters
+    ----------
+    freqs : :class:`numpy.ndarray`, shape(n_freqs,) or (n_prns, n_freqs)
+      Frequencies in Hz of the frequency axis of `results`, either common to
+      all the PRNs or one row per PRN.
+    results : :class:`numpy.ndarray`, shape(n_prns, ..., n_freqs, n_phases)
+      Correlation powers. Any axes between the PRN and the frequency axes,
+      e.g. the offsets, are searched together.
+    k : int, optional
+      Number of peaks to find per PRN.
+    interpolation : {'gaussian', 'parabolic', 'none'}, optional
+      Frequency interpolation method, see `interpolate`.
+    code_phases : iterable of int or `None`, optional
+      Code phases in samples of the last axis of `results`, if only some were
+      searched. The SNR is then relative to the expected noise power instead
+      of the mean of `results`.
+
+    Returns
+    -------
+    out : (array, array, array)
+      | The tuple
+      |   `(code_phase, carrier_freq, SNR)`
+      | Of arrays of shape(n_prns, `k`) with the peaks of each PRN, strongest
+        first, in the units of `find_peak`. Where fewer than `k` peaks exist,
+        the code phase and frequency are NaN and the SNR is zero.
+
+    """
+    n_prns = results.shape[0]
+    n_freqs, n_phases = results.shape[-2:]
+    surfaces = results.reshape(n_prns, -1, n_phases)
+    prn_index = np.arange(n_prns)[:, np.newaxis]
+
+    # The power of the best frequency and offset of every code phase.
+    profile = surfaces.max(axis=1)
+
+    # Pick the strongest code phase, then suppress everything within one chip
+    # of it, so that every peak is only found once, and repeat. The code phase
+    # axis is circular unless only a window of code phases was searched.
+    width = int(np.ceil(self.samples_per_chip))
+    neighbours = np.arange(-width, width + 1)
+    masked = profile.astype(np.float64)
+    top = np.empty((n_prns, k), dtype=int)
+    found = np.empty((n_prns, k), dtype=bool)
+    for j in range(k):
+      top[:, j] = masked.argmax(axis=1)
+      found[:, j] = np.isfinite(masked[prn_index[:, 0], top[:, j]])
+      suppress = top[:, j, np.newaxis] + neighbours
+      if code_phases is None:
+        suppress %= n_phases
       else:
-        freq = freqs[freq_index] - \
-            (freqs[freq_index - 1] - freqs[freq_index]) * delta
+        suppress = np.clip(suppress, 0, n_phases - 1)
+      masked[prn_index, suppress] = -np.inf
+
+    # Interpolate the frequency of each peak between the neighbouring bins of
+    # the same offset and code phase.
+    row = surfaces[prn_index, :, top].argmax(axis=-1)
+    freq_index = row % n_freqs
+    inner = (freq_index > 0) & (freq_index < n_freqs - 1)
+    S_1 = surfaces[prn_index, row, top]
+    S_0 = surfaces[prn_index, np.where(inner, row - 1, row), top]
+    S_2 = surfaces[prn_index, np.where(inner, row + 1, row), top]
+    with np.errstate(divide='ignore', invalid='ignore'):
+      delta = self.interpolate(S_0, S_1, S_2, interpolation)
+    delta = np.where(inner & np.isfinite(delta), delta, 0)
+
+    # Per PRN frequencies, also when all PRNs share the same ones
+    freqs = np.asarray(freqs) + np.zeros((n_prns, 1))
+    below = freqs[prn_index, np.maximum(freq_index - 1, 0)]
+    above = freqs[prn_index, np.minimum(freq_index + 1, n_freqs - 1)]
+    peak_freqs = freqs[prn_index, freq_index]
+    step = np.where(delta > 0, above - peak_freqs, peak_freqs - below)
+    carr_freq = np.where(found, peak_freqs + step * delta, np.nan)
+
+    if code_phases is not None:
+      top = np.asarray(code_phases)[top]
+    code_phase = np.where(found, top / float(self.samples_per_chip), np.nan)
+
+    # Calculate SNR for the peaks. A window of code phases around a prior is
+    # mostly correlation peak, so there the mean is replaced by the expected
+    # power of noise, which (by Parseval) is the sample power times `n` squared.
+    if code_phases is None:
+      results_mean = surfaces.mean(axis=(1, 2), dtype=np.float64)
     else:
-      freq = freqs[freq_index]
+      results_mean = np.repeat(self.n_integrate * np.mean(
+          np.sum(np.square(np.abs(self.short_samples_ft)), axis=-1)), n_prns)
+    results_mean = results_mean[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+      snr = np.where(found & (results_mean != 0),
+                     S_1 / results_mean, 0)
 
-    code_phase = float(cp_samples) / self.samples_per_chip
+    return (code_phase, carr_freq, snr)
 
-    # Calculate SNR for the peak.
-    results_mean = np.mean(results)
-    if results_mean != 0:
-      snr = np.max(results) / results_mean
-    else:
-      snr = 0
+  def coarse_acquisition(self, n_ms=DEFAULT_COARSE_MS):
+    """
+    Get the 1 ms acquisition used for the coarse search.
+
+    The returned :class:`Acquisition` works on the same samples as this one,
+    with `n_ms` consecutive 1 ms blocks as its offsets, so that
+    `correlate(..., noncoherent=True)` sums them non-coherently. It is created
+    on first use and follows later calls to `init_samples`.
+
+    Parameters
+    ----------
+    n_ms : int, optional
+      Number of 1 ms blocks to sum.
+
+    Returns
+    -------
+    out : :class:`Acquisition`
+
+    """
+    coarse_acq = self.coarse_acqs.get(n_ms)
+    if coarse_acq is None:
+      coarse_acq = Acquisition(self.signal,
+                               self.samples,
+                               self.sampling_freq,
+                               self.IF,
+                               self.samples_per_chip * self.code_length,
+                               self.code_length,
+                               n_codes_integrate=1,
+                               offsets=[k * self.samples_per_code
+                                        for k in range(n_ms)],
+                               wisdom_file=self.wisdom_file,
+                               batched=self.batched,
+                               batch_bytes=self.batch_bytes,
+                               precision=self.precision)
+      self.coarse_acqs[n_ms] = coarse_acq
+    return coarse_acq
+
+  def start_pool(self, codes='l1ca', nprocs=None, coarse_ms=None):
+    """
+    Start a persistent pool of worker processes used by `acquisition`.
+
+    The short sets of samples and their spectra are moved to shared memory
+    and the spectra of `codes` are loaded with :meth:`code_spectra` (a
+    memory-mapped file when a wisdom file is used). The workers attach to
+    them when they are forked, so nothing but the PRN and the frequencies to
+    search is sent per job. The workers live until `stop_pool` is called and
+    keep their FFTW plans across calls to `acquisition` and `init_samples`.
+
+    The same goes for the coarse acquisitions of :meth:`coarse_acquisition`
+    created so far, so that the workers also run the coarse searches. A
+    coarse search with another number of blocks restarts the pool.
+
+    Parameters
+    ----------
+    codes : {'l1ca', 'l2cm', 'glo'}, optional
+      Code family searched by the workers, the default of `acquisition`
+      while the pool runs. Default: GPS L1 C/A.
+    nprocs : int or `None`, optional
+      Number of worker processes. Default: one per CPU.
+    coarse_ms : int or `None`, optional
+      Number of 1 ms blocks of a coarse acquisition to create for the
+      workers, see `acquisition`.
+
+    """
+    from peregrine.parallel_processing import WorkerPool
+    import multiprocessing as mp
+
+    if self.pool is not None:
+      self.stop_pool()
+
+    if coarse_ms is not None:
+      self.coarse_acquisition(coarse_ms)
+    for acq in [self] + self.coarse_acqs.values():
+      acq._share_samples()
+      # Loaded before forking, so that all the workers share them.
+      acq.code_spectra(codes)
+
+    self.pool = WorkerPool(self._pool_search, nprocs or mp.cpu_count())
+    self.pool_codes = codes
+
+  def _share_samples(self):
+    """Move the short sets of samples and their spectra to shared memory."""
+    from peregrine.parallel_processing import shared_array
+
+    short_samples = shared_array((len(self.offsets), self.n_integrate),
+                                 self.complex_dtype)
+    short_samples_ft2 = shared_array((len(self.offsets), 2 * self.n_integrate),
+                                     self.complex_dtype)
+    if hasattr(self, 'short_samples_ft2'):
+      short_samples[:] = self.short_samples
+      short_samples_ft2[:] = self.short_samples_ft2
+    self.short_samples = short_samples
+    self.short_samples_ft2 = short_samples_ft2
+    self.short_samples_ft = short_samples_ft2[:, :self.n_integrate]
+    self.samples_shared = True
+
+  def stop_pool(self):
+    """Stop the worker pool started by `start_pool`."""
+    if self.pool is not None:
+      self.pool.close()
+      self.pool = None
+      self.pool_codes = None
+      for acq in [self] + self.coarse_acqs.values():
+        acq.samples_shared = False
+
+  def _pool_search(self, job):
+    """
+    Search one PRN in a pool worker, returning the peak from `find_peak`.
+
+    `job` is the number of 1 ms blocks and the arguments of `_coarse_search`
+    for a coarse search, `None` and the arguments of `_search` otherwise.
+
+    """
+    coarse_ms, args = job
+    if coarse_ms is None:
+      return self._search(*args)
+    return self.coarse_acqs[coarse_ms]._coarse_search(*args)
+
+  def _coarse_search(self, prn, freqs, codes='l1ca'):
+    """
+    Search one PRN summing the offsets non-coherently, returning the peak
+    found by `find_peak`.
 
-    return (code_phase, freq, snr)
+    """
+    results = self.correlate(self.code_spectra(codes)[prn], freqs,
+                             noncoherent=True)
+    return self.find_peak(freqs, results)
 
   def acquisition(self,
                   prns=range(32),
@@ -376,7 +1114,13 @@ class Acquisition:
                   doppler_step=None,
                   threshold=DEFAULT_THRESHOLD,
                   progress_bar_output='none',
-                  multi=True
+                  multi=True,
+                  coarse_threshold=None,
+                  coarse_ms=DEFAULT_COARSE_MS,
+                  code_phase_priors=None,
+                  code_phase_search=DEFAULT_CODE_PHASE_SEARCH,
+                  strategy='auto',
+                  codes=None
                   ):
     """
     Perform an acquisition for a given list of PRNs.
@@ -409,6 +1153,31 @@ class Acquisition:
     show_progress : bool, optional
       When `True` a progress bar will be printed showing acquisition status and
       estimated time remaining.
+    multi : bool, optional
+      Search the PRNs in parallel processes. Ignored when a pool has been
+      started with `start_pool`, which is then always used.
+    coarse_threshold : float or `None`, optional
+      If given, every PRN is first searched over the whole Doppler range with
+      `coarse_ms` 1 ms blocks summed non-coherently, in 1 kHz steps. PRNs
+      whose coarse SNR is below `coarse_threshold` are reported as not
+      acquired with the coarse estimates; the others only get the full search
+      within about one coarse step of the coarse peak.
+    coarse_ms : int, optional
+      Number of 1 ms blocks summed in the coarse search.
+    code_phase_priors : list of floats or `None`, optional
+      List of expected code phases in chips (one per PRN). If given, only code
+      phases within `code_phase_search` chips of these are searched.
+    code_phase_search : float, optional
+      Maximum code phase away from code_phase_prior to search, in chips.
+    strategy : {'auto', 'pcs', 'pfs'}, optional
+      Search with the parallel code phase ('pcs') or the parallel frequency
+      ('pfs') method, or pick the cheaper one for each PRN ('auto') with
+      `search_costs`. Searching all code phases, the parallel code phase
+      search is practically always the cheaper one; the parallel frequency
+      search pays off with narrow `code_phase_priors` windows.
+    codes : {'l1ca', 'l2cm', 'glo'} or `None`, optional
+      Code family of the PRNs. Default: the one of the pool started with
+      `start_pool`, GPS L1 C/A without a pool.
 
     Returns
     -------
@@ -419,6 +1188,12 @@ class Acquisition:
     logger.info("Acquisition starting")
     from peregrine.parallel_processing import parmap
 
+    if strategy not in ('auto', 'pcs', 'pfs'):
+      raise ValueError("Unknown acquisition strategy '%s'." % strategy)
+
+    if codes is None:
+      codes = self.pool_codes or 'l1ca'
+
     # If the Doppler step is not specified, compute it from the coarse
     # acquisition length.
     if doppler_step is None:
@@ -447,7 +1222,7 @@ class Acquisition:
       logger.warning("show_progress = True but progressbar module not found.")
 
     # Setup our progress bar if we need it
-    if show_progress and not multi:
+    if show_progress and not multi and self.pool is None:
       widgets = ['  Acquisition ',
                  progressbar.Attribute('prn', '(PRN: %02d)', '(PRN --)'), ' ',
                  progressbar.Percentage(), ' ',
@@ -461,28 +1236,43 @@ class Acquisition:
     else:
       pbar = None
 
+    def search_code_phases(n):
+      if code_phase_priors is None:
+        return None
+      center = code_phase_priors[n] * self.samples_per_chip
+      first = int(round(center - code_phase_search * self.samples_per_chip))
+      last = int(round(center + code_phase_search * self.samples_per_chip))
+      return np.arange(first, last + 1) % self.samples_per_code
+
+    def search_freqs(n):
+      doppler_prior = doppler_priors[n]
+      return np.arange(doppler_prior - doppler_search,
+                       doppler_prior + doppler_search, doppler_step) + self.IF
+
     def do_acq(n):
       prn = prns[n]
-      doppler_prior = doppler_priors[n]
-      freqs = np.arange(doppler_prior - doppler_search,
-                        doppler_prior + doppler_search, doppler_step) + self.IF
+      freqs = fine_freqs[n]
       if pbar:
-        def progress_callback(freq_num, num_freqs):
-          pbar.update(n * len(freqs) + freq_num, attr={'prn': prn + 1})
+        def progress_callback(step, num_steps):
+          pbar.update(n * len(freqs) + step * len(freqs) // num_steps,
+                      attr={'prn': prn + 1})
       else:
         progress_callback = None
 
-      coarse_results = self.acquire(caCodes[prn], freqs,
-                                    progress_callback=progress_callback)
+      peak = self._search(prn, freqs, search_code_phases(n), strategy, codes,
+                          progress_callback=progress_callback)
+      return make_result(n, peak)
 
-      code_phase, carr_freq, snr = self.find_peak(freqs, coarse_results,
-                                                  interpolation='gaussian')
+    def make_result(n, peak, status=None):
+      prn = prns[n]
+      code_phase, carr_freq, snr = peak
 
       # If the result is above the threshold, then we have acquired the
       # satellite.
-      status = '-'
-      if (snr > threshold):
-        status = 'A'
+      if status is None:
+        status = '-'
+        if (snr > threshold):
+          status = 'A'
 
       # Save properties of the detected satellite signal
       acq_result = AcquisitionResult(prn,
@@ -494,16 +1284,65 @@ class Acquisition:
                                      self.signal)
 
       # If the acquisition was successful, log it
-      if (snr > threshold):
+      if status == 'A':
         logger.debug("Acquired %s" % acq_result)
 
       return acq_result
 
-    if multi:
-      acq_results = parmap(
-          do_acq, range(len(prns)), show_progress=show_progress)
+    # Frequencies of the full search, per PRN index. The coarse search
+    # narrows them down or drops the PRN altogether.
+    fine_freqs = dict((n, search_freqs(n)) for n in range(len(prns)))
+    acq_by_index = {}
+
+    if coarse_threshold is not None:
+      coarse_acq = self.coarse_acquisition(coarse_ms)
+      if self.pool is not None and not coarse_acq.samples_shared:
+        # The workers were forked before this coarse acquisition existed.
+        logger.debug("Restarting the acquisition pool for the coarse search.")
+        self.start_pool(self.pool_codes, len(self.pool.procs))
+      # Carrier removal shifts the spectrum by whole bins, so finer steps
+      # would only repeat bins.
+      coarse_step = self.sampling_freq / coarse_acq.n_integrate
+      coarse_freqs = [np.arange(doppler_priors[n] - doppler_search,
+                                doppler_priors[n] + doppler_search +
+                                coarse_step / 2, coarse_step) + self.IF
+                      for n in range(len(prns))]
+      if self.pool is not None:
+        jobs = [(coarse_ms, (prn, coarse_freqs[n], codes))
+                for n, prn in enumerate(prns)]
+        coarse_peaks = self.pool.map(jobs, show_progress=show_progress)
+      else:
+        coarse_peaks = [coarse_acq._coarse_search(prn, coarse_freqs[n], codes)
+                        for n, prn in enumerate(prns)]
+      for n, peak in enumerate(coarse_peaks):
+        if peak[2] < coarse_threshold:
+          acq_by_index[n] = make_result(n, peak, '-')
+          del fine_freqs[n]
+        else:
+          # Keep the fine bins within one coarse step of the coarse peak,
+          # plus one more on each side so that the fine peak can still be
+          # interpolated.
+          freqs = fine_freqs[n]
+          k = np.abs(freqs - peak[1]).argmin()
+          m = int(np.ceil(coarse_step / doppler_step)) + 1
+          fine_freqs[n] = freqs[max(k - m, 0):k + m + 1]
+      logger.debug("%d of %d PRNs passed the coarse search.",
+                   len(fine_freqs), len(prns))
+
+    todo = sorted(fine_freqs)
+    if self.pool is not None:
+      jobs = [(None, (prns[n], fine_freqs[n], search_code_phases(n), strategy,
+                      codes))
+              for n in todo]
+      peaks = self.pool.map(jobs, show_progress=show_progress)
+      fine_results = [make_result(n, peak) for n, peak in zip(todo, peaks)]
+    elif multi and todo:
+      fine_results = parmap(do_acq, todo, show_progress=show_progress)
     else:
-      acq_results = map(do_acq, range(len(prns)))
+      fine_results = map(do_acq, todo)
+
+    acq_by_index.update(zip(todo, fine_results))
+    acq_results = [acq_by_index[n] for n in range(len(prns))]
 
     # Acquisition is finished
 
@@ -518,6 +1357,154 @@ class Acquisition:
 
     return acq_results
 
+  def reacquisition(self,
+                    prns,
+                    doppler_priors,
+                    doppler_search=DEFAULT_REACQ_DOPPLER_SEARCH,
+                    threshold=DEFAULT_THRESHOLD,
+                    **kwargs):
+    """
+    Re-acquire satellites around their last known Doppler.
+
+    Searches a narrow window around `doppler_priors`, e.g. the last Doppler of
+    channels that lost lock, in the current samples, typically after
+    `advance_samples`. The `sample_index` of the results is the
+    `sample_index` of the samples, so that tracking can restart there.
+
+    Parameters
+    ----------
+    prns : iterable
+      List of PRNs to re-acquire.
+    doppler_priors : list of floats
+      List of expected Doppler frequencies in Hz (one per PRN).
+    doppler_search : float, optional
+      Maximum frequency away from doppler_prior to search.
+    threshold : float, optional
+      Threshold SNR value for a satellite to be considered acquired.
+    kwargs : dict, optional
+      Other parameters of `acquisition`.
+
+    Returns
+    -------
+    out : [AcquisitionResult]
+      A list of :class:`AcquisitionResult` objects, one per PRN in `prns`.
+
+    """
+    acq_results = self.acquisition(prns,
+                                   doppler_priors=doppler_priors,
+                                   doppler_search=doppler_search,
+                                   threshold=threshold,
+                                   **kwargs)
+    for acq_result in acq_results:
+      acq_result.sample_index = self.sample_index
+    return acq_results
+
+  def noncoherent_acquisition(self,
+                              blocks,
+                              prns=range(32),
+                              doppler_priors=None,
+                              doppler_search=7000,
+                              doppler_step=None,
+                              threshold=DEFAULT_THRESHOLD):
+    """
+    Perform an acquisition summing many blocks of samples non-coherently.
+
+    Each block is correlated coherently as in `acquisition` and the resulting
+    correlation powers are added to one running surface per PRN, so memory
+    use does not grow with the number of blocks. This allows integrating much
+    longer than the coherent integration length allows, e.g. for weak
+    signals.
+
+    The blocks replace the samples given to the constructor or
+    `init_samples` and must be consecutive, i.e. each one starts where the
+    previous one ended. Each block must hold at least the last offset plus
+    `n_integrate` samples; with ``offsets=[0]`` blocks of `n_integrate`
+    samples can be used, e.g. as generated by
+    :func:`peregrine.samples.load_sample_blocks`. The code Doppler is not
+    compensated, which limits the total integration time to a few seconds.
+
+    Parameters
+    ----------
+    blocks : iterable of :class:`numpy.ndarray`
+      Blocks of samples, consumed once.
+    prns : iterable, optional
+      List of PRNs to acquire. Default: 0..31 (0-indexed)
+    doppler_priors : list of floats, optional
+      List of expected Doppler frequencies in Hz (one per PRN).
+    doppler_search : float, optional
+      Maximum frequency away from doppler_prior to search.  Default: 7000
+    doppler_step : float, optional
+      Doppler frequency step. Default: one bin of the coherent integration.
+    threshold : float, optional
+      Threshold SNR value for a satellite to be considered acquired. Summing
+      blocks lowers the SNR of noise peaks, so lower values than for
+      `acquisition` can be used.
+
+    Returns
+    -------
+    out : [AcquisitionResult]
+      A list of :class:`AcquisitionResult` objects, one per PRN in `prns`.
+
+    """
+    logger.info("Non-coherent acquisition starting")
+
+    if doppler_step is None:
+      doppler_step = self.sampling_freq / self.n_integrate
+
+    if doppler_priors is None:
+      doppler_priors = np.zeros_like(prns)
+
+    code_spectra = self.code_spectra('l1ca')
+    window = np.arange(-doppler_search, doppler_search, doppler_step)
+    freqs = np.add.outer(doppler_priors, window) + self.IF
+    powers = np.zeros((len(prns), len(window), self.samples_per_code),
+                      dtype=self.real_dtype)
+
+    block_size = max(self.offsets) + self.n_integrate
+    samples_per_code = self.samples_per_chip * self.code_length
+    n_blocks = 0
+    block_start = 0
+    for block in blocks:
+      if len(block) < block_size:
+        raise ValueError("Sample block too short, %d samples needed."
+                         % block_size)
+      self.init_samples(block)
+      # Unless the blocks are a whole number of code periods long, the code
+      # phase moves from one block to the next. Rotate the surfaces so that
+      # they all refer to the code phase at the start of the first block.
+      drift = int(round(block_start % samples_per_code))
+      for n, prn in enumerate(prns):
+        powers[n] += np.roll(self.correlate(code_spectra[prn], freqs[n]),
+                             drift, axis=1)
+      n_blocks += 1
+      block_start += len(block)
+
+    if n_blocks == 0:
+      raise ValueError("No sample blocks to acquire.")
+
+    code_phases, carr_freqs, snrs = self.find_peaks(freqs, powers)
+    acq_results = []
+    for n, prn in enumerate(prns):
+      code_phase, carr_freq, snr = \
+          code_phases[n, 0], carr_freqs[n, 0], snrs[n, 0]
+      status = '-'
+      if (snr > threshold):
+        status = 'A'
+      acq_results.append(AcquisitionResult(prn,
+                                           carr_freq,
+                                           carr_freq - self.IF,
+                                           code_phase,
+                                           snr,
+                                           status,
+                                           self.signal))
+
+    logger.info("Non-coherent acquisition of %d blocks finished", n_blocks)
+    acquired_prns = [ar.prn + 1 for ar in acq_results if ar.status == 'A']
+    logger.info("Acquired %d satellites, PRNs: %s.",
+                len(acquired_prns), acquired_prns)
+
+    return acq_results
+
   def load_wisdom(self, wisdom_file=DEFAULT_WISDOM_FILE):
     """Load saved FFTW wisdom from file."""
     with open(wisdom_file, 'rb') as f:
@@ -677,3 +1664,16 @@ def print_scores(acq_results, pred, pred_dopp=None):
   print "Found %d of %d, mean doppler error = %+5.0f Hz, mean abs err = %4.0f Hz, worst = %+5.0f Hz"\
         % (n_match, len(pred),
            sum_dopp_err / max(1, n_match), sum_abs_dopp_err / max(1, n_match), worst_dopp_err)
+
+
+def _code_table(codes):
+  """Get the codes of a code family, one row per PRN."""
+  if codes == 'l1ca':
+    return caCodes
+  elif codes == 'l2cm':
+    from include.generateL2CMcode import L2CMCodes
+    return L2CMCodes
+  elif codes == 'glo':
+    from include.generateGLOcode import GLOCode
+    return GLOCode[np.newaxis]
+  raise ValueError("Unknown code family '%s'." % codes)
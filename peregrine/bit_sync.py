@@ -0,0 +1,332 @@
+# Copyright (C) 2016 Swift Navigation Inc.
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+The :mod:`peregrine.bit_sync` module finds the navigation data bit edges in
+arrays of 1 ms prompt correlations.
+
+The functions process a whole array at once and give the results the
+:class:`peregrine.tracking.NavBitSync` classes reach by feeding the
+correlations one at a time. They take the state of such a synchronizer
+(the bit phase and count of the correlations already seen, the histogram and
+the previous correlations), so that arrays can continue where the previous
+ones ended.
+
+Stored tracking results can be synchronized from their prompt correlations
+taken while the coherent integration was 1 ms, for example::
+
+  ends, bits = decode_bits(records['P'].real[records['coherent_ms'] == 1])
+
+"""
+
+import numpy as np
+
+BIT_PERIOD_MS = 20
+"""Length of a GPS L1C/A navigation data bit [ms]."""
+
+
+def _phases(n, phase, period):
+  """
+  Bit phases of `n` correlations following the bit phase `phase`.
+
+  """
+  return (phase + 1 + np.arange(n)) % period
+
+
+def _extend(corr, history, length):
+  """
+  Prefix `corr` with the `length` correlations before it, the last of
+  `history` padded with zeros.
+
+  """
+  history = np.asarray(history, dtype=np.float64)[-length:]
+  return np.concatenate((np.zeros(length - len(history)), history, corr))
+
+
+def _cumulative_hists(phases, bins, weights, hist, period):
+  """
+  Add the weights to the histogram bins.
+
+  Returns
+  -------
+  out : tuple
+    The indices of the correlations at the last bit phase, and the
+    histograms after each of them followed by the final histogram.
+
+  """
+  last = phases == period - 1
+  checks = np.flatnonzero(last)
+  cycle = np.cumsum(last) - last
+  sums = np.bincount(cycle * period + bins, weights=weights,
+                     minlength=(len(checks) + 1) * period)
+  hists = hist + np.cumsum(sums.reshape(-1, period), axis=0)
+  return checks, hists
+
+
+def _scores(hists):
+  """
+  Difference between the two highest bins of each histogram.
+
+  """
+  top = np.sort(hists, axis=1)
+  return top[:, -1] - top[:, -2]
+
+
+def window_sums(corr, length, history=()):
+  """
+  Sum of the last `length` correlations at each correlation.
+
+  Parameters
+  ----------
+  corr : array_like
+    Correlations.
+  length : int
+    Number of correlations to sum.
+  history : array_like, optional
+    Correlations before `corr`, zeros when missing.
+
+  Returns
+  -------
+  out : :class:`numpy.ndarray`
+    The sums, one per correlation.
+
+  """
+  corr = np.asarray(corr, dtype=np.float64)
+  acc = np.concatenate(([0.], np.cumsum(_extend(corr, history, length))))
+  return acc[length + 1:] - acc[1:len(corr) + 1]
+
+
+def match_bit(corr, thres=25, phase=0, count=0, history=(), hist=None,
+              period=BIT_PERIOD_MS):
+  """
+  Find the bit edges by matching the correlations with a bit long window,
+  like :class:`peregrine.tracking.NBSMatchBit`.
+
+  The absolute sum of the last `period` correlations is accumulated in a
+  histogram of their bit phase. After each bit, the bit phase of the highest
+  bin is taken when it exceeds the next one by `thres` times twice the
+  largest of the last `period` correlations.
+
+  Parameters
+  ----------
+  corr : array_like
+    Prompt correlations, one per ms.
+  thres : float, optional
+    Threshold of the histogram score.
+  phase : int, optional
+    Bit phase before the first correlation.
+  count : int, optional
+    Number of correlations before the first one.
+  history : array_like, optional
+    Last correlations before the first one.
+  hist : array_like, optional
+    Histogram of the correlations before the first one.
+  period : int, optional
+    Bit length [ms].
+
+  Returns
+  -------
+  out : tuple
+    Index of the correlation at which the bit edges are found, the bit phase
+    at which the bits end (the `bit_phase_ref` of the synchronizer) and the
+    histogram then. The index and the bit phase are -1 if the bit edges are
+    not found, and the histogram is then the one after the last
+    correlation.
+
+  """
+  corr = np.asarray(corr, dtype=np.float64)
+  n = len(corr)
+  hist = np.zeros(period) if hist is None else np.asarray(hist)
+  phases = _phases(n, phase, period)
+  # The window sums are valid once a whole window was seen
+  valid = count + 1 + np.arange(n) >= period
+  sums = np.abs(window_sums(corr, period, history)) * valid
+  checks, hists = _cumulative_hists(phases, phases, sums, hist, period)
+
+  extended = np.abs(_extend(corr, history, period))
+  windows = extended[checks[:, np.newaxis] + period -
+                     np.arange(period)[::-1]]
+  found = np.flatnonzero(valid[checks] & (
+      _scores(hists[:len(checks)]) > thres * 2 * windows.max(axis=1)))
+  if len(found):
+    j = found[0]
+    return checks[j], int(np.argmax(hists[j])), hists[j]
+  return -1, -1, hists[-1]
+
+
+def histogram(corr, thres=10, phase=0, count=0, prev_corr=0., hist=None,
+              period=BIT_PERIOD_MS):
+  """
+  Find the bit edges from a histogram of the sign changes of the
+  correlations, like :class:`peregrine.tracking.NBSHistogram`.
+
+  Each sign change adds the opposite of the product of the two correlations
+  to the bin of its bit phase. The bit phase of the highest bin is taken at
+  the `thres`-th sign change.
+
+  Parameters
+  ----------
+  corr : array_like
+    Prompt correlations, one per ms.
+  thres : int, optional
+    Number of sign changes to take.
+  phase : int, optional
+    Bit phase before the first correlation.
+  count : int, optional
+    Number of sign changes before the first correlation.
+  prev_corr : float, optional
+    Correlation before the first one.
+  hist : array_like, optional
+    Histogram of the sign changes before the first correlation.
+  period : int, optional
+    Bit length [ms].
+
+  Returns
+  -------
+  out : tuple
+    See :func:`match_bit`.
+
+  """
+  corr = np.asarray(corr, dtype=np.float64)
+  hist = np.zeros(period) if hist is None else np.asarray(hist)
+  phases = _phases(len(corr), phase, period)
+  dots = corr * np.concatenate(([prev_corr], corr[:-1]))
+  edges = np.flatnonzero(dots < 0)
+  index = -1
+  if len(edges) >= thres - count:
+    edges = edges[:thres - count]
+    index = edges[-1]
+  hist = hist + np.bincount(phases[edges], weights=-dots[edges],
+                            minlength=period)
+  if index < 0:
+    return -1, -1, hist
+  return index, int(np.argmax(hist)), hist
+
+
+def match_edge(corr, thres=100000, phase=0, count=0, history=(), hist=None,
+               period=BIT_PERIOD_MS):
+  """
+  Find the bit edges by matching the correlations with a bit edge, like
+  :class:`peregrine.tracking.NBSMatchEdge`.
+
+  The correlations are convolved with a bit edge, the last `period`
+  correlations minus the `period` ones before them. The absolute values are
+  accumulated in a histogram of the bit phase following them. After each
+  bit, the bit phase of the highest bin is taken when it exceeds the next one
+  by `thres`.
+
+  Parameters
+  ----------
+  corr : array_like
+    Prompt correlations, one per ms.
+  thres : float, optional
+    Threshold of the histogram score.
+  phase : int, optional
+    Bit phase before the first correlation.
+  count : int, optional
+    Number of correlations before the first one.
+  history : array_like, optional
+    Last correlations before the first one.
+  hist : array_like, optional
+    Histogram of the correlations before the first one.
+  period : int, optional
+    Bit length [ms].
+
+  Returns
+  -------
+  out : tuple
+    See :func:`match_bit`.
+
+  """
+  corr = np.asarray(corr, dtype=np.float64)
+  n = len(corr)
+  hist = np.zeros(period) if hist is None else np.asarray(hist)
+  phases = _phases(n, phase, period)
+  edge = np.concatenate((np.ones(period), -np.ones(period)))
+  extended = _extend(corr, history, 2 * period)
+  valid = count + 1 + np.arange(n) >= 2 * period
+  sums = np.abs(np.convolve(extended, edge, 'valid')[1:]) * valid
+  checks, hists = _cumulative_hists(phases, (phases + 1) % period, sums,
+                                    hist, period)
+
+  found = np.flatnonzero(valid[checks] &
+                         (_scores(hists[:len(checks)]) > thres))
+  if len(found):
+    j = found[0]
+    return checks[j], int(np.argmax(hists[j])), hists[j]
+  return -1, -1, hists[-1]
+
+
+def integrate_bits(corr, bit_phase_ref, phase=0, acc=0.,
+                   period=BIT_PERIOD_MS):
+  """
+  Integrate the correlations over the bits.
+
+  Parameters
+  ----------
+  corr : array_like
+    Prompt correlations, one per ms.
+  bit_phase_ref : int
+    Bit phase at which the bits end.
+  phase : int, optional
+    Bit phase before the first correlation.
+  acc : float, optional
+    Integral of the current bit before the first correlation.
+  period : int, optional
+    Bit length [ms].
+
+  Returns
+  -------
+  out : tuple
+    The indices of the last correlation of each bit, the bit integrals, and
+    the integral of the bit after the last one.
+
+  """
+  corr = np.asarray(corr, dtype=np.float64)
+  ends = np.flatnonzero(_phases(len(corr), phase, period) == bit_phase_ref)
+  integral = acc + np.cumsum(corr)
+  sums = np.diff(np.concatenate(([0.], integral[ends])))
+  if len(ends):
+    acc = integral[-1] - integral[ends[-1]]
+  elif len(corr):
+    acc = integral[-1]
+  return ends, sums, acc
+
+
+def decode_bits(corr, sync=match_bit, period=BIT_PERIOD_MS, **kwargs):
+  """
+  Find the bit edges and integrate the bits following them.
+
+  Parameters
+  ----------
+  corr : array_like
+    Prompt correlations, one per ms, from the start of tracking.
+  sync : callable, optional
+    Bit edge search, :func:`match_bit`, :func:`histogram` or
+    :func:`match_edge`.
+  period : int, optional
+    Bit length [ms].
+  kwargs : dictionary
+    Other parameters of `sync`.
+
+  Returns
+  -------
+  out : tuple
+    The indices of the last correlation of each whole bit after the bit
+    edges are found, and the bits, 1 for positive integrals and 0 otherwise.
+
+  """
+  corr = np.asarray(corr, dtype=np.float64)
+  index, bit_phase_ref, _ = sync(corr, period=period, **kwargs)
+  if index < 0:
+    return np.zeros(0, dtype=int), np.zeros(0, dtype=np.uint8)
+  ends = np.flatnonzero(_phases(len(corr), 0, period) == bit_phase_ref)
+  ends = ends[(ends >= index) & (ends >= period - 1)]
+  sums = window_sums(corr, period)[ends]
+  return ends, (sums > 0).astype(np.uint8)
@@ -0,0 +1,574 @@
+# Copyright (C) 2016 Swift Navigation Inc.
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+The :mod:`peregrine.correlator` module contains numpy implementations of the
+tracking correlator, for one tracking channel or for many channels at once,
+and a correlator of 1-bit and 2-bit samples working on bit-packed replicas.
+
+"""
+
+import os
+import numpy as np
+from peregrine.gps_constants import L1CA, L2C, chip_rate
+from peregrine.include.generateCAcode import caCodes
+from peregrine.include.generateL2CMcode import L2CMCodes
+
+import logging
+logger = logging.getLogger(__name__)
+
+__all__ = ['track_correlate', 'track_correlate_multi', 'PackedCorrelator']
+
+GROUP_PADDING = 1.5
+"""Largest ratio of block lengths of channels correlated together by
+:func:`track_correlate_multi`, i.e. of padded to correlated samples."""
+
+PACKED_REPLICAS_FILE = "packed_replicas_%s_%.3fHz_%d_%d.npy"
+"""File name of the bit-packed code replicas of :class:`PackedCorrelator`,
+after the signal, sampling frequency, code length and number of fractional
+sample offsets."""
+
+PACKED_RESOLUTION = 128
+"""Code phase resolution of the bit-packed code replicas of
+:class:`PackedCorrelator` [1/chip]. The replicas are sampled at as many
+fractional sample offsets as needed for it."""
+
+PACKED_BLOCK = 1024
+"""Number of samples taken from the bit-packed code replicas at once by
+:class:`PackedCorrelator`. The code Doppler is accounted for between these
+blocks only."""
+
+# Code replicas built so far, see _replica.
+_replicas = {}
+
+# Number of bits set in every byte value.
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# Multiplier of 8 bytes of 0 or 1 gathering them as bits, see _packbits.
+_PACK = np.uint64(0x8040201008040201)
+
+
+def track_correlate(samples, chips_to_correlate, code_freq, code_phase,
+                    carr_freq, carr_phase, code, sampling_freq, signal,
+                    n_epochs=None):
+  """
+  Correlate samples with the early, prompt and late code replicas.
+
+  Drop-in replacement of :func:`swiftnav.correlate.track_correlate`, for a
+  single tracking channel.
+
+  Parameters
+  ----------
+  samples : :class:`numpy.ndarray`
+    Samples, starting at the first one to correlate.
+  chips_to_correlate : int
+    Number of code chips to correlate over.
+  code_freq : float
+    Code chipping rate [chips/s].
+  code_phase : float
+    Code phase of the first sample [chips].
+  carr_freq : float
+    Carrier frequency [Hz].
+  carr_phase : float
+    Carrier phase of the first sample [rad].
+  code : :class:`numpy.ndarray`
+    PRN code, one element per chip with value +/- 1. For L2C the CM code,
+    which is time multiplexed chip by chip with the (zero) CL code.
+  sampling_freq : float
+    Sampling frequency [Hz].
+  signal : string
+    Signal type.
+  n_epochs : int, optional
+    Number of consecutive integrations of `chips_to_correlate` chips to do
+    at the same code and carrier frequencies. By default one integration is
+    done and scalars are returned.
+
+  Returns
+  -------
+  out : (complex, complex, complex, int, float, float)
+    | The tuple
+    |   `(E, P, L, blksize, code_phase, carr_phase)`
+    | Of the early, prompt and late correlations, the number of samples
+      correlated and the code [chips] and carrier [rad] phases of the next
+      sample. With `n_epochs`, `E`, `P`, `L` and `blksize` are arrays with one
+      element per integration and the phases are the ones after the last
+      integration.
+
+  """
+  request = (samples, chips_to_correlate, code_freq, code_phase, carr_freq,
+             carr_phase, code, sampling_freq, signal)
+  if n_epochs is not None:
+    request += (n_epochs,)
+  return track_correlate_multi([request])[0]
+
+
+def track_correlate_multi(requests):
+  """
+  Correlate the samples of many tracking channels at once.
+
+  Every channel has its own samples, block length, frequencies, phases and
+  code. Channels with blocks of similar lengths (e.g. all the 1 ms L1C/A
+  blocks) are grouped, and the blocks of each group are zero padded to the
+  longest one and correlated with a few numpy operations on the stacked
+  blocks, instead of one call per channel.
+
+  Parameters
+  ----------
+  requests : list
+    One tuple of :func:`track_correlate` arguments per channel, optionally
+    including `n_epochs`.
+
+  Returns
+  -------
+  out : list
+    One tuple of :func:`track_correlate` results per channel.
+
+  """
+  blksizes = [np.ceil((r[1] * _epochs(r) - r[3]) * r[7] / r[2])
+              for r in requests]
+  order = np.argsort(blksizes)
+  results = [None] * len(requests)
+  first = 0
+  for last in range(1, len(order) + 1):
+    if last == len(order) or \
+       blksizes[order[last]] > GROUP_PADDING * blksizes[order[first]]:
+      group = order[first:last]
+      group_results = _correlate_group([requests[i] for i in group])
+      for i, result in zip(group, group_results):
+        if len(requests[i]) > 9:
+          results[i] = result
+        else:
+          results[i] = tuple(x[0] for x in result[:4]) + result[4:]
+      first = last
+  return results
+
+
+def _epochs(request):
+  """
+  Number of integrations of a :func:`track_correlate_multi` request.
+
+  """
+  return request[9] if len(request) > 9 else 1
+
+
+def _correlate_group(requests):
+  """
+  Correlate the samples of many tracking channels, with the blocks stacked
+  in one array.
+
+  """
+  n_epochs = np.array([_epochs(r) for r in requests])
+  samples, chips, code_freq, code_phase, carr_freq, carr_phase, codes, \
+      sampling_freq, signals = zip(*[r[:9] for r in requests])
+  chips = np.array(chips, dtype=np.float64)
+  code_phase = np.array(code_phase, dtype=np.float64)
+  carr_phase = np.array(carr_phase, dtype=np.float64)
+  sampling_freq = np.array(sampling_freq, dtype=np.float64)
+  code_step = np.array(code_freq, dtype=np.float64) / sampling_freq
+  carr_step = 2 * np.pi * np.array(carr_freq, dtype=np.float64) / sampling_freq
+
+  # Block sizes of the integrations, computed the same way as for
+  # consecutive single integrations.
+  n = len(requests)
+  blksize = np.zeros((n, n_epochs.max()), dtype=int)
+  available = np.array([len(s) for s in samples])
+  next_code_phase = code_phase
+  for k in range(blksize.shape[1]):
+    size = np.ceil((chips - next_code_phase) / code_step).astype(int)
+    size = np.minimum(size, available)
+    size[k >= n_epochs] = 0
+    available -= size
+    blksize[:, k] = size
+    next_code_phase = np.where(k < n_epochs,
+                               next_code_phase + size * code_step - chips,
+                               next_code_phase)
+  total = blksize.sum(axis=1)
+  width = total.max()
+
+  dtype = np.result_type(np.float64, *[s.dtype for s in samples])
+  block = np.zeros((len(requests), width), dtype=dtype)
+  for i, s in enumerate(samples):
+    block[i, :total[i]] = s[:total[i]]
+
+  # All the replicas in one table.
+  replicas = [_replica(code, signal) for code, signal in zip(codes, signals)]
+  lengths = np.array([len(r) - 2 for r in replicas])[:, np.newaxis]
+  starts = np.cumsum([0] + [len(r) for r in replicas[:-1]])[:, np.newaxis]
+  table = np.concatenate(replicas)
+
+  # Index of the half chip of every sample in the table. The code phase
+  # goes back by the integrated chips at the start of every integration.
+  t = np.arange(width)
+  index = 2 * (code_phase[:, np.newaxis] + code_step[:, np.newaxis] * t)
+  epoch_starts = np.cumsum(blksize, axis=1) - blksize
+  if blksize.shape[1] > 1:
+    rewind = np.zeros((n, width + 1))
+    np.add.at(rewind, (np.arange(n)[:, np.newaxis], epoch_starts[:, 1:]),
+              2 * chips[:, np.newaxis])
+    index -= np.cumsum(rewind, axis=1)[:, :width]
+  index = np.floor(index).astype(int)
+  index %= lengths
+  index += starts + 1
+
+  carrier = _phasors(carr_phase, carr_step, width)
+  baseband_re = block * carrier.real
+  baseband_im = block * carrier.imag
+
+  if blksize.shape[1] == 1:
+    def integrate(x):
+      return np.einsum('ij,ij->i', *x)[:, np.newaxis]
+  else:
+    # Sums over the integrations, zero for the empty ones. The empty ones
+    # may start right after the last sample, hence the extra zero.
+    flat_starts = (epoch_starts + width * np.arange(n)[:, np.newaxis]).ravel()
+    empty = blksize == 0
+
+    def integrate(x):
+      sums = np.add.reduceat(np.append(np.multiply(*x), 0), flat_starts)
+      sums = sums.reshape(blksize.shape)
+      sums[empty] = 0
+      return sums
+
+  def correlate(replica):
+    return integrate((baseband_re, replica)) + \
+        1j * integrate((baseband_im, replica))
+
+  E = correlate(table[index + 1])
+  P = correlate(table[index])
+  L = correlate(table[index - 1])
+
+  next_carr_phase = np.fmod(carr_phase + total * carr_step, 2 * np.pi)
+  return [(E[i, :k], P[i, :k], L[i, :k], blksize[i, :k],
+           next_code_phase[i], next_carr_phase[i])
+          for i, k in enumerate(n_epochs)]
+
+
+def _replica(code, signal):
+  """
+  Get the replica of a code used by the correlator.
+
+  The replica has one element per half chip, with the last and first half
+  chips repeated around it, so that the early and late replicas are the
+  prompt one shifted by one element. Replicas are built once per process and
+  shared by all the channels tracking the same code array, e.g. a row of
+  :data:`caCodes`.
+
+  """
+  key = _code_key(code, signal)
+  if key not in _replicas:
+    half_chips = np.repeat(_chips(code, signal), 2)
+    replica = np.concatenate((half_chips[-1:], half_chips,
+                              half_chips[:1])).astype(np.float64)
+    # The code is kept so that its memory cannot be reused by another code.
+    _replicas[key] = (code, replica)
+  return _replicas[key][1]
+
+
+def _code_key(code, signal):
+  """
+  Key of a code array in the replica caches: the signal and the memory
+  address, type, strides and length of the array, so that the codes need not
+  be compared.
+
+  """
+  return (signal, code.ctypes.data, code.dtype.str, code.strides, len(code))
+
+
+def _chips(code, signal):
+  """
+  Get the chips of a code as correlated. The CL code of L2C is zero, every
+  other chip.
+
+  """
+  if signal == L2C:
+    return np.column_stack((code, np.zeros_like(code))).ravel()
+  return code
+
+
+def _phasors(phase, step, width):
+  """
+  Compute ``exp(-1j * (phase + step * t))`` for `t` in ``range(width)``, one
+  row per element of `phase` and `step`.
+
+  The angles are split into coarse and fine steps, so that only about
+  ``2 * sqrt(width)`` complex exponentials per row are computed and every
+  phasor is the product of two of them.
+
+  """
+  k = max(int(np.ceil(np.sqrt(width))), 1)
+  fine = np.exp(-1j * step[:, np.newaxis] * np.arange(k))
+  coarse = np.exp(-1j * (phase[:, np.newaxis] +
+                         step[:, np.newaxis] * k * np.arange(-(-width // k))))
+  phasors = coarse[:, :, np.newaxis] * fine[:, np.newaxis, :]
+  return phasors.reshape(len(phase), -1)[:, :width]
+
+
+class PackedCorrelator(object):
+  """
+  Tracking correlator of 1-bit and 2-bit samples by XOR and popcount.
+
+  Drop-in replacement of :func:`track_correlate` for a single tracking
+  channel. The samples are packed to a sign bit and a magnitude bit each, and
+  the carrier is wiped off with 1-bit in-phase and quadrature replicas. The
+  code replicas are sampled at the sampling frequency and bit-packed once per
+  signal and sampling frequency, at fractional sample offsets of at most
+  1/:data:`PACKED_RESOLUTION` chip. Every correlation is then a few XORs of
+  packed bytes, whose set bits are counted with a 256 entry lookup table.
+
+  The results are those of samples of values +/-1 and +/-3 (larger values
+  count as 3), correlated with a carrier quantized to its sign. That costs
+  about 1 dB of SNR compared to :func:`track_correlate`. The code phase of
+  the replicas is rounded to the nearest offset, and only updated for the
+  code Doppler every :data:`PACKED_BLOCK` samples.
+
+  Parameters
+  ----------
+  cache_dir : string or `None`, optional
+    Directory where the packed replicas of the whole code family are saved,
+    to be memory-mapped by the next runs. Without a directory they are only
+    cached in memory.
+
+  """
+
+  def __init__(self, cache_dir=None):
+    self.cache_dir = cache_dir
+    # Packed replicas, per signal and sampling frequency, and per code array.
+    self.families = {}
+    self.codes = {}
+
+  def __getstate__(self):
+    # The replicas are loaded again by the unpickled correlator.
+    return {'cache_dir': self.cache_dir}
+
+  def __setstate__(self, state):
+    self.__init__(**state)
+
+  def __call__(self, samples, chips_to_correlate, code_freq, code_phase,
+               carr_freq, carr_phase, code, sampling_freq, signal):
+    """
+    Correlate samples with the early, prompt and late code replicas.
+
+    Same parameters and results as :func:`track_correlate` without
+    `n_epochs`.
+
+    """
+    code_step = code_freq / sampling_freq
+    carr_step = 2 * np.pi * carr_freq / sampling_freq
+    blksize = int(np.ceil((chips_to_correlate - code_phase) / code_step))
+    blksize = min(blksize, len(samples))
+    n_blocks = -(-blksize // PACKED_BLOCK)
+
+    # Packed signs and magnitudes of the samples, signs of the carrier cosine
+    # and sine and valid samples, zero past the block. The carrier phase is
+    # computed in fixed point, 2**32 per cycle, so that its sign bits are the
+    # top bits.
+    block = samples[:blksize]
+    bits = np.zeros((5, n_blocks * PACKED_BLOCK), dtype=np.uint8)
+    bits[0, :blksize] = block < 0
+    bits[1, :blksize] = np.abs(block) > 1
+    phase = np.arange(blksize, dtype=np.uint32)
+    phase *= np.uint32(int(round(carr_step / (2 * np.pi) * 2 ** 32)) % 2 ** 32)
+    phase += np.uint32(int(round(carr_phase / (2 * np.pi) * 2 ** 32)) % 2 ** 32)
+    bits[3, :blksize] = phase >> 31
+    phase += np.uint32(2 ** 30)
+    bits[2, :blksize] = phase >> 31
+    bits[4, :blksize] = 1
+    sign, magnitude, cos_sign, sin_sign, valid = _packbits(bits)
+    carrier = np.array([cos_sign, sin_sign])
+
+    # Positions of the blocks of the early, prompt and late replicas in the
+    # packed replicas [fractional samples].
+    replicas, weights = self.replicas(code, signal, sampling_freq)
+    code_length = len(code) * (2 if signal == L2C else 1)
+    starts = code_phase + code_step * PACKED_BLOCK * np.arange(n_blocks)
+    position = np.mod(starts + np.array([[0.5], [0], [-0.5]]), code_length)
+    position *= sampling_freq * replicas.shape[-2] / chip_rate
+    position = np.round(position).astype(np.int64).ravel()
+
+    # The products of the samples, code and carrier are negative where the
+    # sign bits differ, and count three times where the samples do.
+    shape = (3, 1, -1)
+    used = valid
+    if weights is not None:
+      used = used & _take_bits(weights, position).reshape(shape)
+    x = (sign ^ _take_bits(replicas, position).reshape(shape) ^ carrier) & used
+    n_used = _POPCOUNT[used].sum(axis=-1, dtype=np.int64)
+    n_neg = _POPCOUNT[x].sum(axis=-1, dtype=np.int64)
+    if magnitude.any():
+      n_used += 2 * _POPCOUNT[used & magnitude].sum(axis=-1, dtype=np.int64)
+      n_neg += 2 * _POPCOUNT[x & magnitude].sum(axis=-1, dtype=np.int64)
+    sums = n_used - 2 * n_neg
+    E, P, L = sums[:, 0] - 1j * sums[:, 1]
+
+    next_code_phase = code_phase + blksize * code_step - chips_to_correlate
+    next_carr_phase = np.fmod(carr_phase + blksize * carr_step, 2 * np.pi)
+    return (E, P, L, blksize, next_code_phase, next_carr_phase)
+
+  def replicas(self, code, signal, sampling_freq):
+    """
+    Get the packed replicas of a code.
+
+    Returns
+    -------
+    out : (:class:`numpy.ndarray`, :class:`numpy.ndarray` or `None`)
+      The packed sign bits of the code, one row per fractional sample offset,
+      and for L2C the packed bits of the CM chips (the CL chips are zero).
+
+    """
+    key = _code_key(code, signal) + (sampling_freq,)
+    if key not in self.codes:
+      table = caCodes if signal == L1CA else L2CMCodes
+      rows = []
+      if len(code) == table.shape[1]:
+        rows = np.flatnonzero(np.all(table == code, axis=1))
+      if len(rows):
+        family, weights = self.family_replicas(signal, sampling_freq)
+        replicas = family[rows[0]]
+      else:
+        # Not one of the codes of the signal, e.g. in tests.
+        chips = _chips(code, signal)
+        replicas = _sample_bits(chips < 0, sampling_freq)
+        weights = None
+        if signal == L2C:
+          weights = _sample_bits(chips != 0, sampling_freq)
+      # The code is kept so that its memory cannot be reused by another code.
+      self.codes[key] = (code, replicas, weights)
+    return self.codes[key][1:]
+
+  def family_replicas(self, signal, sampling_freq):
+    """
+    Get the packed replicas of all the codes of a signal.
+
+    They are saved to a file named after the signal, sampling frequency,
+    code length and number of offsets in `cache_dir`, and memory-mapped when
+    needed again.
+
+    Returns
+    -------
+    out : (:class:`numpy.ndarray`, :class:`numpy.ndarray` or `None`)
+      The packed sign bits of the codes, indexed by PRN (0-indexed) and
+      fractional sample offset, and for L2C the packed bits of the CM chips.
+
+    """
+    key = (signal, sampling_freq)
+    if key in self.families:
+      return self.families[key]
+
+    if signal == L1CA:
+      table = caCodes
+    elif signal == L2C:
+      table = L2CMCodes
+    else:
+      raise ValueError("Unsupported signal '%s'." % signal)
+    chips = _chips(table[0], signal)
+    weights = None
+    if signal == L2C:
+      weights = _sample_bits(chips != 0, sampling_freq)
+    shape = (len(table), _offsets(sampling_freq),
+             _packed_bits(len(chips), sampling_freq) // 8)
+
+    replicas = None
+    filename = None
+    if self.cache_dir is not None:
+      filename = os.path.join(self.cache_dir,
+                              PACKED_REPLICAS_FILE % (signal, sampling_freq,
+                                                      table.shape[1],
+                                                      shape[1]))
+      try:
+        replicas = np.load(filename, mmap_mode='r')
+        if replicas.shape != shape or replicas.dtype != np.uint8:
+          replicas = None
+      except (IOError, ValueError):
+        replicas = None
+
+    if replicas is None:
+      replicas = np.array([_sample_bits(_chips(code, signal) < 0,
+                                        sampling_freq) for code in table])
+      if filename is not None:
+        # Write under a temporary name first so that concurrent runs never
+        # see a partially written file.
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+          with open(tmp_filename, 'wb') as f:
+            np.save(f, replicas)
+          os.rename(tmp_filename, filename)
+          replicas = np.load(filename, mmap_mode='r')
+        except (IOError, OSError):
+          logger.warning("Couldn't save packed replicas file '%s'.", filename)
+
+    self.families[key] = (replicas, weights)
+    return self.families[key]
+
+
+def _sample_bits(bits, sampling_freq):
+  """
+  Sample per chip bits at the sampling frequency and the nominal chip rate,
+  and pack them.
+
+  Row `k` of the `n` rows starts `k / n` samples into the code, and is one
+  code period plus :data:`PACKED_BLOCK` samples long, with one more byte so
+  that :func:`_take_bits` can take the blocks at any bit.
+
+  """
+  n = _offsets(sampling_freq)
+  t = np.arange(_packed_bits(len(bits), sampling_freq)) + \
+      np.arange(n)[:, np.newaxis] / float(n)
+  chips = np.floor(t * (chip_rate / sampling_freq)).astype(np.int64)
+  return np.packbits(bits[chips % len(bits)], axis=1)
+
+
+def _offsets(sampling_freq):
+  """
+  Number of fractional sample offsets of the rows of :func:`_sample_bits`.
+
+  """
+  return int(np.ceil(PACKED_RESOLUTION * chip_rate / sampling_freq))
+
+
+def _packed_bits(n_chips, sampling_freq):
+  """
+  Number of bits of the rows of :func:`_sample_bits`, a whole number of
+  bytes.
+
+  """
+  n_bits = int(np.ceil(n_chips * sampling_freq / chip_rate)) + PACKED_BLOCK
+  return n_bits + -n_bits % 8 + 8
+
+
+def _packbits(bits):
+  """
+  Same as ``np.packbits(bits, axis=-1)`` for bytes of value 0 or 1 in rows
+  of a multiple of 8 bytes, only faster: each 8 bytes are gathered in the top
+  byte of their product with :data:`_PACK`.
+
+  """
+  words = np.ascontiguousarray(bits).view(np.uint64)
+  return ((words * _PACK) >> np.uint64(56)).astype(np.uint8)
+
+
+def _take_bits(table, position):
+  """
+  Take :data:`PACKED_BLOCK` bits of the packed replicas `table` at each of
+  the `position`s [fractional sample offsets], shifted to start on a byte.
+
+  """
+  offset = position % table.shape[-2]
+  start = position // table.shape[-2]
+  shift = (start % 8).astype(np.uint8)[:, np.newaxis]
+  index = (start // 8)[:, np.newaxis] + np.arange(PACKED_BLOCK // 8 + 1)
+  packed = table[offset[:, np.newaxis], index]
+  return ((packed[:, :-1] << shift) | (packed[:, 1:] >> (8 - shift))).ravel()
+
+
+# Tells the tracking channels that the correlator takes a list of requests,
+# so that :class:`peregrine.tracking.Tracker` runs them in lockstep, and that
+# the correlators take a number of integrations to do at once.
+track_correlate_multi.multi_channel = True
+track_correlate_multi.multi_epoch = True
+track_correlate.multi_epoch = True
@@ -266,5 +266,9 @@ l2c_lock_detect_params_20ms = {
 
 alias_detect_interval_ms = 500
 
+# How long the optimistic lock of a channel must stay lost before the
+# channel is considered lost, e.g. to be re-acquired [ms]
+lost_lock_timeout_ms = 500
+
 # Default pipelining prediction coefficient
 pipelining_k = .9549
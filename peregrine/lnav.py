@@ -0,0 +1,220 @@
+# Copyright (C) 2016 Swift Navigation Inc.
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+The :mod:`peregrine.lnav` module decodes the GPS L1C/A navigation message
+(LNAV) of a tracking channel at once from its stored prompt correlations.
+
+The data bits are synchronized and integrated over the whole channel, the
+subframes are found by correlating the bits with the TLM preamble, and the
+parity of all their words is checked together.
+
+"""
+
+import numpy as np
+
+from peregrine import bit_sync
+
+PREAMBLE = np.array([1, 0, 0, 0, 1, 0, 1, 1], dtype=np.uint8)
+"""TLM word preamble."""
+
+SUBFRAME_BITS = 300
+"""Number of bits of a subframe."""
+
+WORD_BITS = 30
+"""Number of bits of a word, with 24 data and 6 parity bits."""
+
+WEEK_MS = 7 * 24 * 3600 * 1000
+"""Length of a GPS week [ms]."""
+
+_PARITY_MASKS = [0b10111011000111110011010010000000,
+                 0b01011101100011111001101001000000,
+                 0b10101110110001111100110100000000,
+                 0b01010111011000111110011010000000,
+                 0b01101011101100011111001101000000,
+                 0b10001011011110101000100111000000]
+"""Parity bits D25 to D30 of a word, as masks of the last two parity bits
+of the previous word (D29* and D30*) followed by the 24 data bits."""
+
+_PARITY_MATRIX = np.unpackbits(
+    np.array(_PARITY_MASKS, dtype='>u4').view(np.uint8)).reshape(6, 32)
+
+SUBFRAME_DTYPE = [('bit', np.int64),
+                  ('record', np.int64),
+                  ('subframe_id', np.uint8),
+                  ('tow', np.int64),
+                  ('words', np.uint32, 10)]
+"""Decoded subframe: index of its first bit, index of the tracking result
+ending it, subframe ID, time of week at its end [ms] and its ten words of 24
+data bits."""
+
+
+def integrate_bits(P, coherent_ms, bit_phase_ref=None):
+  """
+  Integrate the prompt correlations of a tracking channel over the data bits.
+
+  Parameters
+  ----------
+  P : array_like
+    Prompt correlations of the tracking results, from the start of tracking.
+  coherent_ms : array_like
+    Integration time of each correlation [ms]. Longer integrations must not
+    span bit edges, as with the tracking loops after bit sync.
+  bit_phase_ref : int, optional
+    Bit phase at which the bits end, see
+    :class:`peregrine.tracking.NavBitSync`. By default the bit edges are
+    searched in the leading 1 ms correlations with
+    :func:`peregrine.bit_sync.match_bit`.
+
+  Returns
+  -------
+  out : tuple
+    The integrated bits, with zeros for the bits not covered by the
+    correlations, and the index of the correlation ending each bit. Both are
+    empty if the bit edges are not found.
+
+  """
+  P = np.real(np.asarray(P))
+  coherent_ms = np.asarray(coherent_ms, dtype=np.int64)
+  if bit_phase_ref is None:
+    stage1 = np.argmax(np.append(coherent_ms, 0) != 1)
+    index, bit_phase_ref, _ = bit_sync.match_bit(P[:stage1])
+    if index < 0:
+      return np.zeros(0), np.zeros(0, dtype=np.int64)
+
+  # Bit of the last ms of each correlation
+  last_ms = np.cumsum(coherent_ms) - 1
+  bits = (last_ms - bit_phase_ref + bit_sync.BIT_PERIOD_MS) // \
+      bit_sync.BIT_PERIOD_MS
+  sums = np.bincount(bits, weights=P)
+  ms = np.bincount(bits, weights=coherent_ms)
+  sums[ms != bit_sync.BIT_PERIOD_MS] = 0.
+  ends = np.searchsorted(bits, np.arange(len(sums)), 'right') - 1
+  return sums, ends
+
+
+def find_subframes(bits):
+  """
+  Find the subframes passing the parity check in the integrated bits.
+
+  When some subframes follow each other, only the subframes aligned with
+  them are kept.
+
+  Parameters
+  ----------
+  bits : array_like
+    Integrated data bits, zero when unknown.
+
+  Returns
+  -------
+  out : tuple
+    The indices of the first bit of the subframes, and their words of 24 data
+    bits.
+
+  """
+  signs = np.sign(np.asarray(bits))
+  n = len(signs)
+  match = np.correlate(signs, PREAMBLE * 2. - 1, 'valid')
+  starts = np.flatnonzero(np.abs(match) == len(PREAMBLE))
+  # The parity of the first word depends on the two bits before it
+  starts = starts[(starts >= 2) & (starts + SUBFRAME_BITS <= n)]
+  if len(starts) == 0:
+    return starts, np.zeros((0, 10), dtype=np.uint32)
+
+  window = signs[starts[:, np.newaxis] + np.arange(-2, SUBFRAME_BITS)]
+  known = np.all(window != 0, axis=1)
+  raw = (window * np.sign(match[starts])[:, np.newaxis] > 0).astype(np.int64)
+  # Each word with the last two bits of the previous one
+  words = raw[:, np.arange(10)[:, np.newaxis] * WORD_BITS + np.arange(32)]
+  data = words[:, :, 2:26] ^ words[:, :, 1:2]
+  parity = np.dot(np.concatenate((words[:, :, :2], data), axis=2),
+                  _PARITY_MATRIX[:, :26].T) % 2
+  valid = known & np.all(np.all(parity == words[:, :, 26:], axis=2), axis=1)
+  starts = starts[valid]
+  values = np.dot(data[valid], 1 << np.arange(23, -1, -1)).astype(np.uint32)
+
+  # A preamble in another word passes the parity check too, as the words are
+  # genuine. Subframes follow each other, so the valid subframe starts are
+  # the ones of the subframes next to another one.
+  subframe_id = (values[:, 1] >> 2) & 7
+  valid = (subframe_id >= 1) & (subframe_id <= 5)
+  starts, values = starts[valid], values[valid]
+  linked = np.in1d(starts, starts + SUBFRAME_BITS) | \
+      np.in1d(starts, starts - SUBFRAME_BITS)
+  if linked.any():
+    aligned = np.in1d(starts % SUBFRAME_BITS,
+                      starts[linked] % SUBFRAME_BITS)
+    starts, values = starts[aligned], values[aligned]
+  return starts, values
+
+
+def decode_lnav(P, coherent_ms, bit_phase_ref=None):
+  """
+  Decode the LNAV subframes of a tracking channel.
+
+  Parameters
+  ----------
+  P : array_like
+    Prompt correlations of the tracking results, from the start of tracking.
+  coherent_ms : array_like
+    Integration time of each correlation [ms].
+  bit_phase_ref : int, optional
+    Bit phase at which the bits end, see :func:`integrate_bits`.
+
+  Returns
+  -------
+  out : :class:`numpy.ndarray`
+    The subframes passing the parity check, with `SUBFRAME_DTYPE` records.
+    Their time of week, from the TOW count of their handover word, anchors
+    the time of week of the tracking results: the one of result `record`
+    is `tow`.
+
+  """
+  bits, ends = integrate_bits(P, coherent_ms, bit_phase_ref)
+  starts, words = find_subframes(bits)
+  subframes = np.zeros(len(starts), dtype=SUBFRAME_DTYPE)
+  subframes['bit'] = starts
+  subframes['record'] = ends[starts + SUBFRAME_BITS - 1]
+  subframes['words'] = words
+  if len(starts):
+    subframes['subframe_id'] = (words[:, 1] >> 2) & 7
+    # The TOW count is the time of week of the next subframe in 6 s units
+    subframes['tow'] = (words[:, 1] >> 7).astype(np.int64) * 6000 % WEEK_MS
+  return subframes
+
+
+def find_ephemeris(subframes):
+  """
+  Find the first complete ephemeris in the decoded subframes.
+
+  Parameters
+  ----------
+  subframes : :class:`numpy.ndarray`
+    Subframes, see :func:`decode_lnav`.
+
+  Returns
+  -------
+  out : int
+    Index of subframe 3 of the first consecutive subframes 1, 2 and 3 with
+    the same issue of data, -1 if there are none.
+
+  """
+  if len(subframes) < 3:
+    return -1
+  bit = subframes['bit']
+  sid = subframes['subframe_id']
+  words = subframes['words']
+  # IODC LSBs in subframe 1, IODE in subframes 2 and 3
+  iodc = words[:-2, 7] >> 16
+  complete = (sid[:-2] == 1) & (sid[1:-1] == 2) & (sid[2:] == 3) & \
+      (bit[1:-1] - bit[:-2] == SUBFRAME_BITS) & \
+      (bit[2:] - bit[1:-1] == SUBFRAME_BITS) & \
+      (iodc == words[1:-1, 2] >> 16) & (iodc == words[2:, 9] >> 16)
+  found = np.flatnonzero(complete)
+  return found[0] + 2 if len(found) else -1
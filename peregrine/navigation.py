@@ -16,8 +16,13 @@ import swiftnav.track
 import swiftnav.signal
 import logging
 from math import isnan
+import peregrine.gps_constants as gps
 from peregrine.gps_constants import L1CA
 from peregrine.gps_constants import L2C
+from peregrine.lnav import decode_lnav
+from peregrine.lnav import find_ephemeris
+from peregrine.pvt import solve_pvt
+from peregrine.tracking_file_utils import searchTrackingResults
 
 logger = logging.getLogger(__name__)
 
@@ -30,14 +35,33 @@ def extract_ephemerides(combinedResultObject):
     isL1CA = band == L1CA
     isL2C = band == L2C
     if isL1CA:
+      records = combinedResultObject.channelRecords(n)
+      if records is None:
+        continue
+      # The subframes of the whole channel are decoded at once to find the
+      # first complete ephemeris; the navigation message decoder only replays
+      # the results up to it.
+      subframes = decode_lnav(records['P'], records['coherent_ms'])
+      last = find_ephemeris(subframes)
+      prompt = np.asarray(records['P'])
       nav_msg = swiftnav.nav_msg.NavMsg()
-      tow_index = None
-      for i, x in enumerate(combinedResultObject.channelResult(n)):
-        tr, idx = x
-        tow = nav_msg.update(tr.P[idx])
-        if tow is not None:
-          # print tr.prn, tow
-          tow_index = (i, tow)
+      if last < 0:
+        # Without a bulk decoded ephemeris the decoder replays the whole
+        # channel, as it may still find one.
+        logger.info("No ephemeris decoded in bulk for PRN=%d band=%s" %
+                    (prn, band))
+        tow_index = None
+        for i, P in enumerate(prompt):
+          tow = nav_msg.update(P)
+          if tow is not None:
+            tow_index = (i, tow)
+      else:
+        tow_index = (subframes['record'][-1], subframes['tow'][-1])
+        for P in prompt[:subframes['record'][last] + 1]:
+          nav_msg.update(P)
+        if not nav_msg.eph_valid:
+          for P in prompt[subframes['record'][last] + 1:]:
+            nav_msg.update(P)
       if nav_msg.eph_valid:
         ephems[prn] = (nav_msg, tow_index)
     elif isL2C:
@@ -74,34 +98,34 @@ def make_chan_meas(combinedResultObject, mss, ephems, samplingFreq):
     prn = entry['prn']
     if band != L1CA:
       continue
-    ms_idx = 0
-    ms = mss[ms_idx]
-    for tr, idx in combinedResultObject.channelResult(n):
-      ms_tracked = tr.ms_tracked[idx]
-      if ms_tracked < ms:
-        continue
-      tow = tr.tow[idx]
+    records = combinedResultObject.channelRecords(n)
+    if records is None:
+      continue
+    # Each requested time takes the first result at or after it that is not
+    # taken by an earlier time.
+    steps = np.arange(len(mss))
+    indices = searchTrackingResults(records, 'ms_tracked', mss) - steps
+    indices = np.maximum.accumulate(indices) + steps
+    valid = np.flatnonzero(indices < len(records))
+    selected = records[indices[valid]]
+    for ms_idx, r in zip(valid, selected):
+      tow = r['tow']
       if not isnan(tow):
         # If ToW is known, make a measurement object.
         # The actual sample time is usually greater than the requested time.
-        # i, tow_e = ephems[tr.prn][1]
+        # i, tow_e = ephems[prn][1]
         cm = swiftnav.track.ChannelMeasurement(
             swiftnav.signal.GNSSSignal(sat=prn - 1, code=0),
-            tr.code_phase[idx],
-            tr.code_freq[idx],
+            r['code_phase'],
+            r['code_freq'],
             0,
-            tr.carr_freq[idx] - tr.IF,
+            r['carr_freq'] - r['IF'],
             tow,
-            ms_tracked,
+            r['ms_tracked'],
             41,  # SNR
             100  # Lock
         )
         result[ms_idx][1][prn - 1] = cm
-      ms_idx += 1
-      if ms_idx > len(mss):
-        break
-      else:
-        ms = mss[ms_idx]
   return result
 
 
@@ -153,6 +177,38 @@ def make_solns(nms):
   return map(swiftnav.pvt.calc_PVT, nms)
 
 
+def make_batch_solns(nms, **kwargs):
+  '''
+  Solve the navigation measurements of all epochs at once.
+
+  Parameters
+  ----------
+  nms : list
+    List of the navigation measurements of each epoch, see `make_nav_meas`.
+  kwargs : dictionary
+    Other parameters of :func:`peregrine.pvt.solve_pvt`.
+
+  Returns
+  -------
+  numpy.ndarray
+    The solutions, one :data:`peregrine.pvt.SOLUTION_DTYPE` record per
+    epoch.
+  '''
+  shape = (len(nms), max([len(ms) for ms in nms] + [0]))
+  pseudoranges = np.full(shape, np.nan)
+  pseudorange_rates = np.full(shape, np.nan)
+  sat_pos = np.full(shape + (3,), np.nan)
+  sat_vel = np.full(shape + (3,), np.nan)
+  for i, ms in enumerate(nms):
+    for j, nm in enumerate(ms):
+      pseudoranges[i, j] = nm.pseudorange
+      pseudorange_rates[i, j] = -nm.doppler * gps.c / gps.l1
+      sat_pos[i, j] = nm.sat_pos
+      sat_vel[i, j] = nm.sat_vel
+  return solve_pvt(pseudoranges, sat_pos, pseudorange_rates, sat_vel,
+                   **kwargs)
+
+
 def navigation(combinedResultObject,
                sampling_freq,
                ephems=None,
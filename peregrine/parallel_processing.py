@@ -3,6 +3,8 @@
 
 import progressbar as pb
 import multiprocessing as mp
+import numpy as np
+import mmap
 import time
 import sys
 import traceback
@@ -84,3 +86,162 @@ def parmap(f, X, nprocs=mp.cpu_count(), show_progress=True, func_progress=False)
   [p.join() for p in proc]
 
   return [x for i, x in sorted(res)]
+
+
+def shared_array(shape, dtype=np.float64):
+  """
+  Allocate a zeroed numpy array backed by anonymous shared memory.
+
+  Processes forked after the allocation share the buffer with the parent, so
+  writes made by either side are seen by all of them without any copying.
+
+  """
+  dtype = np.dtype(dtype)
+  count = int(np.prod(shape))
+  buf = mmap.mmap(-1, max(count * dtype.itemsize, 1))
+  return np.frombuffer(buf, dtype=dtype, count=count).reshape(shape)
+
+
+class WorkerPool(object):
+  """
+  Persistent pool of forked worker processes all running the same function.
+
+  Unlike `parmap`, the workers are started once and serve every subsequent
+  call to `map`, so any state they build up (e.g. FFTW plans) is kept between
+  calls. Only the arguments and results pass through the queues; the function
+  and everything it refers to are inherited when the workers are forked.
+
+  """
+
+  def __init__(self, f, nprocs=mp.cpu_count()):
+    self.q_in = mp.Queue()
+    self.q_out = mp.Queue()
+    self.procs = [mp.Process(target=spawn(f),
+                             args=(self.q_in, self.q_out, None))
+                  for _ in range(min(nprocs, mp.cpu_count()))]
+    for p in self.procs:
+      p.daemon = True
+      p.start()
+
+  def map(self, X, show_progress=False):
+    [self.q_in.put((i, x)) for i, x in enumerate(X)]
+
+    if show_progress:
+      pbar = pb.ProgressBar(
+          widgets=[pb.Percentage(), ' ', pb.ETA()], maxval=len(X)).start()
+
+    res = []
+    failed = False
+    while len(res) < len(X):
+      r = self.q_out.get()
+      if r is None:
+        failed = True
+        r = (None, None)
+      res.append(r)
+      if show_progress:
+        pbar.update(len(res))
+
+    if show_progress:
+      pbar.finish()
+
+    if failed:
+      raise RuntimeError("Worker process raised an exception")
+    return [x for i, x in sorted(res)]
+
+  def close(self):
+    [self.q_in.put((None, None)) for _ in self.procs]
+    [p.join() for p in self.procs]
+    self.procs = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+def resident_worker(f):
+  def worker(q_in, q_out):
+    objects = {}
+    while True:
+      msg = q_in.get()
+      if msg is None:
+        break
+      op, arg = msg
+      if op == 'add':
+        key, obj = arg
+        objects[key] = obj
+      elif op == 'remove':
+        objects.pop(arg, None)
+      else:
+        try:
+          q_out.put(f(objects, *arg))
+        except:
+          print "Subprocess raised exception:"
+          exType, exValue, exTraceback = sys.exc_info()
+          traceback.print_exception(
+              exType, exValue, exTraceback, file=sys.stdout)
+          q_out.put(None)
+  return worker
+
+
+class ResidentPool(object):
+  """
+  Persistent pool of forked worker processes that each own a set of objects.
+
+  An object is pickled once, when it is handed to a worker with `add`, and
+  then stays in that worker. `call` runs `f(objects, *args)` in every worker
+  on the dictionary of the objects it owns, so only the arguments and the
+  results of `f`, which must not be `None`, pass through the queues. Like
+  with `WorkerPool`, `f` and everything it refers to (e.g. arrays from
+  `shared_array`) are inherited when the workers are forked.
+
+  """
+
+  def __init__(self, f, nprocs=mp.cpu_count()):
+    nprocs = max(1, min(nprocs, mp.cpu_count()))
+    self.q_ins = [mp.Queue() for _ in range(nprocs)]
+    self.q_out = mp.Queue()
+    self.procs = [mp.Process(target=resident_worker(f), args=(q_in, self.q_out))
+                  for q_in in self.q_ins]
+    for p in self.procs:
+      p.daemon = True
+      p.start()
+    # The worker owning every object, and the number of objects per worker.
+    self.owners = {}
+    self.loads = [0] * nprocs
+
+  def add(self, key, obj):
+    """Hand `obj` over to the least loaded worker."""
+    w = self.loads.index(min(self.loads))
+    self.q_ins[w].put(('add', (key, obj)))
+    self.owners[key] = w
+    self.loads[w] += 1
+
+  def remove(self, key):
+    """Drop the object `key` in its worker."""
+    w = self.owners.pop(key)
+    self.q_ins[w].put(('remove', key))
+    self.loads[w] -= 1
+
+  def keys(self):
+    return self.owners.keys()
+
+  def call(self, *args):
+    """Run `f` in all the workers, returning the list of their results."""
+    [q_in.put(('call', args)) for q_in in self.q_ins]
+    res = [self.q_out.get() for _ in self.q_ins]
+    if any(r is None for r in res):
+      raise RuntimeError("Worker process raised an exception")
+    return res
+
+  def close(self):
+    [q_in.put(None) for q_in in self.q_ins]
+    [p.join() for p in self.procs]
+    self.procs = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
@@ -0,0 +1,170 @@
+# Copyright (C) 2016 Swift Navigation Inc.
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+The :mod:`peregrine.pvt` module solves the receiver position, velocity and
+clock of many epochs at once.
+
+The measurements of all epochs are stacked in arrays with one row per epoch
+and one column per satellite, missing measurements being NaN. The
+Gauss-Newton iterations of the least-squares position solution run on all
+epochs together, with the normal equations of each epoch solved as a stack.
+
+"""
+
+import numpy as np
+
+from peregrine import gps_constants
+
+MIN_SATS = 4
+"""Number of satellites needed for a solution."""
+
+SOLUTION_DTYPE = [('pos_ecef', np.float64, 3),
+                  ('vel_ecef', np.float64, 3),
+                  ('clock_offset', np.float64),
+                  ('clock_drift', np.float64),
+                  ('n_used', np.int64),
+                  ('valid', np.bool_)]
+"""Solution of an epoch: receiver ECEF position [m] and velocity [m/s],
+clock offset [s] and drift [s/s], number of satellites used and validity.
+The other fields are NaN when the solution is not valid."""
+
+
+def _sagnac(sat_pos, tof):
+  """
+  Rotate the satellite positions or velocities into the ECEF frame at the
+  time of reception, the Earth having turned during the time of flight.
+
+  """
+  angle = gps_constants.omegae_dot * tof
+  rotated = np.empty_like(sat_pos)
+  rotated[..., 0] = sat_pos[..., 0] + angle * sat_pos[..., 1]
+  rotated[..., 1] = sat_pos[..., 1] - angle * sat_pos[..., 0]
+  rotated[..., 2] = sat_pos[..., 2]
+  return rotated
+
+
+def _geometry(x, sat_pos, pseudoranges):
+  """
+  Line of sight unit vectors and ranges from the receivers to the
+  satellites, for receiver positions and clock offsets `x`.
+
+  """
+  tof = (pseudoranges - x[:, 3:]) / gps_constants.c
+  los = _sagnac(sat_pos, tof) - x[:, np.newaxis, :3]
+  ranges = np.sqrt(np.sum(los ** 2, axis=2))
+  return los / ranges[:, :, np.newaxis], ranges, tof
+
+
+def _solve_normal(G, y, weights):
+  """
+  Weighted least-squares solution of `G x = y` of each epoch.
+
+  Epochs with singular normal equations get NaN solutions.
+
+  """
+  used = weights > 0
+  G = np.where(used[:, :, np.newaxis], G, 0.)
+  Gw = G * weights[:, :, np.newaxis]
+  A = np.einsum('nsi,nsj->nij', Gw, G)
+  b = np.einsum('nsi,ns->ni', Gw, np.where(used, y, 0.))
+  # The rank of the geometry is checked before solving the stack, as a
+  # singular epoch would fail the whole stack
+  s = np.linalg.svd(A, compute_uv=False)
+  singular = s[:, -1] <= s[:, 0] * A.shape[-1] * np.finfo(A.dtype).eps
+  A[singular] = np.eye(A.shape[-1])
+  x = np.linalg.solve(A, b[:, :, np.newaxis])[:, :, 0]
+  x[singular] = np.nan
+  return x
+
+
+def solve_pvt(pseudoranges, sat_pos, pseudorange_rates=None, sat_vel=None,
+              x0=None, max_iterations=10, tolerance=1e-4):
+  """
+  Solve the receiver position, velocity and clock of many epochs.
+
+  Parameters
+  ----------
+  pseudoranges : array_like
+    Pseudoranges [m], one row per epoch and one column per satellite, NaN
+    for missing measurements. The satellite clock errors must be corrected.
+  sat_pos : array_like
+    ECEF satellite positions at the time of transmission [m], of shape
+    `pseudoranges.shape + (3,)`.
+  pseudorange_rates : array_like, optional
+    Pseudorange rates [m/s], shaped like `pseudoranges`, NaN for missing
+    measurements. The velocity and clock drift are NaN if not given.
+  sat_vel : array_like, optional
+    ECEF satellite velocities [m/s], shaped like `sat_pos`.
+  x0 : array_like, optional
+    Initial receiver position [m] and clock offset [m], for all epochs or
+    one row per epoch. The center of the Earth by default.
+  max_iterations : int, optional
+    Maximum number of Gauss-Newton iterations.
+  tolerance : float, optional
+    The iterations stop when the corrections of all epochs are smaller
+    [m].
+
+  Returns
+  -------
+  out : :class:`numpy.ndarray`
+    The solutions, one `SOLUTION_DTYPE` record per epoch.
+
+  """
+  pseudoranges = np.atleast_2d(np.asarray(pseudoranges, dtype=np.float64))
+  n = len(pseudoranges)
+  sat_pos = np.asarray(sat_pos, dtype=np.float64).reshape(
+      pseudoranges.shape + (3,))
+  used = np.isfinite(pseudoranges) & np.all(np.isfinite(sat_pos), axis=2)
+  weights = used.astype(np.float64)
+  n_used = np.sum(used, axis=1)
+  valid = n_used >= MIN_SATS
+
+  x = np.zeros((n, 4))
+  if x0 is not None:
+    x[:] = x0
+  pr = np.where(used, pseudoranges, 0.)
+  for _ in range(max_iterations):
+    los, ranges, _ = _geometry(x, sat_pos, pr)
+    G = np.concatenate((-los, np.ones(pr.shape + (1,))), axis=2)
+    dx = _solve_normal(G, pr - ranges - x[:, 3:], weights)
+    valid &= np.all(np.isfinite(dx), axis=1)
+    dx[~valid] = 0.
+    x += dx
+    if np.all(np.abs(dx[:, :3]) < tolerance):
+      break
+
+  solutions = np.zeros(n, dtype=SOLUTION_DTYPE)
+  solutions['pos_ecef'] = x[:, :3]
+  solutions['clock_offset'] = x[:, 3] / gps_constants.c
+  solutions['vel_ecef'] = np.nan
+  solutions['clock_drift'] = np.nan
+  solutions['n_used'] = n_used
+
+  if pseudorange_rates is not None:
+    prr = np.asarray(pseudorange_rates, dtype=np.float64).reshape(
+        pseudoranges.shape)
+    sat_vel = np.asarray(sat_vel, dtype=np.float64).reshape(sat_pos.shape)
+    los, _, tof = _geometry(x, sat_pos, pr)
+    used_rates = used & np.isfinite(prr) & \
+        np.all(np.isfinite(sat_vel), axis=2)
+    # The pseudorange rates are the satellite velocities along the lines of
+    # sight minus the receiver ones, plus the clock drift
+    y = np.where(used_rates, prr, 0.) - \
+        np.sum(los * _sagnac(np.where(used_rates[:, :, np.newaxis],
+                                      sat_vel, 0.), tof), axis=2)
+    G = np.concatenate((-los, np.ones(pr.shape + (1,))), axis=2)
+    v = _solve_normal(G, y, used_rates.astype(np.float64))
+    solutions['vel_ecef'] = v[:, :3]
+    solutions['clock_drift'] = v[:, 3] / gps_constants.c
+
+  solutions['valid'] = valid
+  for name in ('pos_ecef', 'vel_ecef', 'clock_offset', 'clock_drift'):
+    solutions[name][~valid] = np.nan
+  return solutions
@@ -9,7 +9,9 @@
 # EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
 # WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
 
+import os
 import sys
+import time
 import argparse
 import cPickle
 import logging
@@ -17,16 +19,19 @@ import json
 import numpy as np
 from operator import attrgetter
 
-from peregrine.samples import load_samples
+from peregrine.samples import load_samples, SampleLoader
 from peregrine.acquisition import Acquisition, load_acq_results, save_acq_results
 from peregrine.navigation import navigation
 import peregrine.tracking as tracking
+from peregrine.tracking_segments import track_segments
+from peregrine.tracking_segments import DEFAULT_SEGMENT_OVERLAP_MS
 from peregrine.log import default_logging_config
 from peregrine import defaults
 import peregrine.gps_constants as gps
 from peregrine.tracking_file_utils import removeTrackingOutputFiles
 from peregrine.tracking_file_utils import TrackingResults
 from peregrine.tracking_file_utils import createTrackingDumpOutputFileName
+from peregrine.tracking_file_utils import createTrackingCheckpointFileName
 
 
 class SaveConfigAction(argparse.Action):
@@ -125,6 +130,12 @@ def populate_peregrine_cmd_line_arguments(parser):
                          "(-1: use all available data)",
                          default="-1")
 
+  inputCtrl.add_argument("--batch-size",
+                         metavar='SAMPLES',
+                         type=int,
+                         help="the number of samples tracked per batch "
+                         "(default: chosen for the available memory)")
+
   inputCtrl.add_argument("--profile",
                          choices=['peregrine', 'custom_rate', 'low_rate',
                                   'normal_rate', 'piksi_v3', 'high_rate'],
@@ -183,6 +194,33 @@ def main():
   parser.add_argument("-n", "--skip-navigation",
                       help="use previously saved navigation results",
                       action="store_true")
+  parser.add_argument("--resume",
+                      help="resume tracking from the last tracking checkpoint "
+                      "(use with -a to keep the acquisition results)",
+                      action="store_true")
+  parser.add_argument("--checkpoint-interval",
+                      metavar='SECONDS',
+                      type=float,
+                      default=300.,
+                      help="how often to save a tracking checkpoint "
+                      "(0: never, default: %(default)s)")
+  parser.add_argument("--reacquire",
+                      help="re-acquire and restart the L1C/A channels that "
+                      "lose the lock while tracking",
+                      action="store_true")
+  parser.add_argument("--time-segments",
+                      metavar='N',
+                      type=int,
+                      default=0,
+                      help="split the samples file into N overlapping time "
+                      "segments tracked in parallel (0: off, default: "
+                      "%(default)s)")
+  parser.add_argument("--segment-overlap-ms",
+                      metavar='MS',
+                      type=float,
+                      default=DEFAULT_SEGMENT_OVERLAP_MS,
+                      help="overlap of the time segments used to stitch "
+                      "them together (default: %(default)s)")
 
   populate_peregrine_cmd_line_arguments(parser)
 
@@ -259,7 +297,8 @@ def main():
                         freq_profile['sampling_freq'],
                         freq_profile['GPS_L1_IF'],
                         gps.l1ca_code_period * freq_profile['sampling_freq'],
-                        gps.l1ca_code_length)
+                        gps.l1ca_code_length,
+                        batched=True)
       # only one signal - L1CA is expected to be acquired at the moment
       # TODO: add handling of acquisition results from GLONASS once GLONASS
       # acquisition is supported.
@@ -284,13 +323,38 @@ def main():
   acq_results.sort(key=attrgetter('snr'), reverse=True)
 
   # Track the acquired satellites
-  if not args.skip_tracking:
+  if not args.skip_tracking and args.time_segments > 1:
     # Remove tracking output files from the previous session.
     removeTrackingOutputFiles(args.file)
 
-    load_samples(samples=samples,
-                 filename=args.file,
-                 file_format=args.file_format)
+    fn_results = track_segments(args.file, args.file_format, freq_profile,
+                                acq_results, args.time_segments,
+                                sample_index=skip_samples,
+                                ms_to_track=ms_to_process,
+                                overlap_ms=args.segment_overlap_ms,
+                                batch_size=args.batch_size,
+                                stage2_coherent_ms=stage2_coherent_ms,
+                                stage2_loop_filter_params=stage2_params,
+                                tracker_options=tracker_options,
+                                check_l2c_mask=args.check_l2c_mask)
+
+    logging.debug("Saving tracking results as '%s'" % fn_results)
+
+  elif not args.skip_tracking:
+    checkpoint_file = createTrackingCheckpointFileName(args.file)
+    resume = args.resume and os.path.isfile(checkpoint_file)
+    if args.resume and not resume:
+      logging.warning("No tracking checkpoint '%s', tracking from the start.",
+                      checkpoint_file)
+    if not resume:
+      # Remove tracking output files from the previous session.
+      removeTrackingOutputFiles(args.file)
+
+    # Batches are read ahead while the previous one is tracked. The first
+    # one is loaded once it is known where tracking resumes.
+    loader = SampleLoader(args.file, args.file_format,
+                          batch_size=args.batch_size)
+    loader.set_total(samples)
 
     if ms_to_process < 0:
       ms_to_process = int(
@@ -309,12 +373,23 @@ def main():
                                output_file=args.file,
                                progress_bar_output=args.progress_bar,
                                check_l2c_mask=args.check_l2c_mask)
+    if resume:
+      samples['sample_index'] = tracker.resume(checkpoint_file)
+    loader.load(samples)
+    if args.reacquire:
+      reacq = Acquisition(gps.L1CA,
+                          None,
+                          freq_profile['sampling_freq'],
+                          freq_profile['GPS_L1_IF'],
+                          gps.l1ca_code_period * freq_profile['sampling_freq'],
+                          gps.l1ca_code_length)
     # The tracking channels are designed to support batch processing.
     # In the batch processing mode the data samples are provided in
-    # batches (chunks) of 'defaults.processing_block_size' bytes size.
+    # batches (chunks) of 'loader.batch_size' samples.
     # The loop below runs all tracking channels for each batch as it
     # reads it from the samples file.
     tracker.start()
+    last_checkpoint = time.time()
     condition = True
     while condition:
       # Each tracking channel remembers its own data samples offset within
@@ -328,10 +403,17 @@ def main():
         condition = False
       else:
         samples['sample_index'] = sample_index
-        load_samples(samples=samples,
-                     filename=args.file,
-                     file_format=args.file_format)
+        if args.checkpoint_interval > 0 and \
+           time.time() - last_checkpoint >= args.checkpoint_interval:
+          tracker.checkpoint(checkpoint_file, sample_index)
+          last_checkpoint = time.time()
+        loader.load(samples)
+        if args.reacquire:
+          tracker.reacquire_channels(reacq, samples)
+    loader.close()
     fn_results = tracker.stop()
+    if os.path.isfile(checkpoint_file):
+      os.remove(checkpoint_file)
 
     logging.debug("Saving tracking results as '%s'" % fn_results)
 
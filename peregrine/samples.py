@@ -12,10 +12,27 @@
 import os
 import numpy as np
 import math
+import threading
 import defaults
 from peregrine.gps_constants import L1CA, L2C
 
-__all__ = ['load_samples', 'save_samples']
+__all__ = ['load_samples', 'load_sample_blocks', 'save_samples',
+           'SampleLoader', 'auto_batch_size']
+
+BATCH_MEMORY_FRACTION = 0.25
+"""Fraction of the available memory used for sample batches by
+:func:`auto_batch_size`."""
+
+BATCH_COPIES = 4
+"""Number of copies of a batch held in memory at once: the current and the
+prefetched batch of :class:`SampleLoader`, the copy made when joining them,
+and the shared buffers of the tracking worker pool."""
+
+MIN_BATCH_SIZE = int(1e6)
+"""Smallest batch size [samples] chosen by :func:`auto_batch_size`."""
+
+MAX_BATCH_SIZE = 5 * defaults.processing_block_size
+"""Largest batch size [samples] chosen by :func:`auto_batch_size`."""
 
 
 def __load_samples_n_bits(filename, num_samples, num_skip, n_bits,
@@ -62,12 +79,33 @@ def __load_samples_n_bits(filename, num_samples, num_skip, n_bits,
 
   num_samples = len(s_file) * 8 / sample_block_size
 
+  samples = np.empty((n_rx, num_samples - sample_offset),
+                     dtype=value_lookup.dtype)
+
+  if 8 % sample_block_size == 0:
+    # Whole sample blocks per byte: decode the bytes with a lookup table of
+    # the samples of every byte value, without unpacking the bits. The
+    # samples of a byte are looked up as one word, and the file is decoded
+    # in chunks to bound the temporary memory.
+    byte_lookup = __byte_lookup(n_bits, n_rx, value_lookup)
+    word = np.dtype('i%d' % (byte_lookup.shape[2] * value_lookup.itemsize))
+    chunk_size = 1 << 20
+    for rx in range(n_rx):
+      words = np.ascontiguousarray(byte_lookup[rx]).view(word).reshape(-1)
+      chan = samples[channel_lookup[rx]]
+      index = -sample_offset
+      for start in range(0, len(s_file), chunk_size):
+        chunk = np.take(words, s_file[start:start + chunk_size])
+        chunk = chunk.view(value_lookup.dtype)
+        skip = max(0, -index)
+        chan[index + skip:index + len(chunk)] = chunk[skip:]
+        index += len(chunk)
+    return samples
+
   # Compute total data block size to ignore bits in the tail.
   rounded_len = num_samples * sample_block_size
 
   bits = np.unpackbits(s_file)
-  samples = np.empty((n_rx, num_samples - sample_offset),
-                     dtype=value_lookup.dtype)
 
   for rx in range(n_rx):
     # Construct multi-bit sample values
@@ -82,6 +120,34 @@ def __load_samples_n_bits(filename, num_samples, num_skip, n_bits,
   return samples
 
 
+def __byte_lookup(n_bits, n_rx, value_lookup):
+  '''
+  Helper method to build the table of the samples packed in a byte.
+
+  Parameters
+  ----------
+  n_bits : int
+    Number of bits per sample
+  n_rx : int
+    Number of interleaved receiver channels
+  value_lookup : array-like
+    Array to map values
+
+  Returns
+  -------
+  out : :class:`numpy.ndarray`, shape(`n_rx`, 256, samples per byte)
+    The samples of every receiver channel for every byte value, first sample
+    in the most significant bits.
+  '''
+  bits = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1)
+  bits = bits.reshape(256, -1, n_rx, n_bits)
+  values = np.zeros(bits.shape[:-1], dtype=np.uint8)
+  for bit in range(n_bits):
+    values <<= 1
+    values += bits[..., bit]
+  return value_lookup[values].transpose(2, 0, 1)
+
+
 def __load_samples_one_bit(filename, num_samples, num_skip, channel_lookup):
   '''
   Helper method to load single-bit samples from a file.
@@ -373,6 +439,319 @@ def load_samples(samples,
   return samples
 
 
+def load_sample_blocks(filename,
+                       block_size,
+                       num_blocks=-1,
+                       num_skip=0,
+                       file_format='piksi',
+                       channel=defaults.sample_channel_GPS_L1):
+  """
+  Generate consecutive blocks of samples from a file.
+
+  Only one block is read and held in memory at a time, so arbitrarily long
+  recordings can be processed block by block.
+
+  Parameters
+  ----------
+  filename : string
+    Filename of sample data file.
+  block_size : int
+    Number of samples per block.
+  num_blocks : int, optional
+    Number of blocks to generate, ``-1`` means until the end of the file.
+  num_skip : int, optional
+    Number of samples to discard from the beginning of the file.
+  file_format : string, optional
+    Format of the sample data file, see :func:`_load_samples`.
+  channel : int, optional
+    Receiver channel (band) to take the samples from.
+
+  Returns
+  -------
+  out : generator of :class:`numpy.ndarray`, shape(`block_size`,)
+    The blocks of samples. A partial block at the end of the file is dropped.
+
+  """
+  n = 0
+  while num_blocks < 0 or n < num_blocks:
+    try:
+      signal = _load_samples(filename,
+                             block_size,
+                             num_skip + n * block_size,
+                             file_format)
+    except (EOFError, ValueError):
+      # Reading past the end of the file. Errors on the first block, e.g. an
+      # unknown file format, are not about the end of the file.
+      if n == 0:
+        raise
+      return
+    if signal.shape[1] < block_size:
+      return
+    yield signal[channel]
+    n += 1
+
+
+def auto_batch_size(filename, file_format, memory=None):
+  """
+  Choose the number of samples per batch for the available memory.
+
+  A batch takes :data:`BATCH_COPIES` times its size in memory, for all the
+  bands stored in the file, and may use :data:`BATCH_MEMORY_FRACTION` of the
+  available memory.
+
+  Parameters
+  ----------
+  filename : string
+    Filename of sample data file.
+  file_format : string
+    Format of the sample data file, see :func:`_load_samples`.
+  memory : int, optional
+    Available memory [bytes]. By default the memory available to new
+    processes as reported by the OS, or `defaults.processing_block_size`
+    samples per batch if it is unknown.
+
+  Returns
+  -------
+  out : int
+    Number of samples per batch.
+
+  """
+  if memory is None:
+    memory = _available_memory()
+    if memory is None:
+      return defaults.processing_block_size
+  signal = _load_samples(filename, 8, 0, file_format)
+  bytes_per_sample = signal.shape[0] * signal.dtype.itemsize
+  size = int(memory * BATCH_MEMORY_FRACTION /
+             (BATCH_COPIES * bytes_per_sample))
+  return min(max(size, MIN_BATCH_SIZE), MAX_BATCH_SIZE)
+
+
+def _available_memory():
+  """
+  Memory available for new allocations [bytes], or `None` if unknown.
+
+  """
+  try:
+    with open('/proc/meminfo') as f:
+      for line in f:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) * 1024
+  except (IOError, ValueError, IndexError):
+    pass
+  try:
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+  except (AttributeError, ValueError, OSError):
+    return None
+
+
+def _samples_total(filename, file_format, sample_index):
+  """
+  Number of samples in the file after `sample_index`, callable from classes
+  (see :func:`__get_samples_total`).
+
+  """
+  return __get_samples_total(filename, file_format, sample_index)
+
+
+def _read_samples(filename, file_format, sample_index, num_samples):
+  """
+  Read `num_samples` samples from `sample_index`, fewer at the end of the
+  file, or `None` past the end of the file.
+
+  """
+  available = _samples_total(filename, file_format, 0) - sample_index
+  if min(num_samples, available) <= 0:
+    return None
+  # Packed formats may return a few samples less than requested when not
+  # starting at a byte boundary.
+  signal = _load_samples(filename, min(num_samples + 8, available),
+                         sample_index, file_format)
+  return signal[:, :num_samples]
+
+
+class SampleLoader(object):
+  """
+  Load sample batches like :func:`load_samples`, reading ahead in the
+  background.
+
+  While a batch is processed, the samples following it are read on a
+  background thread. When the next batch starts before the end of the
+  previous one, as when tracking channels are at different sample indices,
+  the overlap is taken from the previous batch instead of being read again.
+
+  """
+
+  def __init__(self, filename, file_format='piksi', batch_size=None):
+    """
+    Parameters
+    ----------
+    filename : string
+      Filename of sample data file.
+    file_format : string, optional
+      Format of the sample data file, see :func:`_load_samples`.
+    batch_size : int, optional
+      Number of samples per batch, by default chosen by
+      :func:`auto_batch_size`.
+
+    """
+    self.filename = filename
+    self.file_format = file_format
+    if batch_size is None:
+      batch_size = auto_batch_size(filename, file_format)
+    self.batch_size = int(batch_size)
+
+    # Samples read so far, of all the bands, starting at `buffer_index`.
+    self.buffer = None
+    self.buffer_index = 0
+    self.eof = False
+
+    self.prefetch_thread = None
+    self.prefetch_index = None
+    self.prefetch_count = 0
+    self.prefetch_result = None
+
+  def set_total(self, samples):
+    """
+    Set `samples['samples_total']` if it is not known yet, without loading
+    a batch.
+
+    Parameters
+    ----------
+    samples : dictionary
+      Sample data.
+
+    Returns
+    -------
+    out : dictionary
+      `samples`
+
+    """
+    if samples['samples_total'] == -1:
+      samples['samples_total'] = _samples_total(self.filename,
+                                                self.file_format,
+                                                samples['sample_index'])
+    return samples
+
+  def load(self, samples):
+    """
+    Load the batch starting at `samples['sample_index']`.
+
+    Parameters
+    ----------
+    samples : dictionary
+      Sample data, updated like :func:`load_samples` does.
+
+    Returns
+    -------
+    out : dictionary
+      `samples`
+
+    """
+    self.set_total(samples)
+    index = samples['sample_index']
+    self._join_prefetch()
+
+    # Drop the samples before the batch.
+    buffer_end = self.buffer_index + self._buffer_len()
+    if self.buffer is not None and self.buffer_index <= index < buffer_end:
+      self.buffer = self.buffer[:, index - self.buffer_index:]
+    else:
+      self.buffer = None
+      self.eof = False
+    self.buffer_index = index
+
+    missing = self.batch_size - self._buffer_len()
+    if missing > 0 and not self.eof:
+      self._append(_read_samples(self.filename, self.file_format,
+                                 index + self._buffer_len(), missing),
+                   missing)
+    if self.buffer is None:
+      raise EOFError("No samples at index %d of '%s'." % (index,
+                                                          self.filename))
+
+    signal = self.buffer[:, :self.batch_size]
+    samples[L1CA]['samples'] = signal[defaults.sample_channel_GPS_L1]
+    if len(signal) > 1:
+      samples[L2C]['samples'] = signal[defaults.sample_channel_GPS_L2]
+
+    # The next batch starts at the latest at the end of this one.
+    prefetch = 2 * self.batch_size - self._buffer_len()
+    if prefetch > 0 and not self.eof:
+      self._start_prefetch(index + self._buffer_len(), prefetch)
+    return samples
+
+  def close(self):
+    """
+    Wait for the background read and release the buffers.
+
+    """
+    self._join_prefetch()
+    self.buffer = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def _buffer_len(self):
+    return 0 if self.buffer is None else self.buffer.shape[1]
+
+  def _append(self, signal, num_samples):
+    """
+    Append the samples read after the buffer, noting the end of the file if
+    fewer than `num_samples` were read.
+
+    """
+    if signal is None or signal.shape[1] < num_samples:
+      self.eof = True
+    if signal is None:
+      return
+    if self.buffer is None:
+      self.buffer = signal
+    else:
+      self.buffer = np.concatenate((self.buffer, signal), axis=1)
+
+  def _start_prefetch(self, sample_index, num_samples):
+    """
+    Start reading `num_samples` samples from `sample_index` on a background
+    thread.
+
+    """
+    def prefetch():
+      try:
+        self.prefetch_result = (_read_samples(self.filename, self.file_format,
+                                              sample_index, num_samples),
+                                None)
+      except Exception as e:
+        self.prefetch_result = (None, e)
+
+    self.prefetch_index = sample_index
+    self.prefetch_count = num_samples
+    self.prefetch_result = None
+    self.prefetch_thread = threading.Thread(target=prefetch)
+    self.prefetch_thread.daemon = True
+    self.prefetch_thread.start()
+
+  def _join_prefetch(self):
+    """
+    Wait for the background read and append its samples if they follow the
+    buffer.
+
+    """
+    if self.prefetch_thread is None:
+      return
+    self.prefetch_thread.join()
+    self.prefetch_thread = None
+    signal, error = self.prefetch_result
+    self.prefetch_result = None
+    if error is not None:
+      raise error
+    if self.prefetch_index == self.buffer_index + self._buffer_len():
+      self._append(signal, self.prefetch_count)
+
+
 def save_samples(filename, samples, file_format='int8'):
   """
   Save sample data to a file.
@@ -12,7 +12,6 @@ import numpy as np
 import math
 import parallel_processing as pp
 import multiprocessing as mp
-import cPickle
 
 from swiftnav.track import LockDetector
 from swiftnav.track import CN0Estimator
@@ -26,12 +25,21 @@ from swiftnav.cnav_msg import CNavMsgDecoder
 from swiftnav.signal import signal_from_code_index
 from peregrine import defaults
 from peregrine import gps_constants
+from peregrine import bit_sync
 from peregrine.acquisition import AcquisitionResult
 from peregrine.include.generateCAcode import caCodes
 from peregrine.include.generateL2CMcode import L2CMCodes
 from peregrine.tracking_file_utils import createTrackingOutputFileNames
+from peregrine.tracking_file_utils import appendTrackingResults
+from peregrine.tracking_file_utils import exportTrackingAnalysis
+from peregrine.tracking_file_utils import TrackingResultsWriter
+from peregrine.tracking_file_utils import collectTrackingOutputFileEntries
+from peregrine.tracking_file_utils import loadTrackingResults
+from peregrine.tracking_file_utils import truncateTrackingResults
 
 import logging
+import cPickle
+import os
 import sys
 
 logger = logging.getLogger(__name__)
@@ -122,6 +130,51 @@ def _tracking_channel_factory(parameters):
     return TrackingChannelL2C(parameters)
 
 
+def run_channels_lockstep(channels, samples, correlator):
+  """
+  Run tracking channels for the given batch of data together.
+
+  The channels are stepped through their `TrackingChannel.run_steps` side
+  by side, so that each step correlates all the channels with a single call
+  of a multi-channel correlator such as
+  :func:`peregrine.correlator.track_correlate_multi`.
+
+  Parameters
+  ----------
+  channels : list
+    Tracking channels
+  samples : dictionary
+    Sample data. Sample data are provided in batches
+  correlator : callable
+    Correlator taking a list of correlator argument tuples and returning the
+    list of their results
+
+  Return
+  ------
+  out : list
+    The results of `TrackingChannel.run` of the channels
+
+  """
+  pending = []
+  for chan in channels:
+    steps = chan.run_steps(samples)
+    for args in steps:
+      pending.append((steps, args))
+      break
+
+  while pending:
+    results = correlator([args for _, args in pending])
+    running = []
+    for (steps, _), result in zip(pending, results):
+      try:
+        running.append((steps, steps.send(result)))
+      except StopIteration:
+        pass
+    pending = running
+
+  return [chan._get_result() for chan in channels]
+
+
 class TrackingChannel(object):
   """
   Tracking channel base class.
@@ -204,6 +257,8 @@ class TrackingChannel(object):
                                      self.acq.prn,
                                      self.acq.signal)
     self.alias_detect_init = 1
+    # Prompt correlations of each code period of the integration
+    self.P_epochs = []
     self.code_phase = 0.0
     self.carr_phase = 0.0
     self.samples_per_chip = int(round(self.sampling_freq / self.chipping_rate))
@@ -215,6 +270,16 @@ class TrackingChannel(object):
     self.code_phase_acc = 0.0
     self.samples_tracked = 0
     self.i = 0
+    # Time of week of the last result [ms], NaN until it is decoded. It is
+    # kept here as the results before `i` may already be dumped.
+    self.tow = np.nan
+
+    # Whether the PLL has been locked, for how long it has been unlocked
+    # since [ms], and whether it has lost the lock for longer than
+    # `defaults.lost_lock_timeout_ms`.
+    self.had_lock = False
+    self.unlocked_ms = 0
+    self.lost_lock = False
 
     self.pipelining = False    # Flag if pipelining is used
     self.pipelining_k = 0.     # Error prediction coefficient for pipelining
@@ -237,7 +302,8 @@ class TrackingChannel(object):
     Append intermediate tracking results to a file.
 
     """
-    fn_analysis, fn_results = self.track_result.dump(self.output_file, self.i)
+    fn_analysis, fn_results = self.track_result.dump(self.output_file, self.i,
+                                                     self.results_writer)
     self.i = 0
     return fn_analysis, fn_results
 
@@ -344,6 +410,17 @@ class TrackingChannel(object):
     """
     return True
 
+  def __getstate__(self):
+    """
+    Get the channel state to pickle, without the sample batch and the
+    results writer, which are given to the channel again when it runs.
+
+    """
+    state = self.__dict__.copy()
+    state['samples'] = None
+    state['results_writer'] = None
+    return state
+
   def run(self, samples):
     """
     Run tracking channel for the given batch of data.
@@ -362,6 +439,42 @@ class TrackingChannel(object):
       The return value is determined by '_get_result' customization method,
       which can be redefined in subclasses
 
+    """
+    multi_channel = getattr(self.correlator, 'multi_channel', False)
+    steps = self.run_steps(samples)
+    try:
+      args = next(steps)
+      while True:
+        if multi_channel:
+          args = steps.send(self.correlator([args])[0])
+        else:
+          args = steps.send(self.correlator(*args))
+    except StopIteration:
+      pass
+
+    return self._get_result()
+
+  def run_steps(self, samples):
+    """
+    Run tracking channel for the given batch of data, one correlation at a
+    time.
+
+    This is a generator doing the work of `run`, except for returning the
+    '_get_result' result. Instead of calling the correlator it yields the
+    arguments of the correlation to do and expects its result to be sent
+    back. This way the correlations of many channels can be computed
+    together, see `run_channels_lockstep`.
+
+    If the correlator has a true `multi_epoch` attribute, the integrations
+    of a coherent integration round are requested at once, with the number
+    of integrations as an extra argument, and the results are arrays with
+    one element per integration.
+
+    Parameters
+    ----------
+    sample : dictionary
+      Sample data. Sample data are provided in batches
+
     """
     self.start()
     self.samples = samples
@@ -374,6 +487,7 @@ class TrackingChannel(object):
     samples_total = len(samples[self.signal]['samples'])
 
     estimated_blksize = self.coherent_ms * self.sampling_freq / 1e3
+    multi_epoch = getattr(self.correlator, 'multi_epoch', False)
 
     self.track_result.status = 'T'
 
@@ -415,25 +529,44 @@ class TrackingChannel(object):
 
       coherent_iter, code_chips_to_integrate = self._short_n_long_preprocess()
 
-      for _ in range(self.coherent_iter):
+      # A multi-epoch correlator does all the integrations in one call,
+      # unless the batch could end before the last one.
+      n_epochs = None
+      if multi_epoch and self.coherent_iter > 1:
+        epoch_blksize = np.ceil(code_chips_to_integrate * self.sampling_freq /
+                                (corr_code_freq + self.chipping_rate)) + 1
+        if (sample_index + self.coherent_iter * epoch_blksize +
+                2 * max(estimated_blksize, epoch_blksize)) < samples_total:
+          n_epochs = self.coherent_iter
+
+      for _ in range(1 if n_epochs else self.coherent_iter):
 
         if (sample_index + 2 * estimated_blksize) >= samples_total:
           break
 
         samples_ = samples[self.signal]['samples'][sample_index:]
 
-        E_, P_, L_, blksize, self.code_phase, self.carr_phase = self.correlator(
-            samples_,
-            code_chips_to_integrate,
-            corr_code_freq + self.chipping_rate, self.code_phase,
-            corr_carr_freq + self.IF, self.carr_phase,
-            self.prn_code,
-            self.sampling_freq,
-            self.signal
-        )
-
-        if blksize > estimated_blksize:
-          estimated_blksize = blksize
+        request = (samples_,
+                   code_chips_to_integrate,
+                   corr_code_freq + self.chipping_rate, self.code_phase,
+                   corr_carr_freq + self.IF, self.carr_phase,
+                   self.prn_code,
+                   self.sampling_freq,
+                   self.signal)
+        if n_epochs:
+          request += (n_epochs,)
+
+        E_, P_, L_, blksize, self.code_phase, self.carr_phase = yield request
+
+        if n_epochs:
+          if blksize.max() > estimated_blksize:
+            estimated_blksize = blksize.max()
+          self.P_epochs.extend(P_)
+          E_, P_, L_, blksize = E_.sum(), P_.sum(), L_.sum(), blksize.sum()
+        else:
+          self.P_epochs.append(P_)
+          if blksize > estimated_blksize:
+            estimated_blksize = blksize
 
         sample_index += blksize
         samples_processed += blksize
@@ -457,6 +590,13 @@ class TrackingChannel(object):
           lock_detect_lpfq = self.lock_detect.update(self.P.real,
                                                      self.P.imag,
                                                      coherent_iter)
+      if lock_detect_outo:
+        self.had_lock = True
+        self.unlocked_ms = 0
+      else:
+        self.unlocked_ms += self.coherent_ms
+      self.lost_lock = self.had_lock and \
+          self.unlocked_ms >= defaults.lost_lock_timeout_ms
 
       if lock_detect_outo:
         if self.alias_detect_init:
@@ -508,6 +648,7 @@ class TrackingChannel(object):
       self.track_result.alias_detect_err_hz[self.i] = alias_detect_err_hz
 
       self._run_postprocess()
+      self.P_epochs = []
 
       self.samples_tracked = self.sample_index + samples_processed
       self.track_result.ms_tracked[self.i] = self.samples_tracked * 1e3 / \
@@ -522,8 +663,6 @@ class TrackingChannel(object):
 
     self.sample_index += samples_processed
 
-    return self._get_result()
-
 
 class TrackingChannelL1CA(TrackingChannel):
 
@@ -649,7 +788,13 @@ class TrackingChannelL1CA(TrackingChannel):
     L1C/A to L2C handover.
     """
 
-    sync, bit = self.nav_bit_sync.update(np.real(self.P), self.coherent_ms)
+    if len(self.P_epochs) > 1 and isinstance(self.nav_bit_sync, NavBitSync):
+      # The bits of a multi-ms integration are synchronized over its 1 ms
+      # correlations at once
+      _, bits = self.nav_bit_sync.update_block(np.real(self.P_epochs))
+      sync, bit = (True, bits[-1]) if len(bits) else (False, None)
+    else:
+      sync, bit = self.nav_bit_sync.update(np.real(self.P), self.coherent_ms)
     if sync:
       tow = self.nav_msg.update(bit)
       if tow >= 0:
@@ -670,8 +815,8 @@ class TrackingChannelL1CA(TrackingChannel):
           pass
     else:
       tow = -1
-    self.track_result.tow[self.i] = tow if tow >= 0 else (
-        self.track_result.tow[self.i - 1] + self.coherent_ms)
+    self.tow = tow if tow >= 0 else self.tow + self.coherent_ms
+    self.track_result.tow[self.i] = self.tow
 
     # Handover to L2C if possible
     if self.l2c_handover and not self.l2c_handover_acq and \
@@ -727,6 +872,9 @@ class TrackingChannelL2C(TrackingChannel):
 
     self.cnav_msg = CNavMsg()
     self.cnav_msg_decoder = CNavMsgDecoder()
+    # Symbols fed to the CNAV message decoder, one byte each, to restore its
+    # state from a checkpoint.
+    self.cnav_symbols = bytearray()
 
   def is_pickleable(self):
     """
@@ -738,6 +886,25 @@ class TrackingChannelL2C(TrackingChannel):
     """
     return False
 
+  def __getstate__(self):
+    """
+    Get the channel state to pickle for a checkpoint. The CNAV message
+    decoder cannot be pickled, so it is restored by feeding the symbols it
+    was fed to a new one.
+
+    """
+    state = TrackingChannel.__getstate__(self)
+    del state['cnav_msg']
+    del state['cnav_msg_decoder']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.cnav_msg = CNavMsg()
+    self.cnav_msg_decoder = CNavMsgDecoder()
+    for symbol in self.cnav_symbols:
+      self.cnav_msg_decoder.decode(symbol, self.cnav_msg)
+
   def _short_n_long_preprocess(self):
     if self.short_n_long:
       # When simulating short and long cycles, short step resets EPL
@@ -783,6 +950,7 @@ class TrackingChannelL2C(TrackingChannel):
     """
 
     symbol = 0xFF if np.real(self.P) >= 0 else 0x00
+    self.cnav_symbols.append(symbol)
     res, delay = self.cnav_msg_decoder.decode(symbol, self.cnav_msg)
     if res:
       logger.debug("[PRN: %d (%s)] CNAV message decoded: "
@@ -797,10 +965,10 @@ class TrackingChannelL2C(TrackingChannel):
       tow = self.cnav_msg.getTow() * 6000 + delay * 20
       logger.debug("[PRN: %d (%s)] ToW %d" %
                    (self.prn + 1, self.signal, tow))
-      self.track_result.tow[self.i] = tow
+      self.tow = tow
     else:
-      self.track_result.tow[self.i] = self.track_result.tow[self.i - 1] + \
-          self.coherent_ms
+      self.tow += self.coherent_ms
+    self.track_result.tow[self.i] = self.tow
 
 
 class Tracker(object):
@@ -824,7 +992,8 @@ class Tracker(object):
                stage2_loop_filter_params=None,
                multi=False,
                tracker_options=None,
-               output_file=None):
+               output_file=None,
+               analysis_output=True):
     """
     Set up tracking environment.
     1. Check if multy CPU tracking is possible
@@ -849,7 +1018,12 @@ class Tracker(object):
     loop_filter_class : class
       The type of the loop filter class to be used by tracker channels
     correlator : class
-      The correlator class to be used by tracker channels
+      The correlator class to be used by tracker channels. With a
+      multi-channel correlator such as
+      :func:`peregrine.correlator.track_correlate_multi` all the channels
+      are correlated together, see `run_channels_lockstep`. With a
+      multi-epoch correlator the integrations of a coherent round are
+      correlated at once, see `TrackingChannel.run_steps`.
     stage2_coherent_ms : dictionary
       Stage 2 coherent integration parameters set.
     stage2_loop_filter_params : dictionary
@@ -863,6 +1037,9 @@ class Tracker(object):
       The actual file name is a mangled version of this file name and
       reflects the signal name and PRN number for which the tracking results
       are generated.
+    analysis_output : bool
+      Write the CSV tracking analysis files from the tracking results files
+      when tracking is stopped.
 
     """
 
@@ -871,6 +1048,7 @@ class Tracker(object):
     self.ms_to_track = ms_to_track
     self.tracker_options = tracker_options
     self.output_file = output_file
+    self.analysis_output = analysis_output
     self.l2c_handover = l2c_handover
     self.check_l2c_mask = check_l2c_mask
     self.correlator = correlator
@@ -928,8 +1106,21 @@ class Tracker(object):
     else:
       self.pbar = None
 
+    # Writer of the tracking results of the channels run in this process,
+    # and the process it was created in: pool workers create their own.
+    self.results_writer = None
+    self.results_writer_pid = None
+
     self.tracking_channels = map(self._create_channel, channels)
 
+    # Worker pool running the pickleable channels in `multi` mode, see
+    # `run_channels`, and the PRN, signal and next sample index of the
+    # channels in it, keyed by channel key.
+    self.pool = None
+    self.pool_channels = {}
+    self.pool_indices = {}
+    self.next_channel_key = 0
+
   def start(self):
     """
     Start tracking operation for all created tracking channels.
@@ -962,19 +1153,39 @@ class Tracker(object):
     ------
     out : list
       A list of file names - one file name for one tracking channel.
-      Each file contains pickled TrackingResults object
+      Each file is a tracking results file, see
+      :func:`peregrine.tracking_file_utils.loadTrackingResults`.
 
     """
 
     if self.pbar:
       self.pbar.finish()
+    stats = [self._close_results_writer()]
+    if self.pool is not None:
+      stats += self.pool.call('close')
+      self.pool.close()
+      self.pool = None
+    logger.info("Tracking results writer: %d blocks of %d results, "
+                "at most %d pending, %.3fs waiting, %.3fs writing" %
+                (sum(x['blocks'] for x in stats),
+                 sum(x['records'] for x in stats),
+                 max(x['max_pending'] for x in stats),
+                 sum(x['wait_time'] for x in stats),
+                 sum(x['write_time'] for x in stats)))
     res = map(lambda chan: chan.track_result.makeOutputFileNames(
                 chan.output_file),
                 self.tracking_channels)
+    res += [createTrackingOutputFileNames(self.output_file, prn + 1, signal)
+            for prn, signal in self.pool_channels.itervalues()]
 
     fn_analysis = map(lambda x: x[0], res)
     fn_results = map(lambda x: x[1], res)
 
+    if self.analysis_output:
+      for analysis, results in sorted(set(res)):
+        if os.path.isfile(results):
+          exportTrackingAnalysis(results, analysis)
+
     def _print_name(name):
       print name
 
@@ -985,6 +1196,109 @@ class Tracker(object):
 
     return fn_results
 
+  def checkpoint(self, fileName, sample_index):
+    """
+    Save the state of the tracking channels and the length of their tracking
+    results files, so that tracking can be resumed from the batch starting at
+    `sample_index` with :meth:`resume`.
+
+    The checkpoint is written to a temporary file first and then renamed, so
+    that the previous checkpoint is kept if writing it is interrupted.
+
+    Parameters
+    ----------
+    fileName : string
+      Checkpoint file name
+    sample_index : int
+      Sample index of the next batch, as returned by :meth:`run_channels`
+
+    """
+    channels = list(self.tracking_channels)
+    self._get_results_writer().flush()
+    if self.pool is not None:
+      for res in self.pool.call('checkpoint'):
+        channels += res
+
+    results = {}
+    for entry in collectTrackingOutputFileEntries(self.output_file):
+      results[entry['filename']] = len(loadTrackingResults(entry['filename']))
+
+    state = {'sample_index': sample_index,
+             'channels': channels,
+             'results': results}
+    with open(fileName + '.tmp', 'wb') as f:
+      cPickle.dump(state, f, protocol=cPickle.HIGHEST_PROTOCOL)
+    os.rename(fileName + '.tmp', fileName)
+    logger.debug("Tracking checkpoint at sample index %d saved as '%s'" %
+                 (sample_index, fileName))
+
+  def resume(self, fileName):
+    """
+    Restore the tracking channels from a checkpoint saved by
+    :meth:`checkpoint`, dropping the tracking results written after it.
+    The tracker must have been created with the same parameters as the one
+    that saved the checkpoint.
+
+    Parameters
+    ----------
+    fileName : string
+      Checkpoint file name
+
+    Return
+    ------
+    out : int
+      Sample index of the batch to resume tracking from
+
+    """
+    with open(fileName, 'rb') as f:
+      state = cPickle.load(f)
+
+    for entry in collectTrackingOutputFileEntries(self.output_file):
+      if entry['filename'] not in state['results']:
+        os.remove(entry['filename'])
+    for results, count in state['results'].iteritems():
+      truncateTrackingResults(results, count)
+
+    channels = []
+    writer = self._get_results_writer()
+    for chan in state['channels']:
+      if isinstance(chan, AcquisitionResult):
+        # Handover not made into a channel in the worker pool yet
+        chan = self._create_channel(chan)
+      elif chan is not None:
+        chan.results_writer = writer
+      channels.append(chan)
+    self.tracking_channels = channels
+    logger.info("Tracking resumed at sample index %d from '%s'" %
+                (state['sample_index'], fileName))
+    return state['sample_index']
+
+  def _get_results_writer(self):
+    """
+    Get the tracking results writer of this process, creating it if needed.
+
+    """
+    if self.results_writer_pid != os.getpid():
+      self.results_writer = TrackingResultsWriter()
+      self.results_writer_pid = os.getpid()
+    return self.results_writer
+
+  def _close_results_writer(self):
+    """
+    Write the pending tracking results of this process and stop its writer.
+
+    Return
+    ------
+    out : dictionary
+      Writer statistics, see
+      :meth:`peregrine.tracking_file_utils.TrackingResultsWriter.stats`
+
+    """
+    writer = self._get_results_writer()
+    self.results_writer = None
+    self.results_writer_pid = None
+    return writer.close()
+
   def _create_channel(self, acq):
     """
     Create a new channel for the given acquisition result.
@@ -1020,72 +1334,306 @@ class Tracker(object):
                   'correlator': self.correlator,
                   'stage2_coherent_ms': self.stage2_coherent_ms,
                   'stage2_loop_filter_params': self.stage2_loop_filter_params,
-                  'multi': self.multi}
+                  'multi': self.multi,
+                  'results_writer': self._get_results_writer()}
     return _tracking_channel_factory(parameters)
 
-  def run_channels(self, samples):
+  def lost_channels(self):
     """
-    Run tracking channels.
+    Get the L1C/A channels that have lost the lock, e.g. to re-acquire them
+    with :meth:`peregrine.acquisition.Acquisition.reacquisition`.
+
+    Return
+    ------
+    out : (list, list)
+      The PRNs of the channels and their last tracked Doppler [Hz]
+
+    """
+    lost = self._lost_channels()
+    return [prn for _, prn, _ in lost], [doppler for _, _, doppler in lost]
+
+  def _lost_channels(self):
+    """
+    Get the L1C/A channels that have lost the lock as a list of tuples
+    (channel or worker pool key, PRN, Doppler).
+
+    """
+    lost = [(chan, chan.prn, chan.loop_filter.to_dict()['carr_freq'])
+            for chan in self.tracking_channels
+            if chan.signal == gps_constants.L1CA and chan.lost_lock]
+    if self.pool is not None:
+      for res in self.pool.call('lost'):
+        lost += res
+    return lost
+
+  def restart_channels(self, acq_results):
+    """
+    Replace the channels that have lost the lock with new channels created
+    from re-acquisition results. The new channels append to the tracking
+    results of the channels they replace.
 
     Parameters
     ----------
-    samples : dictionary
-      Sample data together with description data
+    acq_results : list
+      A list of acquisition results, with `sample_index` being the index of
+      the acquisition samples in the sample stream, as returned by
+      :meth:`peregrine.acquisition.Acquisition.reacquisition`
 
     Return
     ------
     out : int
-      The smallest data sample index across all tracking channels.
-      The index tells the offset, from which the next sample data batch
-      is to be read from the input data file.
+      The number of channels restarted
 
     """
-    channels = self.tracking_channels
-    self.tracking_channels = []
+    acquired = dict((acq.prn, acq) for acq in acq_results
+                    if acq.status == 'A' and acq.signal == gps_constants.L1CA)
+    # The L2C channels handed over to by the lost channels keep running, so
+    # the new channels must not hand over to L2C again.
+    l2c_prns = set(chan.prn for chan in self.tracking_channels
+                   if chan is not None and chan.signal == gps_constants.L2C)
+    l2c_prns.update(prn for prn, signal in self.pool_channels.itervalues()
+                    if signal == gps_constants.L2C)
+    restarted = 0
+    lost = [x for x in self._lost_channels() if x[1] in acquired]
+    if any(not isinstance(chan, TrackingChannel) for chan, _, _ in lost):
+      # The results of the pool channels must be written before the new
+      # channels append to them from this process.
+      self.pool.call('flush')
+    for chan, prn, _ in lost:
+      acq = acquired[prn]
+      acq = AcquisitionResult(acq.prn, acq.carr_freq, acq.doppler,
+                              acq.code_phase, acq.snr, acq.status, acq.signal,
+                              acq.sample_index - self.samples['sample_index'])
+      new_chan = self._create_channel(acq)
+      new_chan.track_result.print_start = 0
+      if prn in l2c_prns:
+        new_chan.l2c_handover = False
+      if isinstance(chan, TrackingChannel):
+        self.tracking_channels[self.tracking_channels.index(chan)] = new_chan
+      else:
+        # Channels in the worker pool are replaced by a new local channel,
+        # which is moved to the pool by the next `run_channels`.
+        self.pool.remove(chan)
+        del self.pool_channels[chan]
+        del self.pool_indices[chan]
+        self.tracking_channels.append(new_chan)
+      logger.info("[PRN: %d (%s)] Tracking is restarted at sample index %d" %
+                  (acq.prn + 1, acq.signal, new_chan.get_index()))
+      restarted += 1
+    return restarted
+
+  def reacquire_channels(self, acq, samples):
+    """
+    Re-acquire the L1C/A channels that have lost the lock in the next batch
+    of samples and restart the ones acquired again, see
+    :meth:`restart_channels`.
+
+    The acquisition samples start where the lost channel that is the
+    furthest ahead stopped, so that the tracking results of the new channels
+    follow the ones of the channels they replace. Nothing is done if the
+    batch is too short for them.
 
-    def _run_parallel(i, samples):
-      """
-      Run a tracking channel.
-      Expected to be run in a child process.
+    Parameters
+    ----------
+    acq : :class:`peregrine.acquisition.Acquisition`
+      L1C/A acquisition, its samples are replaced with the ones of the batch
+    samples : dictionary
+      Sample data of the batch the channels are to be run on next
 
-      Parameters
-      ----------
-      i : int
-        Channel index within self.parallel_channels list
+    Return
+    ------
+    out : int
+      The number of channels restarted
 
-      Return
-      out : TrackingChannel, AcquisitionResult
-        Tracking channel state and handover result
+    """
+    lost = self._lost_channels()
+    if not lost:
+      return 0
+    indices = [chan.get_index() if isinstance(chan, TrackingChannel)
+               else self.pool_indices[chan] for chan, _, _ in lost]
+    offset = max(indices) - samples['sample_index']
+    batch = samples[gps_constants.L1CA]['samples']
+    if offset + acq.offsets[-1] + acq.n_integrate > len(batch):
+      return 0
+    acq.init_samples(batch[offset:], samples['sample_index'] + offset)
+    acq_results = acq.reacquisition([prn for _, prn, _ in lost],
+                                    [doppler for _, _, doppler in lost],
+                                    multi=False)
+    return self.restart_channels(acq_results)
+
+  def _start_pool(self, samples):
+    """
+    Start the worker pool running the pickleable channels in `multi` mode.
 
-      """
-      handover = self.parallel_channels[i].run(samples)
-      return self.parallel_channels[i], handover
+    The sample batches are passed to the workers through shared memory
+    buffers, sized for `defaults.processing_block_size` samples or the first
+    batch if it is longer.
 
-    while channels and not all(v is None for v in channels):
+    """
+    self.shared_samples = {}
+    for signal in (gps_constants.L1CA, gps_constants.L2C):
+      if 'samples' in samples[signal]:
+        batch = samples[signal]['samples']
+        size = max(len(batch), defaults.processing_block_size)
+        self.shared_samples[signal] = pp.shared_array(size, batch.dtype)
+    self.pool = pp.ResidentPool(self._pool_command, mp.cpu_count())
+
+  def _pool_command(self, channels, command, *args):
+    """
+    Run `command` on the channels owned by a pool worker.
+
+    'run' runs the channels on the batch in the shared buffers, or only the
+    channels of the given keys, and returns tuples (key, next sample index,
+    handover result). Acquisition results handed over to the pool are made
+    into channels in the worker first, so that channels that cannot be
+    pickled, such as the L2C ones, run in the pool too. 'lost' returns tuples
+    (key, PRN, Doppler) of the L1C/A channels that have lost the lock,
+    'flush' writes the pending tracking results of the worker, 'checkpoint'
+    also returns the channels of the worker and 'close' stops its results
+    writer, returning the writer statistics.
+
+    """
+    if command == 'run':
+      sample_index, lengths, keys = args
+      samples = {'sample_index': sample_index,
+                 'samples_total': self.samples['samples_total']}
+      for signal in (gps_constants.L1CA, gps_constants.L2C):
+        samples[signal] = {'IF': self.samples[signal]['IF']}
+        if signal in lengths:
+          samples[signal]['samples'] = \
+              self.shared_samples[signal][:lengths[signal]]
+      for key, chan in channels.items():
+        if isinstance(chan, AcquisitionResult):
+          channels[key] = self._create_channel(chan)
+      if keys is None:
+        keys = channels.keys()
+      else:
+        keys = [key for key in keys if key in channels]
+      writer = self._get_results_writer()
+      for chan in channels.itervalues():
+        chan.results_writer = writer
+      handover = self._run_local([channels[key] for key in keys], samples)
+      return [(key, channels[key].get_index(), result)
+              for key, result in zip(keys, handover)]
+    elif command == 'lost':
+      return [(key, chan.prn, chan.loop_filter.to_dict()['carr_freq'])
+              for key, chan in channels.iteritems()
+              if chan.signal == gps_constants.L1CA and chan.lost_lock]
+    elif command == 'flush':
+      self._get_results_writer().flush()
+      return True
+    elif command == 'checkpoint':
+      self._get_results_writer().flush()
+      return channels.values()
+    elif command == 'close':
+      return self._close_results_writer()
+    else:
+      raise ValueError("Unknown pool command '%s'" % command)
 
-      if self.multi:
-        self.parallel_channels = filter(lambda x: x.is_pickleable(), channels)
+  def _run_pool(self, samples):
+    """
+    Run the channels in the worker pool on a batch of samples, handing the
+    new pickleable channels over to the pool first. The handover results of
+    the pool channels are handed over to the pool, and the channels made
+    from them run on the batch in the workers.
+
+    """
+    if self.pool is None:
+      self._start_pool(samples)
+
+    lengths = {}
+    for signal, buf in self.shared_samples.iteritems():
+      if 'samples' in samples[signal]:
+        batch = samples[signal]['samples']
+        if len(batch) > len(buf):
+          raise ValueError("Sample batch larger than the shared buffer.")
+        buf[:len(batch)] = batch
+        lengths[signal] = len(batch)
+
+    local = []
+    for chan in self.tracking_channels:
+      if chan is not None and chan.is_pickleable():
+        # The channel gets the samples of every batch in `run`, so the
+        # samples it was created with do not need to be pickled. It writes
+        # its results with the results writer of its worker.
+        chan.samples = None
+        chan.results_writer = None
+        self._pool_add(chan, chan.get_index())
       else:
-        self.parallel_channels = []
+        local.append(chan)
+    self.tracking_channels = local
 
-      serial_channels = list(set(channels) - set(self.parallel_channels))
-      channels = []
+    keys = None
+    while keys is None or keys:
       handover = []
+      for res in self.pool.call('run', samples['sample_index'], lengths,
+                                keys):
+        for key, index, result in res:
+          self.pool_indices[key] = index
+          if result is not None:
+            handover.append(result)
+      keys = [self._pool_add(acq, acq.sample_index) for acq in handover]
+
+  def _pool_add(self, obj, index):
+    """
+    Hand a channel, or an acquisition result to make a channel from, over to
+    the worker pool.
+
+    Return
+    ------
+    out : int
+      The pool key of the channel
+
+    """
+    key = self.next_channel_key
+    self.next_channel_key += 1
+    self.pool.add(key, obj)
+    self.pool_channels[key] = (obj.prn, obj.signal)
+    self.pool_indices[key] = index
+    return key
+
+  def _run_local(self, channels, samples):
+    """
+    Run tracking channels in this process, in lockstep if the correlator is
+    a multi-channel one, returning their handover results.
+
+    """
+    if getattr(self.correlator, 'multi_channel', False):
+      return run_channels_lockstep(channels, samples, self.correlator)
+    return map(lambda x: x.run(samples), channels)
+
+  def run_channels(self, samples):
+    """
+    Run tracking channels.
 
-      if self.parallel_channels:
-        res = pp.parmap(lambda i: _run_parallel(i, samples),
-                        range(len(self.parallel_channels)),
-                        nprocs=len(self.parallel_channels),
-                        show_progress=False,
-                        func_progress=False)
+    In `multi` mode the pickleable channels are moved to a pool of worker
+    processes, where they stay for the whole run, and the L2C channels they
+    hand over to are created in the workers; only the sample batches
+    (through shared memory) and the handover results are exchanged with the
+    workers.
 
-        channels = map(lambda x: x[0], res)
-        handover += map(lambda x: x[1], res)
+    Parameters
+    ----------
+    samples : dictionary
+      Sample data together with description data
 
-      if serial_channels:
-        handover += map(lambda x: x.run(samples), serial_channels)
+    Return
+    ------
+    out : int
+      The smallest data sample index across all tracking channels.
+      The index tells the offset, from which the next sample data batch
+      is to be read from the input data file.
 
-      self.tracking_channels += channels + serial_channels
+    """
+    if self.multi:
+      self._run_pool(samples)
+    channels = self.tracking_channels
+    self.tracking_channels = []
+
+    while channels and not all(v is None for v in channels):
+      handover = self._run_local(channels, samples)
+
+      self.tracking_channels += channels
       handover = [h for h in handover if h is not None]
       if handover:
         channels = map(self._create_channel, handover)
@@ -1093,6 +1641,7 @@ class Tracker(object):
         channels = None
 
     indicies = map(lambda x: x.get_index(), self.tracking_channels)
+    indicies += self.pool_indices.values()
     min_index = min(indicies)
 
     if self.pbar:
@@ -1102,6 +1651,19 @@ class Tracker(object):
     return min_index
 
 
+TRACK_RESULTS_COLUMNS = ('absolute_sample', 'ms_tracked', 'coherent_ms',
+                         'code_phase', 'code_phase_acc', 'code_freq',
+                         'carr_phase', 'carr_phase_acc', 'carr_freq',
+                         'E', 'P', 'L', 'cn0',
+                         'lock_detect_outp', 'lock_detect_outo',
+                         'lock_detect_pcount1', 'lock_detect_pcount2',
+                         'lock_detect_lpfi', 'lock_detect_lpfq',
+                         'alias_detect_err_hz', 'nav_msg_bit_phase_ref',
+                         'tow')
+"""Per-entry arrays of :class:`TrackResults` stored in tracking results
+files."""
+
+
 class TrackResults:
   """
   Tracking results.
@@ -1157,11 +1719,12 @@ class TrackResults:
     self.signal = signal
     self.ms_tracked = np.zeros(n_points)
 
-  def dump(self, output_file, size):
+  def dump(self, output_file, size, writer=None):
     """
     Store tracking result to file system.
-    The tracking results are stored in two different formats:
-    CSV (test) and Python pickle (binary) format.
+    The tracking results are appended to a tracking results file, see
+    :func:`peregrine.tracking_file_utils.appendTrackingResults`, or queued
+    to be appended by a results writer.
 
     Parameters
     ----------
@@ -1170,63 +1733,51 @@ class TrackResults:
       version of this name and includes the PRN and signal type.
     size : int
       How many entries of the tracking results are to be stored into the file.
+    writer : TrackingResultsWriter, optional
+      Results writer to queue the tracking results to, see
+      :class:`peregrine.tracking_file_utils.TrackingResultsWriter`. By default
+      they are written before returning.
 
     """
     # mangle the output file names with the tracked signal name
     fn_analysis, fn_results = self.makeOutputFileNames(output_file)
 
-    if self.print_start:
-      mode = 'w'
+    if writer is None:
+      appendTrackingResults(fn_results, self.records(size),
+                            create=self.print_start)
     else:
-      mode = 'a'
-
-    # saving tracking results for navigation stage
-    with open(fn_results, mode) as f1:
-      if size != 500:
-        self.resize(size)
-      cPickle.dump(self, f1, protocol=cPickle.HIGHEST_PROTOCOL)
-      if size != 500:
-        self.resize(500)
-
-    with open(fn_analysis, mode) as f1:
-      if self.print_start:
-        f1.write(
-          "sample_index,ms_tracked,coherent_ms,IF,doppler_phase,carr_doppler,"
-          "code_phase,code_freq,"
-          "CN0,E_I,E_Q,P_I,P_Q,L_I,L_Q,"
-          "lock_detect_outp,lock_detect_outo,"
-          "lock_detect_pcount1,lock_detect_pcount2,"
-          "lock_detect_lpfi,lock_detect_lpfq,alias_detect_err_hz,"
-          "code_phase_acc\n")
-      for i in range(size):
-        f1.write("%s," % int(self.absolute_sample[i]))
-        f1.write("%s," % self.ms_tracked[i])
-        f1.write("%s," % self.coherent_ms[i])
-        f1.write("%s," % self.IF)
-        f1.write("%s," % self.carr_phase[i])
-        f1.write("%s," % (self.carr_freq[i] -
-                          self.IF))
-        f1.write("%s," % self.code_phase[i])
-        f1.write("%s," % self.code_freq[i])
-        f1.write("%s," % self.cn0[i])
-        f1.write("%s," % self.E[i].real)
-        f1.write("%s," % self.E[i].imag)
-        f1.write("%s," % self.P[i].real)
-        f1.write("%s," % self.P[i].imag)
-        f1.write("%s," % self.L[i].real)
-        f1.write("%s," % self.L[i].imag)
-        f1.write("%s," % int(self.lock_detect_outp[i]))
-        f1.write("%s," % int(self.lock_detect_outo[i]))
-        f1.write("%s," % int(self.lock_detect_pcount1[i]))
-        f1.write("%s," % int(self.lock_detect_pcount2[i]))
-        f1.write("%s," % self.lock_detect_lpfi[i])
-        f1.write("%s," % self.lock_detect_lpfq[i])
-        f1.write("%s," % self.alias_detect_err_hz[i])
-        f1.write("%s\n" % self.code_phase_acc[i])
+      writer.append(fn_results, self.records(size), create=self.print_start)
 
     self.print_start = 0
     return fn_analysis, fn_results
 
+  def records(self, size):
+    """
+    Get the first tracking results as records.
+
+    Parameters
+    ----------
+    size : int
+      How many entries of the tracking results to get.
+
+    Returns
+    -------
+    out : :class:`numpy.ndarray`
+      One record per entry, with one field per element of
+      `TRACK_RESULTS_COLUMNS` and the `status` and `IF` fields.
+
+    """
+    columns = [getattr(self, name) for name in TRACK_RESULTS_COLUMNS]
+    dtype = [(name, c.dtype) for name, c in zip(TRACK_RESULTS_COLUMNS,
+                                                 columns)]
+    dtype += [('status', 'S1'), ('IF', np.float64)]
+    records = np.empty(size, dtype=dtype)
+    for name, c in zip(TRACK_RESULTS_COLUMNS, columns):
+      records[name] = c[:size]
+    records['status'] = self.status
+    records['IF'] = self.IF
+    return records
+
   def makeOutputFileNames(self, outputFileName):
     # mangle the output file names with the tracked signal name
     fn_analysis, fn_results = createTrackingOutputFileNames(outputFileName,
@@ -1234,12 +1785,6 @@ class TrackResults:
                                                             self.signal)
     return fn_analysis, fn_results
 
-  def resize(self, n_points):
-    for k in dir(self):
-      v = getattr(self, k)
-      if isinstance(v, np.ndarray):
-        v.resize(n_points, refcheck=False)
-
   def __eq__(self, other):
     return self._equal(other)
 
@@ -1298,6 +1843,82 @@ class NavBitSync:
     else:
       return False, None
 
+  def update_block(self, corr):
+    """
+    Update with consecutive 1 ms correlations at once.
+
+    The state and the bits are the same as after calling `update` with each
+    correlation, but the bit edges are searched and the bits are integrated
+    over the whole array, see :mod:`peregrine.bit_sync`.
+
+    Parameters
+    ----------
+    corr : array_like
+      Prompt correlations, one per ms.
+
+    Returns
+    -------
+    out : tuple
+      The indices of the correlations ending a bit, and the bits.
+
+    """
+    corr = np.asarray(corr, dtype=np.float64)
+    n_bits = len(self.bits)
+    ends = []
+    start = 0
+    if not self.synced:
+      index = self._sync_block(corr)
+      if index < 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+      start = index + 1
+      if self.bit_phase == self.bit_phase_ref:
+        ends.append(index)
+        self.bits.append(1 if self.bit_integrate > 0 else 0)
+        self.bit_integrate = 0
+
+    corr = corr[start:]
+    bit_ends, sums, self.bit_integrate = bit_sync.integrate_bits(
+        corr, self.bit_phase_ref, self.bit_phase, self.bit_integrate)
+    self.bit_phase = (self.bit_phase + len(corr)) % 20
+    self.count += len(corr)
+    self.bits += [1 if s > 0 else 0 for s in sums]
+    return (np.concatenate((ends, start + bit_ends)).astype(int),
+            np.array(self.bits[n_bits:], dtype=int))
+
+  def _sync_block(self, corr):
+    """
+    Search the bit edges in 1 ms correlations until they are found.
+
+    Subclasses with a vectorized search override this per correlation
+    search.
+
+    Returns
+    -------
+    out : int
+      Index of the correlation at which the bit edges are found, -1 if they
+      are not.
+
+    """
+    for index, c in enumerate(corr):
+      self.bit_phase = (self.bit_phase + 1) % 20
+      self.count += 1
+      self.bit_integrate += c
+      self.update_bit_sync(c, 1)
+      if self.synced:
+        return index
+    return -1
+
+  def _advance(self, corr):
+    """
+    Advance the bit phase, the count and the bit integral over 1 ms
+    correlations.
+
+    """
+    self.bit_phase = (self.bit_phase + len(corr)) % 20
+    self.count += len(corr)
+    self.bit_integrate = np.cumsum(np.concatenate(([self.bit_integrate],
+                                                   corr)))[-1]
+
   def update_bit_sync(self, corr, ms):
     raise NotImplementedError
 
@@ -1430,6 +2051,35 @@ class NBSMatchBit(NavBitSync):
           self.synced = True
           self.bit_phase_ref = np.argmax(self.hist)
 
+  def _sync_block(self, corr):
+    # The score is the one of the histogram at the last check, so the
+    # correlations after it are matched separately.
+    checked = max(len(corr) - (len(corr) + self.bit_phase + 1) % 20, 0)
+    index = self._match_bit(corr[:checked])
+    if index < 0 and checked < len(corr):
+      self._match_bit(corr[checked:])
+    return index
+
+  def _match_bit(self, corr):
+    history = self.prev[(self.bit_phase + 1 + np.arange(20)) % 20]
+    index, bit_phase_ref, self.hist = bit_sync.match_bit(
+        corr, self.thres, self.bit_phase, self.count, history, self.hist)
+    if index >= 0:
+      corr = corr[:index + 1]
+    if len(corr):
+      self._advance(corr)
+      # The bit integral is the sum of the last 20 correlations
+      self.bit_integrate = bit_sync.window_sums(corr, 20, history)[-1]
+      self.prev[(self.bit_phase + 1 + np.arange(20)) % 20] = \
+          np.concatenate((history, corr))[-20:]
+      if self.bit_phase == 19 and self.count >= 20:
+        sh = sorted(self.hist)
+        self.score = sh[-1] - sh[-2]
+    if index >= 0:
+      self.synced = True
+      self.bit_phase_ref = bit_phase_ref
+    return index
+
 
 class NBSHistogram(NavBitSync):
 
@@ -1452,6 +2102,26 @@ class NBSHistogram(NavBitSync):
         self.hist = np.zeros(20)
         self.bit_phase_count = 0
 
+  def _sync_block(self, corr):
+    index, bit_phase_ref, hist = bit_sync.histogram(
+        corr, self.thres, self.bit_phase, self.bit_phase_count,
+        self.prev_corr, self.hist)
+    if index >= 0:
+      corr = corr[:index + 1]
+    if len(corr):
+      dots = corr * np.concatenate(([self.prev_corr], corr[:-1]))
+      self.bit_phase_count += np.count_nonzero(dots < 0)
+      self.prev_corr = corr[-1]
+      self._advance(corr)
+    if index >= 0:
+      self.synced = True
+      self.bit_phase_ref = bit_phase_ref
+      self.hist = np.zeros(20)
+      self.bit_phase_count = 0
+    else:
+      self.hist = hist
+    return index
+
 
 class NBSMatchEdge(NavBitSync):
   # TODO: This isn't quite right - might get wrong answer with long leading
@@ -1465,15 +2135,32 @@ class NBSMatchEdge(NavBitSync):
     self.thres = thres
 
   def update_bit_sync(self, corr, ms):
-    bp40 = self.bit_phase % 40
-    self.acc += corr - 2 * self.prev[(bp40 - 20) % 40] + self.prev[bp40]
-    self.prev[bp40] = corr
-    if self.bit_phase >= 40:
+    # The previous correlations are kept in the order they came in
+    i40 = (self.count - 1) % 40
+    self.acc += corr - 2 * self.prev[(i40 - 20) % 40] + self.prev[i40]
+    self.prev[i40] = corr
+    if self.count >= 40:
       # Accumulator valid
-      self.hist[(bp40 + 1) % 20] += abs(self.acc)
-      if bp40 % 20 == 19:
+      self.hist[(self.bit_phase + 1) % 20] += abs(self.acc)
+      if self.bit_phase == 19:
         # Histogram valid
         sh = sorted(self.hist)
         if sh[-1] - sh[-2] > self.thres:
           self.synced = True
           self.bit_phase_ref = np.argmax(self.hist)
+
+  def _sync_block(self, corr):
+    history = self.prev[(self.count + np.arange(40)) % 40]
+    index, bit_phase_ref, self.hist = bit_sync.match_edge(
+        corr, self.thres, self.bit_phase, self.count, history, self.hist)
+    if index >= 0:
+      corr = corr[:index + 1]
+    if len(corr):
+      self._advance(corr)
+      last = np.concatenate((history, corr))[-40:]
+      self.acc = last[20:].sum() - last[:20].sum()
+      self.prev[(self.count + np.arange(40)) % 40] = last
+    if index >= 0:
+      self.synced = True
+      self.bit_phase_ref = bit_phase_ref
+    return index
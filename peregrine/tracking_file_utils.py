@@ -10,13 +10,38 @@
 
 import os
 import re
+import bisect
+import heapq
 import logging
 import cPickle
 import copy
+import struct
 import sys
+import threading
+import time
+import Queue
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
+RESULTS_HEADER_SPARE = 32
+"""Spare characters in the header of tracking results files, which keep its
+length fixed as the record count grows."""
+
+ANALYSIS_COLUMNS = (
+    "sample_index,ms_tracked,coherent_ms,IF,doppler_phase,carr_doppler,"
+    "code_phase,code_freq,"
+    "CN0,E_I,E_Q,P_I,P_Q,L_I,L_Q,"
+    "lock_detect_outp,lock_detect_outo,"
+    "lock_detect_pcount1,lock_detect_pcount2,"
+    "lock_detect_lpfi,lock_detect_lpfq,alias_detect_err_hz,"
+    "code_phase_acc\n")
+"""Header line of the CSV tracking analysis files."""
+
+RESULTS_QUEUE_SIZE = 32
+"""Number of blocks of tracking results waiting to be written, past which
+tracking waits for the results writer."""
+
 
 def createTrackingOutputFileNames(outputFileName, prn, signalName):
   '''
@@ -56,6 +81,10 @@ def createTrackingDumpOutputFileName(outputFileName):
   return (output_filename + '.combined_track' + output_file_extension)
 
 
+def createTrackingCheckpointFileName(outputFileName):
+  return outputFileName + '.track_checkpoint'
+
+
 def collectTrackingOutputFileEntries(outputFileName):
   '''
   Collects tracking file information by listing file names that are constructed
@@ -113,6 +142,7 @@ def removeTrackingOutputFiles(outputFileName):
   filenames = [fileEntry['filename'] for fileEntry in fileEntries]
   filenames += [fileEntry['filename2'] for fileEntry in fileEntries]
   filenames.append(createTrackingDumpOutputFileName(outputFileName))
+  filenames.append(createTrackingCheckpointFileName(outputFileName))
   filenames.sort()
   for filename in filenames:
     if os.path.isfile(filename):
@@ -120,6 +150,365 @@ def removeTrackingOutputFiles(outputFileName):
       os.remove(filename)
 
 
+def _resultsHeader(dtype, count, length=None):
+  '''
+  Builds the .npy header of a tracking results file holding `count` records,
+  padded to `length` bytes.
+  '''
+  header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+      np.lib.format.dtype_to_descr(np.dtype(dtype)), count)
+  prefix = np.lib.format.magic(1, 0)
+  if length is None:
+    length = len(prefix) + 2 + len(header) + 1 + RESULTS_HEADER_SPARE
+    length = (length + 15) // 16 * 16
+  header += ' ' * (length - len(prefix) - 2 - len(header) - 1) + '\n'
+  return prefix + struct.pack('<H', len(header)) + header
+
+
+def appendTrackingResults(fileName, records, create=False):
+  '''
+  Appends tracking results to a tracking results file.
+
+  Tracking results files are .npy files of one record per tracking result,
+  with a header of fixed length so that records are appended with one write
+  and the header updated in place. They can be read with `np.load`, and
+  memory-mapped by column with :func:`loadTrackingResults`.
+
+  Parameters
+  ----------
+  fileName : string
+    Tracking results file name.
+  records : numpy.ndarray
+    Records to append, of a structured dtype.
+  create : bool, optional
+    Replace the file instead of appending to it. A new file is also created
+    if none exists.
+  '''
+  if create or not os.path.isfile(fileName):
+    with open(fileName, 'wb') as f:
+      f.write(_resultsHeader(records.dtype, 0))
+
+  with open(fileName, 'r+b') as f:
+    prefix = f.read(10)
+    length = 10 + struct.unpack('<H', prefix[8:10])[0]
+    f.seek(0, os.SEEK_END)
+    records.tofile(f)
+    count = (f.tell() - length) // records.dtype.itemsize
+    f.seek(0)
+    f.write(_resultsHeader(records.dtype, count, length))
+
+
+def truncateTrackingResults(fileName, count):
+  '''
+  Drops the tracking results following the first `count` ones from a
+  tracking results file.
+
+  Parameters
+  ----------
+  fileName : string
+    Tracking results file name.
+  count : int
+    Number of tracking results to keep.
+  '''
+  with open(fileName, 'r+b') as f:
+    np.lib.format.read_magic(f)
+    shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+    length = f.tell()
+    if count > shape[0]:
+      raise ValueError("Tracking results file '%s' has %d results, not %d." %
+                       (fileName, shape[0], count))
+    f.truncate(length + count * dtype.itemsize)
+    f.seek(0)
+    f.write(_resultsHeader(dtype, count, length))
+
+
+class TrackingResultsWriter(object):
+  '''
+  Appends tracking results to tracking results files on a background thread.
+
+  Blocks of results are queued by :meth:`append` and written in order by
+  the writer thread, so that tracking does not wait for the file system
+  unless the queue is full. The time spent waiting on a full queue, the
+  largest number of queued blocks and the time spent writing tell whether
+  the writes keep up with tracking, see :meth:`stats`.
+  '''
+
+  def __init__(self, queue_size=RESULTS_QUEUE_SIZE):
+    '''
+    Parameters
+    ----------
+    queue_size : int, optional
+      Number of blocks that can be waiting to be written.
+    '''
+    self.queue = Queue.Queue(queue_size)
+    self.thread = None
+    self.error = None
+    self.blocks = 0
+    self.records = 0
+    self.max_pending = 0
+    self.wait_time = 0.
+    self.write_time = 0.
+
+  def append(self, fileName, records, create=False):
+    '''
+    Queues tracking results to be appended to a tracking results file, see
+    :func:`appendTrackingResults`. The records must not be modified
+    afterwards.
+
+    Raises
+    ------
+    IOError
+      If writing previous results failed.
+    '''
+    self._check()
+    if self.thread is None:
+      self.thread = threading.Thread(target=self._run)
+      self.thread.daemon = True
+      self.thread.start()
+    start = time.time()
+    self.queue.put((fileName, records, create))
+    self.wait_time += time.time() - start
+    self.max_pending = max(self.max_pending, self.queue.qsize())
+
+  def flush(self):
+    '''
+    Waits until the queued results are written.
+    '''
+    if self.thread is not None:
+      self.queue.join()
+    self._check()
+
+  def close(self):
+    '''
+    Writes the queued results and stops the writer thread.
+
+    Returns
+    -------
+    dict
+      Writer statistics, see :meth:`stats`.
+    '''
+    if self.thread is not None:
+      self.queue.put(None)
+      self.thread.join()
+      self.thread = None
+    self._check()
+    return self.stats()
+
+  def stats(self):
+    '''
+    Queries writer statistics: the number of blocks and records written,
+    the largest number of blocks waiting to be written, the time [s] spent
+    waiting for room in the queue and the time [s] spent writing.
+    '''
+    return {'blocks': self.blocks,
+            'records': self.records,
+            'max_pending': self.max_pending,
+            'wait_time': self.wait_time,
+            'write_time': self.write_time}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def _check(self):
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise IOError("Writing tracking results failed: %s" % error)
+
+  def _run(self):
+    while True:
+      item = self.queue.get()
+      try:
+        if item is None:
+          return
+        if self.error is None:
+          fileName, records, create = item
+          start = time.time()
+          appendTrackingResults(fileName, records, create)
+          self.write_time += time.time() - start
+          self.blocks += 1
+          self.records += len(records)
+      except Exception as e:
+        self.error = e
+      finally:
+        self.queue.task_done()
+
+
+def loadTrackingResults(fileName):
+  '''
+  Loads a tracking results file written by :func:`appendTrackingResults`.
+
+  Parameters
+  ----------
+  fileName : string
+    Tracking results file name.
+
+  Returns
+  -------
+  numpy.ndarray
+    The records, memory-mapped unless the file is empty. Columns are
+    accessed by field name, e.g. ``results['P']``.
+  '''
+  with open(fileName, 'rb') as f:
+    np.lib.format.read_magic(f)
+    shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+  if shape[0] == 0:
+    return np.zeros(0, dtype=dtype)
+  return np.load(fileName, mmap_mode='r')
+
+
+def isTrackingResultsFile(fileName):
+  '''
+  Checks if a file is a tracking results file written by
+  :func:`appendTrackingResults`, as opposed to a stream of pickled
+  `TrackResults` objects.
+  '''
+  with open(fileName, 'rb') as f:
+    return f.read(6) == np.lib.format.MAGIC_PREFIX
+
+
+def exportTrackingAnalysis(resultsFileName, analysisFileName):
+  '''
+  Writes the CSV tracking analysis file of a tracking results file.
+
+  Parameters
+  ----------
+  resultsFileName : string
+    Tracking results file name.
+  analysisFileName : string
+    CSV file name.
+  '''
+  r = loadTrackingResults(resultsFileName)
+  columns = [r['absolute_sample'].astype(np.int64), r['ms_tracked'],
+             r['coherent_ms'], r['IF'], r['carr_phase'],
+             r['carr_freq'] - r['IF'], r['code_phase'], r['code_freq'],
+             r['cn0'], r['E'].real, r['E'].imag, r['P'].real, r['P'].imag,
+             r['L'].real, r['L'].imag,
+             r['lock_detect_outp'].astype(np.int64),
+             r['lock_detect_outo'].astype(np.int64),
+             r['lock_detect_pcount1'].astype(np.int64),
+             r['lock_detect_pcount2'].astype(np.int64),
+             r['lock_detect_lpfi'], r['lock_detect_lpfq'],
+             r['alias_detect_err_hz'], r['code_phase_acc']]
+  line = ','.join(['%s'] * len(columns)) + '\n'
+  with open(analysisFileName, 'w') as f:
+    f.write(ANALYSIS_COLUMNS)
+    for start in range(0, len(r), 10000):
+      rows = zip(*[map(np.asscalar, c[start:start + 10000])
+                   for c in columns])
+      f.write(''.join([line % row for row in rows]))
+
+
+class TrackResultsBlock(object):
+  '''
+  Tracking results read from a tracking results file, with the same
+  attributes as the `TrackResults` objects of the pickled files.
+  '''
+
+  def __init__(self, records, prn, signal):
+    for name in records.dtype.names:
+      setattr(self, name, records[name])
+    self.prn = prn
+    self.signal = signal
+    self.status = records['status'][0] if len(records) else '-'
+    self.IF = records['IF'][0] if len(records) else 0
+
+
+class ResultsLoadObject(object):
+  '''
+  Container type for tracking results file loading. Iterates over blocks of
+  consecutive records with the same status and IF.
+  '''
+
+  def __init__(self, fileName, prn, signal):
+    self.fileName = fileName
+    self.prn = prn
+    self.signal = signal
+
+  def __iter__(self):
+    records = loadTrackingResults(self.fileName)
+    if len(records) == 0:
+      return iter([])
+    status = records['status']
+    IF = records['IF']
+    starts = np.flatnonzero((status[1:] != status[:-1]) |
+                            (IF[1:] != IF[:-1])) + 1
+    bounds = [0] + list(starts) + [len(records)]
+    return iter([TrackResultsBlock(records[a:b], self.prn, self.signal)
+                 for a, b in zip(bounds[:-1], bounds[1:])])
+
+
+def searchTrackingResults(records, column, values):
+  '''
+  Finds the first tracking results at or after given values of a column.
+
+  Tracking results are appended in sample order, so the `absolute_sample`
+  and `ms_tracked` columns of a channel are sorted and serve as its index.
+  The column is bisected element by element, so only a few pages of a
+  memory-mapped file are read for each value.
+
+  Parameters
+  ----------
+  records : numpy.ndarray
+    Tracking results of one channel.
+  column : string
+    Name of a sorted column, e.g. 'absolute_sample' or 'ms_tracked'.
+  values : array-like
+    Values to look up.
+
+  Returns
+  -------
+  numpy.ndarray
+    For each value, the index of the first record whose column is not less
+    than the value, or `len(records)`.
+  '''
+  keys = records[column]
+  return np.array([bisect.bisect_left(keys, v) for v in values],
+                  dtype=np.int64)
+
+
+def loadChannelRecords(outputEntry):
+  '''
+  Loads the tracking results of a channel as records.
+
+  Parameters
+  ----------
+  outputEntry : dict
+    Tracking channel entry from :func:`collectTrackingOutputFileEntries`.
+
+  Returns
+  -------
+  numpy.ndarray
+    The records, as returned by :func:`loadTrackingResults`. Pickled
+    results are read in full and converted, and give `None` when empty.
+  '''
+  fileName = outputEntry['filename']
+  if isTrackingResultsFile(fileName):
+    return loadTrackingResults(fileName)
+  blocks = [block.records(len(block.absolute_sample))
+            for block in PickleLoadObject(fileName)]
+  return np.concatenate(blocks) if blocks else None
+
+
+def loadObject(outputEntry):
+  '''
+  Opens the tracking results of a channel, as an iterable of blocks of
+  results.
+
+  Parameters
+  ----------
+  outputEntry : dict
+    Tracking channel entry from :func:`collectTrackingOutputFileEntries`.
+  '''
+  fileName = outputEntry['filename']
+  if isTrackingResultsFile(fileName):
+    return ResultsLoadObject(fileName, outputEntry['prn'] - 1,
+                             outputEntry['band'])
+  return PickleLoadObject(fileName)
+
+
 class PickleLoadObject(object):
   '''
   Container type for pickle object loading
@@ -236,7 +625,7 @@ class TrackingResults(object):
 
     def __init__(self, outputEntry):
       self.outputEntry = copy.deepcopy(outputEntry)
-      fileObj = PickleLoadObject(outputEntry['filename'])
+      fileObj = loadObject(outputEntry)
       self.blockObj = TrackResultFile(fileObj)
 
     def __iter__(self):
@@ -250,43 +639,27 @@ class TrackingResults(object):
     class It(object):
 
       def __init__(self, outputEntries):
-        self.outputEntries = copy.deepcopy(outputEntries)
-        for fileEntry in self.outputEntries:
-          fileObj = PickleLoadObject(fileEntry['filename'])
-          blockObj = TrackResultFile(fileObj)
-          fileEntry['nextResultIt'] = iter(blockObj)
-          fileEntry['resultObj'] = None
+        # Heap of the next result of each channel, ordered by sample index
+        # and then by channel number.
+        self.heap = []
+        for n, fileEntry in enumerate(outputEntries):
+          fileObj = loadObject(fileEntry)
+          self._push(n, iter(TrackResultFile(fileObj)))
+
+      def _push(self, n, resultIt):
+        try:
+          trackResult, idx = resultIt.next()
+        except StopIteration:
+          return
+        heapq.heappush(self.heap, (trackResult.absolute_sample[idx], n,
+                                   (trackResult, idx), resultIt))
 
       def next(self):
-        minIndex = long(1e12)
-        minResultObj = None
-        minEntry = None
-        for fileEntry in self.outputEntries:
-          nextResultIt = fileEntry['nextResultIt']
-          resultObj = fileEntry['resultObj']
-          if nextResultIt is not None and resultObj is None:
-            try:
-              resultObj = nextResultIt.next()
-              fileEntry['resultObj'] = resultObj
-            except StopIteration:
-              resultObj = None
-              fileEntry['nextResultIt'] = None
-              continue
-
-          if resultObj is not None:
-            trackResult, idx = resultObj
-            sampleIndex = trackResult.absolute_sample[idx]
-
-            if sampleIndex < minIndex:
-              minIndex = sampleIndex
-              minResultObj = resultObj
-              minEntry = fileEntry
-
-        if minResultObj is not None:
-          minEntry['resultObj'] = None
-          return minResultObj
-        else:
+        if not self.heap:
           raise StopIteration
+        _, n, resultObj, resultIt = heapq.heappop(self.heap)
+        self._push(n, resultIt)
+        return resultObj
 
     def __init__(self, entries):
       self.entries = entries
@@ -348,6 +721,76 @@ class TrackingResults(object):
     '''
     return TrackingResults.SingleChannel(self.entries[entryIdx])
 
+  def channelRecords(self, entryIdx):
+    '''
+    Queries the records of one tracking channel according to channel index
+    number.
+
+    Parameters
+    ----------
+    entryIdx : int
+      Channel index number
+
+    Returns
+    -------
+    numpy.ndarray
+      Records of the channel, see :func:`loadChannelRecords`
+    '''
+    return loadChannelRecords(self.entries[entryIdx])
+
+  def window(self, start=None, stop=None, column='absolute_sample',
+             fields=None):
+    '''
+    Queries the data from all tracking channels in a window of samples or
+    milliseconds, combined according to sample index number.
+
+    Parameters
+    ----------
+    start : number, optional
+      First value of the window, inclusive. Default is the start of the
+      tracking results.
+    stop : number, optional
+      Last value of the window, exclusive. Default is the end of the
+      tracking results.
+    column : string, optional
+      Column the window applies to, 'absolute_sample' (default) or
+      'ms_tracked'.
+    fields : list, optional
+      Fields to return. Default is all the fields of the records.
+
+    Returns
+    -------
+    numpy.ndarray
+      Records of the window, with a 'channel' field holding the channel
+      index number. Records are ordered by sample index, and records of
+      the same sample index by channel index number.
+    '''
+    parts = []
+    for n in range(len(self.entries)):
+      records = self.channelRecords(n)
+      if records is None or len(records) == 0:
+        continue
+      lo = 0 if start is None else \
+          searchTrackingResults(records, column, [start])[0]
+      hi = len(records) if stop is None else \
+          searchTrackingResults(records, column, [stop])[0]
+      parts.append((n, records[lo:hi]))
+
+    if not parts:
+      return np.zeros(0, dtype=[('channel', np.int32)])
+    if fields is None:
+      fields = parts[0][1].dtype.names
+    dtype = [('channel', np.int32)] + \
+        [(name, parts[0][1].dtype[name]) for name in fields]
+    keys = np.concatenate([r['absolute_sample'] for _, r in parts])
+    order = np.argsort(keys, kind='mergesort')
+    result = np.empty(len(keys), dtype=dtype)
+    result['channel'] = np.concatenate([np.full(len(r), n, dtype=np.int32)
+                                        for n, r in parts])[order]
+    for name in fields:
+      result[name] = np.concatenate([r[name] for _, r in parts])[order]
+    return result
+
   def dump(self, dest=sys.stdout):
     '''
     Produces textual output of the combined tracking data into destination
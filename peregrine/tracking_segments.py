@@ -0,0 +1,381 @@
+# Copyright (C) 2016 Swift Navigation Inc.
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+"""
+The :mod:`peregrine.tracking_segments` module tracks a sample file as time
+segments on many CPUs.
+
+The file is split into segments that overlap their predecessor by some time.
+Each segment is seeded by re-acquiring the satellites at its start, and is
+tracked by its own :class:`peregrine.tracking.Tracker` in a worker process.
+The tracking results of the segments are then stitched into the tracking
+results files of the whole file, using the overlaps to carry the accumulated
+carrier phase, the data bit polarity and the time of week over from one
+segment to the next.
+
+"""
+
+import os
+import logging
+import multiprocessing as mp
+import numpy as np
+
+from peregrine import gps_constants
+from peregrine import parallel_processing as pp
+from peregrine.acquisition import Acquisition, AcquisitionResult
+from peregrine.samples import load_samples, auto_batch_size, SampleLoader
+from peregrine.samples import MIN_BATCH_SIZE, _samples_total
+from peregrine.tracking import Tracker
+from peregrine.tracking_file_utils import appendTrackingResults
+from peregrine.tracking_file_utils import collectTrackingOutputFileEntries
+from peregrine.tracking_file_utils import createTrackingOutputFileNames
+from peregrine.tracking_file_utils import exportTrackingAnalysis
+from peregrine.tracking_file_utils import loadTrackingResults
+from peregrine.tracking_file_utils import removeTrackingOutputFiles
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['track_segments', 'plan_segments', 'seed_segments',
+           'stitch_segments']
+
+DEFAULT_SEGMENT_OVERLAP_MS = 2000.
+"""Default time tracked by a segment before its results are used, for its
+tracking loops to lock and its bit sync to settle [ms]."""
+
+
+def plan_segments(sample_index, samples_total, n_segments):
+  """
+  Split the samples to track into segments of equal length.
+
+  Parameters
+  ----------
+  sample_index : int
+    Index of the first sample to track.
+  samples_total : int
+    Index of the end of the samples to track.
+  n_segments : int
+    Number of segments.
+
+  Returns
+  -------
+  out : list
+    The `n_segments + 1` boundaries of the segments, from `sample_index` to
+    `samples_total`.
+
+  """
+  bounds = np.linspace(sample_index, samples_total, n_segments + 1)
+  return [int(b) for b in bounds]
+
+
+def seed_segments(filename, file_format, freq_profile, starts, acq_results,
+                  threshold=None):
+  """
+  Re-acquire the satellites at the start of each segment.
+
+  The satellites are searched around the Doppler of their latest acquisition,
+  starting from `acq_results`.
+
+  Parameters
+  ----------
+  filename : string
+    Sample data file name.
+  file_format : string
+    Format of the sample data file.
+  freq_profile : dictionary
+    Frequency profile of the samples.
+  starts : list
+    Sample indices of the segment starts.
+  acq_results : list
+    Acquisition results of the satellites to track.
+  threshold : float, optional
+    Acquisition threshold, see
+    :meth:`peregrine.acquisition.Acquisition.reacquisition`.
+
+  Returns
+  -------
+  out : list
+    For each segment, the acquisition results of the satellites re-acquired
+    at its start, with sample indices relative to the segment start.
+
+  """
+  kwargs = {} if threshold is None else {'threshold': threshold}
+  acq_results = [acq for acq in acq_results
+                 if acq.status == 'A' and acq.signal == gps_constants.L1CA]
+  prns = [acq.prn for acq in acq_results]
+  dopplers = [acq.doppler for acq in acq_results]
+  samples_per_code = int(round(freq_profile['sampling_freq'] *
+                               gps_constants.l1ca_code_period))
+  acq = None
+  seeds = []
+  for start in starts:
+    samples = {gps_constants.L1CA: {'IF': freq_profile['GPS_L1_IF']},
+               gps_constants.L2C: {'IF': freq_profile['GPS_L2_IF']},
+               'samples_total': -1,
+               'sample_index': start}
+    load_samples(samples=samples, filename=filename,
+                 num_samples=11 * samples_per_code, file_format=file_format)
+    signal = samples[gps_constants.L1CA]['samples']
+    if acq is None:
+      acq = Acquisition(gps_constants.L1CA, signal,
+                        freq_profile['sampling_freq'],
+                        freq_profile['GPS_L1_IF'],
+                        samples_per_code,
+                        gps_constants.l1ca_code_length,
+                        batched=True)
+    acq.init_samples(signal, start)
+    results = acq.reacquisition(prns, dopplers, multi=False, **kwargs)
+
+    seed = []
+    for n, res in enumerate(results):
+      if res.status != 'A':
+        continue
+      dopplers[n] = res.doppler
+      seed.append(AcquisitionResult(res.prn, res.carr_freq, res.doppler,
+                                    res.code_phase, res.snr, res.status,
+                                    res.signal, 0))
+    logger.info("Segment at sample index %d: re-acquired PRNs %s" %
+                (start, [res.prn + 1 for res in seed]))
+    seeds.append(seed)
+  return seeds
+
+
+def _segment_output_file(output_file, n):
+  """
+  Output file name template of the tracking results of segment `n`.
+
+  """
+  base, ext = os.path.splitext(output_file)
+  return base + '.seg%03d' % n + ext
+
+
+def _track_segment(task):
+  """
+  Track one segment in a worker process, returning its tracking results
+  file names.
+
+  """
+  (filename, file_format, freq_profile, batch_size, start, stop, acqs,
+   output_file, tracker_args) = task
+  samples_total = start + _samples_total(filename, file_format, start)
+  samples = {gps_constants.L1CA: {'IF': freq_profile['GPS_L1_IF']},
+             gps_constants.L2C: {'IF': freq_profile['GPS_L2_IF']},
+             'samples_total': samples_total,
+             'sample_index': start}
+  with SampleLoader(filename, file_format, batch_size=batch_size) as loader:
+    loader.load(samples)
+    # Channels track until their sample index reaches `samples_to_track`.
+    tracker = Tracker(samples=samples,
+                      channels=acqs,
+                      ms_to_track=stop * 1e3 / freq_profile['sampling_freq'],
+                      sampling_freq=freq_profile['sampling_freq'],
+                      output_file=output_file,
+                      analysis_output=False,
+                      **tracker_args)
+    tracker.start()
+    while True:
+      sample_index = tracker.run_channels(samples)
+      if sample_index == samples['sample_index']:
+        break
+      samples['sample_index'] = sample_index
+      loader.load(samples)
+  return tracker.stop()
+
+
+def _align(prev, records, boundary, overlap):
+  """
+  Make the tracking results of a segment continue the ones of the previous
+  segment, comparing them over the second half of their overlap.
+
+  The data bit polarity of the segment is flipped if its prompt correlations
+  are opposite to the previous ones, its accumulated carrier and code phases
+  are offset by the cycles and chips accumulated by the previous segment
+  before it started, and its unknown time of week is continued from the last
+  one known in the previous segment.
+
+  """
+  ps = prev['absolute_sample']
+  ns = records['absolute_sample']
+  window = (ns >= boundary - overlap // 2) & (ns < boundary) & \
+      (ns >= ps[0]) & (ns <= ps[-1])
+  if window.any():
+    ns_w = ns[window]
+    # Nearest epoch of the previous segment
+    j = np.clip(np.searchsorted(ps, ns_w), 1, len(ps) - 1)
+    j -= (ns_w - ps[j - 1]) < (ps[j] - ns_w)
+    if np.sum((records['P'][window] * np.conj(prev['P'][j])).real) < 0:
+      for name in ('E', 'P', 'L'):
+        records[name] = -records[name]
+    # Offsets at the last epoch before the boundary
+    last = np.flatnonzero(window)[-1]
+    for name in ('carr_phase_acc', 'code_phase_acc'):
+      records[name] += np.interp(ns[last], ps, prev[name]) - \
+          records[name][last]
+
+  known = np.flatnonzero(~np.isnan(prev['tow']) & (ps < boundary))
+  if len(known):
+    i = known[-1]
+    unknown = np.isnan(records['tow'])
+    records['tow'][unknown] = records['ms_tracked'][unknown] + \
+        (prev['tow'][i] - prev['ms_tracked'][i])
+
+
+def stitch_segments(segment_files, output_file, boundaries, overlap):
+  """
+  Stitch the tracking results of the segments into the tracking results
+  files of `output_file`.
+
+  Segment `n` contributes its results from `boundaries[n]`, or from the
+  last epoch taken from the previous segments, to `boundaries[n + 1]`; its
+  results before `boundaries[n]` overlap the previous segment and are used
+  to align it, see :func:`_align`.
+
+  Parameters
+  ----------
+  segment_files : list
+    Output file name templates of the segments.
+  output_file : string
+    Output file name template of the stitched tracking results.
+  boundaries : list
+    Segment boundaries, see :func:`plan_segments`.
+  overlap : int
+    Number of samples of the overlaps.
+
+  Returns
+  -------
+  out : list
+    Stitched tracking results file names.
+
+  """
+  channels = {}
+  for n, segment_file in enumerate(segment_files):
+    for entry in collectTrackingOutputFileEntries(segment_file):
+      key = (entry['prn'], entry['band'])
+      channels.setdefault(key, [None] * len(segment_files))[n] = \
+          entry['filename']
+
+  fn_results = []
+  for (prn, band), files in sorted(channels.iteritems()):
+    _, fn = createTrackingOutputFileNames(output_file, prn, band)
+    prev = None
+    count = 0
+    for n, segment in enumerate(files):
+      if segment is None:
+        prev = None
+        continue
+      records = np.array(loadTrackingResults(segment))
+      if len(records) == 0:
+        prev = None
+        continue
+      if prev is not None:
+        _align(prev, records, boundaries[n], overlap)
+      lo, hi = np.searchsorted(records['absolute_sample'],
+                               boundaries[n:n + 2])
+      if n == 0:
+        lo = 0
+      elif count:
+        # Continue after the last epoch taken, which the segment tracked
+        # too when it is just before the boundary.
+        lo = np.searchsorted(records['ms_tracked'], last_ms + .5)
+      if n == len(files) - 1:
+        hi = len(records)
+      hi = max(hi, lo)
+      appendTrackingResults(fn, records[lo:hi], create=count == 0)
+      count += hi - lo
+      if hi > lo:
+        last_ms = records['ms_tracked'][hi - 1]
+      prev = records
+    fn_results.append(fn)
+  return fn_results
+
+
+def track_segments(filename, file_format, freq_profile, acq_results,
+                   n_segments, sample_index=0, ms_to_track=-1,
+                   overlap_ms=DEFAULT_SEGMENT_OVERLAP_MS, output_file=None,
+                   batch_size=None, nprocs=None, analysis_output=True,
+                   **tracker_args):
+  """
+  Track a sample file as time segments in parallel.
+
+  Parameters
+  ----------
+  filename : string
+    Sample data file name.
+  file_format : string
+    Format of the sample data file.
+  freq_profile : dictionary
+    Frequency profile of the samples.
+  acq_results : list
+    Acquisition results at `sample_index`, which seed the first segment.
+  n_segments : int
+    Number of segments.
+  sample_index : int, optional
+    Index of the first sample to track.
+  ms_to_track : float, optional
+    Milliseconds to track from the start of the file, -1 for the whole file.
+  overlap_ms : float, optional
+    Time by which a segment starts before the previous one ends [ms].
+  output_file : string, optional
+    Output file name template, `filename` by default.
+  batch_size : int, optional
+    Samples per batch of each segment, by default chosen for the available
+    memory shared by the worker processes.
+  nprocs : int, optional
+    Number of worker processes, the number of CPUs by default.
+  analysis_output : bool, optional
+    Write the CSV tracking analysis files.
+  tracker_args : dictionary
+    Other parameters of :class:`peregrine.tracking.Tracker`.
+
+  Returns
+  -------
+  out : list
+    Tracking results file names.
+
+  """
+  if output_file is None:
+    output_file = filename
+  if nprocs is None:
+    nprocs = mp.cpu_count()
+  fs = freq_profile['sampling_freq']
+  samples_total = sample_index + _samples_total(filename, file_format,
+                                                sample_index)
+  if ms_to_track >= 0:
+    samples_total = min(samples_total, int(ms_to_track * fs / 1e3))
+  overlap = int(overlap_ms * fs / 1e3)
+  boundaries = plan_segments(sample_index, samples_total, n_segments)
+  starts = [boundaries[0]] + [max(b - overlap, sample_index)
+                              for b in boundaries[1:-1]]
+
+  seeds = [list(acq_results)] + \
+      seed_segments(filename, file_format, freq_profile, starts[1:],
+                    acq_results)
+
+  if batch_size is None:
+    batch_size = max(auto_batch_size(filename, file_format) // nprocs,
+                     MIN_BATCH_SIZE)
+  segment_files = [_segment_output_file(output_file, n)
+                   for n in range(n_segments)]
+  tasks = [(filename, file_format, freq_profile, batch_size, start, stop,
+            seed, segment_file, tracker_args)
+           for start, stop, seed, segment_file in zip(starts, boundaries[1:],
+                                                      seeds, segment_files)]
+  logger.info("Tracking %d segments of %d samples on %d processes" %
+              (n_segments, boundaries[1] - boundaries[0], nprocs))
+  with pp.WorkerPool(_track_segment, nprocs) as pool:
+    pool.map(tasks)
+
+  fn_results = stitch_segments(segment_files, output_file, boundaries,
+                               overlap)
+  for segment_file in segment_files:
+    removeTrackingOutputFiles(segment_file)
+  if analysis_output:
+    for entry in collectTrackingOutputFileEntries(output_file):
+      if entry['filename'] in fn_results:
+        exportTrackingAnalysis(entry['filename'], entry['filename2'])
+  return fn_results
@@ -13,13 +13,46 @@ from test_common import generate_sample_file, \
                         get_sampling_freq
 
 import os
+import pytest
+import numpy as np
 import peregrine.acquisition as acq
+import peregrine.defaults as defaults
+import peregrine.gps_constants as gps
+from peregrine.include.generateCAcode import caCodes
+from peregrine.samples import load_sample_blocks, save_samples
 
 
 def get_acq_result_file_name(sample_file):
   return sample_file + '.acq_results'
 
 
+def make_acq_samples(prn, doppler, code_phase, n_ms=11, snr_db=-15,
+                     freq_profile=defaults.freq_profile_low_rate):
+  """
+  Synthesize real IF samples of one L1 C/A signal in white Gaussian noise.
+  """
+  fs = freq_profile['sampling_freq']
+  n = int(round(n_ms * 1e-3 * fs))
+  t = np.arange(n) / fs
+  chips = np.floor(gps.l1ca_chip_rate * t - code_phase).astype(int)
+  code = caCodes[prn][chips % gps.l1ca_code_length]
+  carrier = np.cos(2 * np.pi * (freq_profile['GPS_L1_IF'] + doppler) * t)
+  amplitude = np.sqrt(2 * 10 ** (snr_db / 10.))
+  np.random.seed(prn)
+  return amplitude * code * carrier + np.random.randn(n)
+
+
+def make_acquisition(samples, freq_profile=defaults.freq_profile_low_rate,
+                     wisdom_file=None, **kwargs):
+  return acq.Acquisition(gps.L1CA, samples,
+                         freq_profile['sampling_freq'],
+                         freq_profile['GPS_L1_IF'],
+                         gps.l1ca_code_period * freq_profile['sampling_freq'],
+                         gps.l1ca_code_length,
+                         wisdom_file=wisdom_file,
+                         **kwargs)
+
+
 def run_acq_test(init_doppler, init_code_phase,
                  prns, file_format,
                  freq_profile='low_rate',
@@ -124,3 +157,390 @@ def test_skip_params():
   """
   run_acq_test(1000, 0, [1], '1bit', skip_samples=1000)
   run_acq_test(1000, 0, [1], '1bit', skip_ms=50)
+
+
+@pytest.mark.parametrize('freq_profile', [
+    defaults.freq_profile_low_rate,
+    # Integer number of samples per code, so the decimated path is used.
+    {'sampling_freq': 2.046e6, 'GPS_L1_IF': 0.5e6},
+])
+def test_acquire_batched(freq_profile):
+  """
+  Test batched correlation matches the per-bin computation
+  """
+  samples = make_acq_samples(4, 1200., 300., freq_profile=freq_profile)
+  serial = make_acquisition(samples, freq_profile=freq_profile)
+  batched = make_acquisition(samples, freq_profile=freq_profile, batched=True,
+                             batch_bytes=5 * 4 * 2 * 16 * serial.n_integrate)
+  freqs = np.arange(-7000, 7000, 250.) + serial.IF
+
+  expected = serial.acquire(caCodes[4], freqs)
+  result = batched.acquire(caCodes[4], freqs)
+  assert result.shape == expected.shape
+  assert np.allclose(result, expected, rtol=1e-9, atol=1e-6 * expected.max())
+
+  code_phase, freq, snr = batched.find_peak(freqs, result)
+  assert abs(freq - serial.IF - 1200.) < 100.
+  assert abs(code_phase - 300.) < 1.5
+
+
+def test_acquisition_pool():
+  """
+  Test the worker pool gives the same results as a serial search, also after
+  the samples are replaced
+  """
+  prns = [3, 4, 9]
+  serial = make_acquisition(make_acq_samples(4, 1200., 300.))
+  pooled = make_acquisition(make_acq_samples(4, 1200., 300.), batched=True)
+  pooled.start_pool(nprocs=2)
+  try:
+    for prn, doppler, code_phase in [(4, 1200., 300.), (9, -2500., 700.)]:
+      samples = make_acq_samples(prn, doppler, code_phase)
+      serial.init_samples(samples)
+      pooled.init_samples(samples)
+      expected = serial.acquisition(prns, multi=False)
+      result = pooled.acquisition(prns)
+      for r, e in zip(result, expected):
+        assert r.prn == e.prn
+        assert r.status == e.status
+        assert np.isclose(r.doppler, e.doppler)
+        assert np.isclose(r.code_phase, e.code_phase)
+        assert np.isclose(r.snr, e.snr)
+      assert [r.prn for r in result if r.status == 'A'] == [prn]
+  finally:
+    pooled.stop_pool()
+  assert pooled.pool is None
+
+
+def test_acquisition_pool_pfs():
+  """
+  Test the pool workers search the current samples with the parallel
+  frequency search after the samples are replaced
+  """
+  serial = make_acquisition(make_acq_samples(4, 1200., 300.))
+  pooled = make_acquisition(make_acq_samples(4, 1200., 300.))
+  pooled.start_pool(nprocs=2)
+  try:
+    samples = make_acq_samples(9, -2500., 700.)
+    serial.init_samples(samples)
+    pooled.init_samples(samples)
+    kwargs = dict(doppler_priors=[-2500.] * 2, doppler_search=300.,
+                  code_phase_priors=[700.] * 2, strategy='pfs')
+    expected = serial.acquisition([4, 9], multi=False, **kwargs)
+    result = pooled.acquisition([4, 9], **kwargs)
+    for r, e in zip(result, expected):
+      assert r.status == e.status
+      assert np.isclose(r.doppler, e.doppler)
+      assert np.isclose(r.code_phase, e.code_phase)
+      assert np.isclose(r.snr, e.snr)
+    assert [r.prn for r in result if r.status == 'A'] == [9]
+  finally:
+    pooled.stop_pool()
+
+
+@pytest.mark.parametrize('strategy', ['pcs', 'pfs'])
+def test_acquisition_pool_codes(strategy):
+  """
+  Test the pool workers search the code family the pool was started with
+  """
+  from peregrine.include.generateGLOcode import GLOCode
+  fs = defaults.freq_profile_low_rate['sampling_freq']
+  IF = defaults.freq_profile_low_rate['GPS_L1_IF']
+  t = np.arange(int(round(11e-3 * fs))) / fs
+  chips = np.floor(511e3 * t - 100.).astype(int)
+  carrier = np.cos(2 * np.pi * (IF - 1500.) * t)
+  np.random.seed(0)
+  samples = 0.5 * GLOCode[chips % 511] * carrier + np.random.randn(len(t))
+
+  pooled = acq.Acquisition(gps.L1CA, samples, fs, IF, 1e-3 * fs, 511)
+  pooled.start_pool('glo', nprocs=2)
+  try:
+    result, = pooled.acquisition([0], strategy=strategy,
+                                 code_phase_priors=[100.])
+  finally:
+    pooled.stop_pool()
+  assert result.status == 'A'
+  assert abs(result.doppler + 1500.) < 100.
+  assert abs(result.code_phase - 100.) < 1.
+
+
+def test_code_spectra_cache(tmpdir):
+  """
+  Test code spectra are saved next to the wisdom file and memory-mapped
+  """
+  wisdom_file = str(tmpdir.join('fftw_wisdom'))
+  samples = make_acq_samples(4, 1200., 300.)
+  first = make_acquisition(samples, wisdom_file=wisdom_file)
+  spectra = first.code_spectra()
+  assert spectra.shape == (len(caCodes), first.n_integrate)
+  assert first.code_spectra() is spectra
+  assert len(tmpdir.listdir('code_spectra_*')) == 1
+
+  second = make_acquisition(samples, wisdom_file=wisdom_file)
+  cached = second.code_spectra()
+  assert isinstance(cached, np.memmap)
+  assert np.array_equal(cached, spectra)
+  assert np.allclose(cached[7], second.code_spectrum(caCodes[7]))
+
+  # Other frequency profiles get their own file
+  third = make_acquisition(samples, wisdom_file=wisdom_file,
+                           n_codes_integrate=2)
+  assert third.code_spectra().shape == (len(caCodes), third.n_integrate)
+  assert len(tmpdir.listdir('code_spectra_*')) == 2
+
+  with pytest.raises(ValueError):
+    first.code_spectra('l2cm')
+
+
+def test_acquisition_coarse():
+  """
+  Test the coarse pass drops absent PRNs and keeps the fine estimates
+  """
+  prns = range(8)
+  samples = make_acq_samples(4, 1200., 300., snr_db=-10)
+  full = make_acquisition(samples, batched=True)
+  coarse = make_acquisition(samples, batched=True)
+  fine_searches = []
+  correlate = coarse.correlate
+
+  def counting_correlate(code_ft_conj, freqs, *args, **kwargs):
+    fine_searches.append(len(freqs))
+    return correlate(code_ft_conj, freqs, *args, **kwargs)
+  coarse.correlate = counting_correlate
+
+  expected = full.acquisition(prns, multi=False)
+  result = coarse.acquisition(prns, multi=False, coarse_threshold=12.)
+
+  assert [r.status for r in result] == [e.status for e in expected]
+  assert [r.prn for r in result if r.status == 'A'] == [4]
+  assert np.isclose(result[4].doppler, expected[4].doppler)
+  assert np.isclose(result[4].code_phase, expected[4].code_phase)
+  # Only PRN 4 got the fine search, over a few bins around the peak
+  assert len(fine_searches) == 1
+  assert fine_searches[0] <= 11
+
+
+@pytest.mark.parametrize('coarse_ms', [None, acq.DEFAULT_COARSE_MS])
+def test_acquisition_pool_coarse(coarse_ms):
+  """
+  Test the pool workers run the coarse pass on the current samples, also
+  when the coarse acquisition is created after the pool
+  """
+  prns = range(8)
+  serial = make_acquisition(make_acq_samples(9, -2500., 700., snr_db=-10))
+  pooled = make_acquisition(make_acq_samples(9, -2500., 700., snr_db=-10))
+  pooled.start_pool(nprocs=2, coarse_ms=coarse_ms)
+  try:
+    samples = make_acq_samples(4, 1200., 300., snr_db=-10)
+    serial.init_samples(samples)
+    pooled.init_samples(samples)
+    expected = serial.acquisition(prns, multi=False, coarse_threshold=12.)
+
+    # The parent does not correlate anything itself, calls in the workers
+    # are recorded in their own copy of the list
+    parent_calls = []
+    coarse_acq = pooled.coarse_acquisition()
+    for a in (pooled, coarse_acq):
+      def recording_correlate(code_ft_conj, freqs, correlate=a.correlate,
+                              **kwargs):
+        parent_calls.append(len(freqs))
+        return correlate(code_ft_conj, freqs, **kwargs)
+      a.correlate = recording_correlate
+    result = pooled.acquisition(prns, coarse_threshold=12.)
+    assert parent_calls == []
+  finally:
+    pooled.stop_pool()
+
+  assert coarse_acq.samples_shared is False
+  for r, e in zip(result, expected):
+    assert r.status == e.status
+    assert np.isclose(r.doppler, e.doppler)
+    assert np.isclose(r.code_phase, e.code_phase)
+    assert np.isclose(r.snr, e.snr)
+  assert [r.prn for r in result if r.status == 'A'] == [4]
+
+
+@pytest.mark.parametrize('batched', [False, True])
+def test_acquire_single_precision(batched):
+  """
+  Test single precision correlation matches double precision
+  """
+  samples = make_acq_samples(4, 1200., 300., snr_db=-20)
+  double = make_acquisition(samples, batched=batched)
+  single = make_acquisition(samples, batched=batched, precision='single')
+  freqs = np.arange(-7000, 7000, 250.) + double.IF
+
+  expected = double.acquire(caCodes[4], freqs)
+  result = single.acquire(caCodes[4], freqs)
+  assert result.dtype == np.float32
+  assert np.allclose(result, expected, rtol=1e-3, atol=1e-4 * expected.max())
+
+  code_phase, freq, snr = double.find_peak(freqs, expected)
+  code_phase_s, freq_s, snr_s = single.find_peak(freqs, result)
+  assert code_phase_s == code_phase
+  assert abs(freq_s - freq) < 0.1
+  assert abs(snr_s - snr) < 1e-3 * snr
+
+  with pytest.raises(ValueError):
+    make_acquisition(samples, precision='half')
+
+
+@pytest.mark.parametrize('freq_profile, n_codes_integrate', [
+    (defaults.freq_profile_low_rate, 4),
+    # Odd number of samples
+    ({'sampling_freq': 2.045e6, 'GPS_L1_IF': 0.5e6}, 3),
+])
+def test_init_samples_real(freq_profile, n_codes_integrate):
+  """
+  Test the spectra of real samples match those computed as complex samples
+  """
+  samples = make_acq_samples(4, 1200., 300., freq_profile=freq_profile)
+  real = make_acquisition(samples, freq_profile=freq_profile,
+                          n_codes_integrate=n_codes_integrate)
+  cplx = make_acquisition(samples.astype(np.complex128),
+                          freq_profile=freq_profile,
+                          n_codes_integrate=n_codes_integrate)
+  assert real.n_integrate % 2 == n_codes_integrate % 2
+  assert np.allclose(real.short_samples_ft2, cplx.short_samples_ft2)
+  assert np.allclose(real.short_samples_ft,
+                     [np.fft.fft(s) for s in real.short_samples])
+
+
+def test_noncoherent_acquisition(tmpdir):
+  """
+  Test a weak signal missed by a coherent search is found by summing blocks
+  streamed from a sample file
+  """
+  samples = make_acq_samples(4, 1200., 300., n_ms=40, snr_db=-27)
+  coherent = make_acquisition(samples[:11 * 2484])
+  result = coherent.acquisition(range(8), multi=False)
+  assert [r.prn for r in result if r.status == 'A'] == []
+
+  filename = str(tmpdir.join('weak.int8'))
+  save_samples(filename, np.clip(np.round(samples * 16), -127, 127), 'int8')
+  noncoherent = make_acquisition(None, offsets=[0])
+  blocks = load_sample_blocks(filename, noncoherent.n_integrate,
+                              file_format='int8')
+  result = noncoherent.noncoherent_acquisition(blocks, range(8), threshold=4.)
+  assert [r.prn for r in result if r.status == 'A'] == [4]
+  assert abs(result[4].doppler - 1200.) < 50.
+  assert abs(result[4].code_phase - 300.) < 1.5
+
+  with pytest.raises(ValueError):
+    noncoherent.noncoherent_acquisition([samples[:100]], range(8))
+
+
+def test_correlate_pfs():
+  """
+  Test the parallel frequency search matches the code phase search columns
+  """
+  samples = make_acq_samples(4, 1200., 300.)
+  acq = make_acquisition(samples, offsets=[0])
+  freqs = acq.IF + np.arange(900., 1500., 100.)
+  code_phases = np.arange(280, 320)
+  pcs = acq.correlate(acq.code_spectra('l1ca')[4], freqs)[:, code_phases]
+  pfs = acq.correlate_pfs(caCodes[4], freqs, code_phases)
+  assert pfs.shape == pcs.shape
+  assert np.allclose(pfs, pcs, atol=0.05 * pcs.max())
+  assert np.unravel_index(pfs.argmax(), pfs.shape) == \
+      np.unravel_index(pcs.argmax(), pcs.shape)
+
+
+def test_acquisition_strategy():
+  """
+  Test the search strategies agree on a prior window and the cost model
+  favours each where it should
+  """
+  samples = make_acq_samples(4, 1200., 300.)
+  acq = make_acquisition(samples)
+  freqs = acq.IF + np.arange(1000., 1500., 250.)
+  pcs, pfs = acq.search_costs(freqs, 1)
+  assert pfs < pcs
+  pcs, pfs = acq.search_costs(freqs, int(acq.samples_per_code))
+  assert pcs < pfs
+
+  full = acq.acquisition([4], multi=False)[0]
+  results = []
+  for strategy in ('pcs', 'pfs', 'auto'):
+    result = acq.acquisition([3, 4], multi=False, doppler_priors=[1200.] * 2,
+                             doppler_search=300., code_phase_priors=[299.] * 2,
+                             strategy=strategy)
+    assert [r.prn for r in result if r.status == 'A'] == [4]
+    results.append((result[1].doppler, result[1].code_phase))
+    assert abs(result[1].snr - full.snr) < 0.1 * full.snr
+  assert abs(results[0][0] - full.doppler) < 250.
+  assert results[0][1] == full.code_phase
+  assert np.allclose(results[1:], results[0], atol=1e-3)
+
+  with pytest.raises(ValueError):
+    acq.acquisition([4], strategy='none')
+
+
+def test_find_peaks():
+  """
+  Test the vectorized peak search over a stack of PRNs and offsets
+  """
+  samples = make_acq_samples(4, 1200., 300.) + \
+      make_acq_samples(9, -2000., 700., snr_db=-18)
+  acq = make_acquisition(samples)
+  prns = [4, 9, 20]
+  freqs = acq.IF + np.arange(-3000., 3000., 250.)
+  code_spectra = acq.code_spectra('l1ca')
+  cube = np.array([acq.correlate(code_spectra[prn], freqs, all_offsets=True)
+                   for prn in prns])
+  assert cube.shape == (3, len(acq.offsets), len(freqs), acq.samples_per_code)
+
+  code_phase, carr_freq, snr = acq.find_peaks(freqs, cube, k=3)
+  assert code_phase.shape == carr_freq.shape == snr.shape == (3, 3)
+  for n, prn in enumerate(prns):
+    peak = acq.find_peak(freqs, acq.correlate(code_spectra[prn], freqs))
+    assert code_phase[n, 0] == peak[0]
+    assert carr_freq[n, 0] == peak[1]
+    assert np.all(np.diff(snr[n]) <= 0)
+    distance = np.abs(code_phase[n, 0] - code_phase[n, 1:]) % 1023
+    assert np.all(np.minimum(distance, 1023 - distance) >= 1)
+  assert abs(code_phase[0, 0] - 301) < 1.5
+  assert abs(carr_freq[1, 0] - acq.IF + 2000.) < 100.
+  assert snr[2, 0] < 0.5 * snr[1, 0] < 0.5 * snr[0, 0]
+  assert snr[0, 1] < 0.3 * snr[0, 0]
+
+  # A window of code phases centred on a peak holds no other one.
+  peak = int(round(code_phase[0, 0] * acq.samples_per_chip))
+  code_phases = np.arange(peak - 3, peak + 4)
+  window = acq.find_peaks(freqs, cube[:, :, :, code_phases], k=2,
+                          code_phases=code_phases)
+  assert window[0][0, 0] == code_phase[0, 0]
+  assert window[1][0, 0] == carr_freq[0, 0]
+  code_phase, carr_freq, snr = window
+  assert np.isnan(code_phase[0, 1]) and np.isnan(carr_freq[0, 1])
+  assert snr[0, 1] == 0
+
+
+def test_advance_samples():
+  """
+  Test sliding the acquisition window reuses spectra and re-acquires
+  """
+  samples = make_acq_samples(4, 1200., 300., n_ms=20)
+  spc = 2484
+  acq = make_acquisition(samples[:11 * spc])
+  assert acq.offsets == [0, 4 * spc]
+  reused = acq.short_samples_ft[1].copy()
+
+  acq.advance_samples(samples[4 * spc:15 * spc], 4)
+  assert acq.sample_index == 4 * spc
+  assert np.array_equal(acq.short_samples_ft[0], reused)
+  fresh = make_acquisition(samples[4 * spc:15 * spc])
+  assert np.allclose(acq.short_samples_ft, fresh.short_samples_ft)
+
+  acq.advance_samples(samples[7 * spc:18 * spc], 3)
+  assert acq.sample_index == 7 * spc
+  fresh = make_acquisition(samples[7 * spc:18 * spc])
+  assert np.allclose(acq.short_samples_ft, fresh.short_samples_ft)
+
+  result = acq.reacquisition([4, 9], [1100., -2000.], multi=False)
+  assert [r.status for r in result] == ['A', '-']
+  assert [r.sample_index for r in result] == [7 * spc] * 2
+  expected = fresh.acquisition([4], multi=False, doppler_priors=[1100.],
+                               doppler_search=500.)[0]
+  assert result[0].doppler == expected.doppler
+  assert result[0].code_phase == expected.code_phase
@@ -0,0 +1,50 @@
+# Copyright (C) 2016 Swift Navigation Inc.
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+from peregrine import bit_sync
+
+import numpy as np
+
+
+def test_window_sums():
+  """
+  Test sliding sums of correlations
+  """
+  corr = np.arange(1., 6.)
+  assert np.all(bit_sync.window_sums(corr, 2) == [1, 3, 5, 7, 9])
+  assert np.all(bit_sync.window_sums(corr, 2, [7., 10.]) == [11, 3, 5, 7, 9])
+
+
+def test_decode_bits():
+  """
+  Test bit edge search and bit integration over arrays of correlations
+  """
+  rng = np.random.RandomState(0)
+  bits = rng.randint(0, 2, 1000)
+  corr = np.roll(np.repeat(bits * 2. - 1, 20), 7) * 100. + \
+      rng.normal(0, 20, 20000)
+
+  for sync in (bit_sync.match_bit, bit_sync.histogram, bit_sync.match_edge):
+    index, bit_phase_ref, hist = sync(corr)
+    assert 0 <= index < len(corr)
+    assert np.argmax(hist) == bit_phase_ref
+    # The first match ends the bits with the 7th correlation, the others at
+    # the start of the next bit.
+    assert bit_phase_ref == (7 if sync is bit_sync.match_bit else 8)
+    # Nothing is found in the correlations before the bit edges are
+    assert sync(corr[:index])[:2] == (-1, -1)
+
+  ends, decoded = bit_sync.decode_bits(corr)
+  assert np.all(ends % 20 == 6)
+  assert np.all(decoded == bits[(ends + 1) // 20 - 1])
+
+  ends, sums, acc = bit_sync.integrate_bits(np.ones(50), 7, 0, 5.)
+  assert np.all(ends == [6, 26, 46])
+  assert np.all(sums == [12, 20, 20])
+  assert acc == 3
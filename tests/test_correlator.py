@@ -0,0 +1,176 @@
+# Copyright (C) 2016 Swift Navigation Inc.
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+from peregrine.correlator import track_correlate, track_correlate_multi,\
+                                 _replica, PackedCorrelator
+from peregrine.gps_constants import L1CA, L2C
+from peregrine.include.generateCAcode import caCodes
+from peregrine.include.generateL2CMcode import L2CMCodes
+
+import cPickle
+import numpy as np
+
+
+def reference_correlate(samples, chips_to_correlate, code_freq, code_phase,
+                        carr_freq, carr_phase, code, sampling_freq, signal,
+                        quantized=False):
+  """
+  Sample by sample reference correlator, or with `quantized` of samples of
+  values +/-1 and +/-3 and a carrier quantized to its sign.
+  """
+  if signal == L2C:
+    code = np.column_stack((code, np.zeros_like(code))).ravel()
+  code_step = code_freq / sampling_freq
+  carr_step = 2 * np.pi * carr_freq / sampling_freq
+  blksize = int(np.ceil((chips_to_correlate - code_phase) / code_step))
+  blksize = min(blksize, len(samples))
+  t = np.arange(blksize)
+  phase = code_phase + code_step * t
+  carrier = np.exp(-1j * (carr_phase + carr_step * t))
+  if quantized:
+    carrier = np.sign(carrier.real) + 1j * np.sign(carrier.imag)
+  baseband = samples[:blksize] * carrier
+
+  def chips(offset):
+    return code[np.floor(phase + offset).astype(int) % len(code)]
+
+  E = np.sum(baseband * chips(0.5))
+  P = np.sum(baseband * chips(0))
+  L = np.sum(baseband * chips(-0.5))
+  return (E, P, L, blksize,
+          code_phase + blksize * code_step - chips_to_correlate,
+          np.fmod(carr_phase + blksize * carr_step, 2 * np.pi))
+
+
+def test_track_correlate_multi():
+  np.random.seed(0)
+  samples = np.random.randint(-3, 4, 100000).astype(np.int8)
+  fs = 16.368e6
+  requests = [
+      (samples[100:], 1023, 1.023e6 + 1.3, 0.37, 4.1e6, 0.5,
+       caCodes[3], fs, L1CA),
+      (samples[777:], 1023, 1.023e6 - 2.1, -0.2, 4.0e6, 2.5,
+       caCodes[7], fs, L1CA),
+      (samples[5:], 20460, 1.023e6 + 0.4, 0.9, 3.74e6, 1.5,
+       L2CMCodes[3], fs / 4, L2C),
+      (samples[3:], 1023, 1.023e6, 0.1, 4.0e6, 0.1,
+       caCodes[1], fs, L1CA),
+  ]
+
+  results = track_correlate_multi(requests)
+  assert len(results) == len(requests)
+  for request, result in zip(requests, results):
+    expected = reference_correlate(*request)
+    assert result[3] == expected[3]
+    assert np.allclose(result[:3], expected[:3], rtol=1e-9, atol=1e-6)
+    assert np.allclose(result[4:], expected[4:])
+    assert np.allclose(track_correlate(*request), result)
+
+
+def test_track_correlate_epochs():
+  np.random.seed(1)
+  samples = np.random.randint(-3, 4, 400000).astype(np.int8)
+  fs = 16.368e6
+  requests = [
+      (samples[100:], 1023, 1.023e6 + 1.3, 0.37, 4.1e6, 0.5,
+       caCodes[3], fs, L1CA, 20),
+      (samples[5:], 20460, 1.023e6 + 0.4, 0.9, 3.74e6, 1.5,
+       L2CMCodes[3], fs / 4, L2C, 2),
+      # Runs out of samples after three integrations
+      (samples[-50000:], 1023, 1.023e6, 0.1, 4.0e6, 0.1,
+       caCodes[1], fs, L1CA, 5),
+  ]
+
+  results = track_correlate_multi(requests)
+  for request, result in zip(requests, results):
+    # Same as consecutive single integrations
+    args = list(request[:9])
+    expected = []
+    for _ in range(request[9]):
+      single = track_correlate(*args)
+      expected.append(single)
+      args[0] = args[0][single[3]:]
+      args[3] = single[4]
+      args[5] = single[5]
+    E, P, L, blksize = [np.array(x) for x in zip(*expected)[:4]]
+    assert np.all(result[3] == blksize)
+    for x, y in zip(result[:3], (E, P, L)):
+      assert np.allclose(x, y, rtol=1e-9, atol=1e-6)
+    assert np.allclose(result[4:], expected[-1][4:])
+
+  assert np.allclose(track_correlate(*requests[0])[1], results[0][1])
+
+
+def test_replica():
+  replica = _replica(caCodes[3], L1CA)
+  assert replica is _replica(caCodes[3], L1CA)
+  assert np.array_equal(replica, _replica(caCodes[3].copy(), L1CA))
+  assert np.all(replica[1:-1] == np.repeat(caCodes[3], 2))
+  assert replica[0] == caCodes[3][-1] and replica[-1] == caCodes[3][0]
+
+  replica = _replica(L2CMCodes[3], L2C)
+  assert len(replica) == 4 * len(L2CMCodes[3]) + 2
+  assert np.all(replica[1:-1:4] == L2CMCodes[3])
+  assert np.all(replica[3:-1:4] == 0)
+
+
+def test_packed_correlator(tmpdir):
+  np.random.seed(2)
+  samples = np.random.choice(np.array([-3, -1, 1, 3], dtype=np.int8), 200000)
+  fs = 16.368e6
+  # Nominal code rates and code phases on the replica offsets first, where
+  # the replicas are exact.
+  exact = [
+      (samples[100:], 1023, 1.023e6, 0.375, 4.1e6, 0.5,
+       caCodes[3], fs, L1CA),
+      (samples[5:], 20460, 1.023e6, 0.5, 3.74e6, 1.5,
+       L2CMCodes[3], fs / 4, L2C),
+      (samples[3:500], 1023, 1.023e6, 0.125, 4.0e6, 0.1,
+       caCodes[1], fs, L1CA),
+      (np.sign(samples[7:]), 1023, 1.023e6, 0., -4.0e6, 6.,
+       caCodes[31], fs, L1CA),
+  ]
+  # Then samples of the signal correlated, with code Doppler
+  approximate = [
+      (1023, 1.023e6 + 1.3, 0.3137, 4.1e6, 0.5, caCodes[3], fs, L1CA),
+      (20460, 1.023e6 - 0.4, 0.9, 3.74e6, 1.5, L2CMCodes[3], fs / 4, L2C),
+      (1023, 1.023e6 + 2.1, -0.2137, 1.0e6, 0.1, -caCodes[1], 2.484375e6,
+       L1CA),
+  ]
+  for n, request in enumerate(approximate):
+    code = request[5]
+    if request[7] == L2C:
+      code = np.column_stack((code, np.zeros_like(code))).ravel()
+    t = np.arange(100000)
+    chips = np.floor(request[2] + request[1] / request[6] * t).astype(int)
+    x = code[chips % len(code)] * \
+        np.cos(request[4] + 2 * np.pi * request[3] / request[6] * t) + \
+        np.random.randn(len(t))
+    x = np.sign(x) * np.where(np.abs(x) > 1, 3, 1)
+    approximate[n] = (x.astype(np.int8),) + request
+
+  correlator = PackedCorrelator(str(tmpdir))
+  for i, request in enumerate(exact + approximate):
+    result = correlator(*request)
+    expected = reference_correlate(*request, quantized=True)
+    assert result[3] == expected[3]
+    assert np.allclose(result[4:], expected[4:])
+    if i < len(exact):
+      assert np.array_equal(result[:3], expected[:3])
+    else:
+      # Samples at the chip edges may get the neighbouring chips.
+      assert np.allclose(result[:3], expected[:3], rtol=0.01)
+
+  # The replicas of the code families are saved, and loaded by the next
+  # correlator. The custom code is not saved.
+  assert len(tmpdir.listdir('packed_replicas_*')) == 2
+  loaded = cPickle.loads(cPickle.dumps(correlator, -1))
+  assert loaded.families == {}
+  assert np.array_equal(loaded(*exact[0])[:3], correlator(*exact[0])[:3])
+  assert isinstance(loaded.family_replicas(L1CA, fs)[0], np.memmap)
@@ -1,9 +1,11 @@
 from test_acquisition import run_acq_test
 from test_common import generate_piksi_sample_file
-from peregrine.gps_constants import L1CA
-from peregrine.samples import load_samples
+from peregrine.gps_constants import L1CA, L2C
+from peregrine.samples import load_samples, load_sample_blocks, _load_samples
+from peregrine.samples import SampleLoader
 
 import peregrine.defaults as defaults
+import numpy as np
 import os
 
 SAMPLE_FILE_NAME = 'sample_data_in_piksi_format.bin'
@@ -58,5 +60,96 @@ def test_file_formats():
   # clean-up
   os.remove(SAMPLE_FILE_NAME)
 
+
+def test_load_sample_blocks():
+  """
+  Test loading a sample file block by block
+  """
+  val = generate_piksi_sample_file(SAMPLE_FILE_NAME)
+  samples = {
+    'samples_total': -1,
+    'sample_index': 0,
+    L1CA: {}
+  }
+  load_samples(samples, SAMPLE_FILE_NAME, -1, 'piksi')
+  whole = samples[L1CA]['samples']
+
+  block_size = 1000
+  blocks = list(load_sample_blocks(SAMPLE_FILE_NAME, block_size,
+                                   num_skip=10, file_format='piksi'))
+  assert len(blocks) == (len(whole) - 10) // block_size
+  for n, block in enumerate(blocks):
+    start = 10 + n * block_size
+    assert (block == whole[start:start + block_size]).all()
+
+  blocks = list(load_sample_blocks(SAMPLE_FILE_NAME, block_size, num_blocks=3,
+                                   file_format='piksi'))
+  assert len(blocks) == 3
+  # clean-up
+  os.remove(SAMPLE_FILE_NAME)
+
+
+def test_packed_file_formats():
+  """
+  Test decoding of interleaved multi-bit formats against the bit layout
+  """
+  packed = np.random.RandomState(0).randint(0, 256, 1001).astype(np.uint8)
+  packed.tofile(SAMPLE_FILE_NAME)
+  bits = np.unpackbits(packed).astype(int)
+
+  formats = [('1bit_x2', 1, (1, -1), defaults.file_encoding_1bit_x2),
+             ('2bits', 2, (-1, -3, 1, 3), [0]),
+             ('2bits_x2', 2, (-1, -3, 1, 3), defaults.file_encoding_2bits_x2),
+             ('2bits_x4', 2, (-1, -3, 1, 3), defaults.file_encoding_2bits_x4)]
+  for file_format, n_bits, values, channels in formats:
+    # Sample values of every receiver channel, first bit most significant
+    fields = bits.reshape(-1, len(channels), n_bits)
+    codes = fields.dot(1 << np.arange(n_bits)[::-1])
+    for num_skip, num_samples in [(0, -1), (1, 100), (3, -1)]:
+      signal = _load_samples(SAMPLE_FILE_NAME, num_samples, num_skip,
+                             file_format)
+      for rx, channel in enumerate(channels):
+        expected = np.take(values, codes[num_skip:, rx])
+        if num_samples > 0:
+          expected = expected[:len(signal[channel])]
+        assert np.all(signal[channel] == expected)
+  # clean-up
+  os.remove(SAMPLE_FILE_NAME)
+
+
+def test_sample_loader():
+  """
+  Test loading overlapping batches read ahead in the background
+  """
+  np.random.RandomState(1).randint(0, 256, 5000).astype(np.uint8).tofile(
+      SAMPLE_FILE_NAME)
+  whole = _load_samples(SAMPLE_FILE_NAME, -1, 0, '2bits_x2')
+  channel = defaults.sample_channel_GPS_L1
+
+  samples = {'samples_total': -1, 'sample_index': 3, L1CA: {}, L2C: {}}
+  with SampleLoader(SAMPLE_FILE_NAME, '2bits_x2', batch_size=1000) as loader:
+    # The number of samples is known before the first batch is read
+    loader.set_total(samples)
+    assert samples['samples_total'] == whole.shape[1] - 3
+    assert loader.buffer is None
+    assert 'samples' not in samples[L1CA]
+
+    # Overlapping, contiguous, restarted and partial batches
+    for index in [3, 500, 1500, 2500, 200, 1000, 9500, 9999]:
+      samples['sample_index'] = index
+      loader.load(samples)
+      expected = whole[:, index:index + 1000]
+      assert np.all(samples[L1CA]['samples'] == expected[channel])
+      assert samples['samples_total'] == whole.shape[1] - 3
+
+    samples['sample_index'] = 10000
+    try:
+      loader.load(samples)
+      assert False
+    except EOFError:
+      pass
+  # clean-up
+  os.remove(SAMPLE_FILE_NAME)
+
 if __name__ == '__main__':
   test_file_formats()
@@ -0,0 +1,107 @@
+# Copyright (C) 2016 Swift Navigation Inc.
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+from peregrine import lnav
+
+import numpy as np
+
+# IS-GPS-200 parity equations: previous bit (0 for D29*, 1 for D30*) and
+# data bits of D25 to D30
+PARITY = [(0, [1, 2, 3, 5, 6, 10, 11, 12, 13, 14, 17, 18, 20, 23]),
+          (1, [2, 3, 4, 6, 7, 11, 12, 13, 14, 15, 18, 19, 21, 24]),
+          (0, [1, 3, 4, 5, 7, 8, 12, 13, 14, 15, 16, 19, 20, 22]),
+          (1, [2, 4, 5, 6, 8, 9, 13, 14, 15, 16, 17, 20, 21, 23]),
+          (1, [1, 3, 5, 6, 7, 9, 10, 14, 15, 16, 17, 18, 21, 22, 24]),
+          (0, [3, 5, 6, 8, 9, 10, 11, 13, 15, 19, 22, 23, 24])]
+
+
+def encode_word(data, prev):
+  """
+  Transmitted bits of a word of 24 data bits after the bits `prev`.
+  """
+  parity = [(prev[p] + sum(data[d - 1] for d in ds)) % 2 for p, ds in PARITY]
+  return list((np.array(data) + prev[1]) % 2) + parity
+
+
+def encode_subframe(words, prev):
+  bits = []
+  for n, word in enumerate(words):
+    data = [(word >> (23 - i)) & 1 for i in range(24)]
+    if n in (1, 9):
+      # The last two data bits make the parity end with zeros
+      for last in ([0, 0], [0, 1], [1, 0], [1, 1]):
+        encoded = encode_word(data[:22] + last, prev)
+        if encoded[-2:] == [0, 0]:
+          break
+    else:
+      encoded = encode_word(data, prev)
+    bits += encoded
+    prev = encoded[-2:]
+  return bits
+
+
+def generate_prompt(rng, stage1=4003):
+  """
+  Prompt correlations and integration times of a channel receiving five
+  subframes, the first three of an ephemeris.
+
+  The tracking starts 3 ms before a bit with the opposite polarity, and
+  switches to 20 ms integrations after `stage1` ms.
+  """
+  subframes = []
+  for n in range(5):
+    words = list(rng.randint(0, 1 << 24, 10))
+    words[0] = 0x8B << 16 | words[0] & 0xFFFC
+    words[1] = (100 + n) << 7 | (n + 1) << 2
+    subframes.append(words)
+  # Same issue of data of the ephemeris
+  subframes[0][7] = 0x2A << 16 | subframes[0][7] & 0xFFFF
+  subframes[1][2] = 0x2A << 16 | subframes[1][2] & 0xFFFF
+  subframes[2][9] = 0x2A << 16 | subframes[2][9] & 0xFFFF
+
+  bits = list(rng.randint(0, 2, 48)) + [0, 0]
+  for words in subframes:
+    bits += encode_subframe(words, bits[-2:])
+  corr = -100. * np.repeat(np.array([0] + bits) * 2. - 1, 20)[17:]
+  corr += rng.normal(0, 30, len(corr))
+  n20 = (len(corr) - stage1) // 20
+  P = np.concatenate((corr[:stage1],
+                      corr[stage1:stage1 + 20 * n20].reshape(-1, 20).sum(1)))
+  coherent_ms = np.concatenate((np.ones(stage1), 20 * np.ones(n20)))
+  return P, coherent_ms, subframes
+
+
+def test_decode_lnav():
+  """
+  Test decoding subframes from the prompt correlations of a channel
+  """
+  stage1 = 4003
+  P, coherent_ms, subframes = generate_prompt(np.random.RandomState(0),
+                                              stage1)
+
+  decoded = lnav.decode_lnav(P + 1j, coherent_ms)
+  assert len(decoded) == 5
+  assert np.all(decoded['bit'] == 51 + 300 * np.arange(5))
+  assert np.all(decoded['subframe_id'] == np.arange(1, 6))
+  assert np.all(decoded['tow'] == (100 + np.arange(5)) * 6000)
+  assert np.all(decoded['words'][:, 2:9] == np.array(subframes)[:, 2:9])
+  # The anchoring results end with the subframes
+  ms = np.cumsum(coherent_ms)
+  assert np.all(ms[decoded['record']] == 3 + 20 * (50 + 300 * np.arange(1, 6)))
+  assert lnav.find_ephemeris(decoded) == 2
+  assert lnav.find_ephemeris(decoded[1:]) == -1
+
+  # Bit errors fail the parity check of their subframe, here bit 500 in the
+  # 20 ms results starting with bit 200
+  P[stage1 + 500 - 200] *= -1
+  decoded = lnav.decode_lnav(P, coherent_ms)
+  assert np.all(decoded['subframe_id'] == [1, 3, 4, 5])
+  assert lnav.find_ephemeris(decoded) == -1
+
+  assert len(lnav.decode_lnav(P[:100], coherent_ms[:100])) == 0
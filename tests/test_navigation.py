@@ -7,6 +7,117 @@
 # EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
 # WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
 
+from peregrine.gps_constants import L1CA
+from peregrine.navigation import extract_ephemerides
+from peregrine.navigation import make_batch_solns
+from peregrine.navigation import make_chan_meas
+from peregrine.tracking import TrackResults
+from peregrine.tracking_file_utils import removeTrackingOutputFiles
+from peregrine.tracking_file_utils import TrackingResults
+from test_lnav import generate_prompt
+from test_pvt import generate_measurements
+
+import numpy as np
+import peregrine.gps_constants as gps
+
+from mock import Mock
+from mock import PropertyMock
+from mock import patch
+
 
 def test_navigation():
   assert True, "Fill me in!"
+
+
+def test_make_chan_meas():
+  '''
+  Measurements are taken from the first tracking results at or after the
+  requested times.
+  '''
+  removeTrackingOutputFiles("test_output.bin")
+  tr = TrackResults(1000, 4, L1CA)
+  tr.ms_tracked[:] = np.arange(1000)
+  tr.absolute_sample[:] = np.arange(1000) * 16368
+  tr.tow[:] = np.arange(1000)
+  tr.tow[11] = np.nan
+  tr.tow[600] = np.nan
+  tr.dump('test_output.bin', 1000)
+
+  mss = [10, 10, 12, 500.5, 600, 999, 999]
+  cmss = make_chan_meas(TrackingResults('test_output.bin'), mss, {},
+                        16.368e6)
+  assert [ms for ms, _ in cmss] == mss
+  assert [cms.keys() for _, cms in cmss] == [[4], [], [4], [4], [], [4], []]
+  removeTrackingOutputFiles("test_output.bin")
+
+
+def test_extract_ephemerides():
+  '''
+  Only the results up to the first complete ephemeris are replayed. Channels
+  without one are replayed whole.
+  '''
+  removeTrackingOutputFiles("test_output.bin")
+  rng = np.random.RandomState(0)
+  for prn in (9, 6, 3):
+    P, coherent_ms, _ = generate_prompt(rng)
+    if prn != 3:
+      # A bit error in subframe 2
+      P[4003 + 500 - 200] *= -1
+    if prn == 9:
+      # Too short for the decoder replaying it
+      P, coherent_ms = P[:4000], coherent_ms[:4000]
+    tr = TrackResults(len(P), prn, L1CA)
+    tr.P[:] = P
+    tr.coherent_ms[:] = coherent_ms
+    tr.ms_tracked[:] = np.cumsum(coherent_ms)
+    tr.absolute_sample[:] = tr.ms_tracked
+    tr.dump('test_output.bin', len(P))
+
+  def nav_msg():
+    # The decoder replaying PRN 6 finds a time of week and an ephemeris, the
+    # one replaying PRN 9 neither
+    msg = Mock()
+    type(msg).eph_valid = PropertyMock(
+        side_effect=lambda: msg.update.call_count > 4000)
+    msg.update.side_effect = lambda P: \
+        1234 if msg.update.call_count == 4100 else None
+    return msg
+
+  with patch('swiftnav.nav_msg.NavMsg') as NavMsg:
+    NavMsg.side_effect = nav_msg
+    ephems = extract_ephemerides(TrackingResults('test_output.bin'))
+  # Channel entries have 1-based PRNs
+  assert sorted(ephems.keys()) == [4, 7]
+  assert NavMsg.call_count == 3
+  # Replayed up to the end of subframe 3
+  ms = np.cumsum(coherent_ms)
+  assert ephems[4][0].update.call_count == \
+      np.searchsorted(ms, 3 + 20 * (50 + 300 * 3)) + 1
+  # Time of week at the end of the last subframe
+  record, tow = ephems[4][1]
+  assert ms[record] == 3 + 20 * (50 + 300 * 5)
+  assert tow == 104 * 6000
+  # Without a decoded ephemeris, the time of week is the decoder's
+  assert ephems[7][0].update.call_count == len(P)
+  assert ephems[7][1] == (4099, 1234)
+  removeTrackingOutputFiles("test_output.bin")
+
+
+def test_make_batch_solns():
+  '''
+  The navigation measurements of all epochs are stacked and solved at once,
+  epochs having different satellites.
+  '''
+  pos, vel, _, pr, prr, sat_pos, sat_vel = \
+      generate_measurements(np.random.RandomState(0), 50)
+  nms = []
+  for i in range(50):
+    nms.append([Mock(pseudorange=pr[i, j], doppler=-prr[i, j] * gps.l1 / gps.c,
+                     sat_pos=sat_pos[i, j], sat_vel=sat_vel[i, j])
+                for j in range(8) if i < 25 or j != 1])
+  nms[10] = nms[10][:3]
+  solutions = make_batch_solns(nms)
+  assert np.all(solutions['valid'] == (np.arange(50) != 10))
+  assert np.all(solutions['n_used'][25:] == 7)
+  assert np.allclose(solutions['pos_ecef'][11:], pos[11:], atol=1e-3)
+  assert np.allclose(solutions['vel_ecef'][11:], vel, atol=1e-3)
@@ -0,0 +1,86 @@
+# Copyright (C) 2016 Swift Navigation Inc.
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+from peregrine import pvt
+from peregrine.gps_constants import c, omegae_dot
+
+import numpy as np
+
+
+def generate_measurements(rng, n_epochs, n_sats=8):
+  """
+  Pseudoranges and pseudorange rates of a receiver moving on the surface of
+  the Earth, with satellites in view above it.
+  """
+  t = np.arange(n_epochs) * 1e-3
+  # Receiver at 45N driving east, clock drifting by 1 ppm
+  up = np.array([1., 0., 1.]) / np.sqrt(2)
+  east = np.array([0., 1., 0.])
+  vel = 20. * east + np.array([0., 0., 0.1])
+  pos = 6371e3 * up + t[:, np.newaxis] * vel
+  clock_offset = 1e-4 + 1e-6 * t
+
+  # Satellites spread over the sky, moving perpendicular to their position
+  directions = rng.normal(0, 1, (n_sats, 3))
+  directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+  directions = up + 0.9 * directions
+  directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+  orbit = np.cross(directions, rng.normal(0, 1, (n_sats, 3)))
+  orbit *= 3900. / np.linalg.norm(orbit, axis=1)[:, np.newaxis]
+  sat_vel = np.tile(orbit, (n_epochs, 1, 1))
+  sat_pos = 26560e3 * directions + t[:, np.newaxis, np.newaxis] * sat_vel
+
+  # The time of flight depends on the range, solved by fixed point
+  ranges = np.full(sat_pos.shape[:2], 2e7)
+  for _ in range(5):
+    rotated = pvt._sagnac(sat_pos, ranges / c)
+    ranges = np.linalg.norm(rotated - pos[:, np.newaxis], axis=2)
+  los = (rotated - pos[:, np.newaxis]) / ranges[:, :, np.newaxis]
+  pseudoranges = ranges + c * clock_offset[:, np.newaxis]
+  rates = np.sum(los * (pvt._sagnac(sat_vel, ranges / c) -
+                        vel[np.newaxis, np.newaxis]), axis=2) + c * 1e-6
+  return pos, vel, clock_offset, pseudoranges, rates, sat_pos, sat_vel
+
+
+def test_solve_pvt():
+  """
+  Test solving many epochs at once
+  """
+  n = 2000
+  pos, vel, clock_offset, pr, prr, sat_pos, sat_vel = \
+      generate_measurements(np.random.RandomState(0), n)
+  # Missing measurements, too many of them for a solution at epoch 10
+  pr[5:20, 2] = np.nan
+  pr[10, 3:7] = np.nan
+  prr[100:, 0] = np.nan
+
+  solutions = pvt.solve_pvt(pr, sat_pos, prr, sat_vel)
+  assert len(solutions) == n
+  valid = np.arange(n) != 10
+  assert np.all(solutions['valid'] == valid)
+  assert solutions['n_used'][10] == 3
+  assert np.all(np.isnan(solutions['pos_ecef'][10]))
+  assert np.allclose(solutions['pos_ecef'][valid], pos[valid], atol=1e-3)
+  assert np.allclose(solutions['clock_offset'][valid], clock_offset[valid],
+                     atol=1e-11)
+  assert np.allclose(solutions['vel_ecef'][valid], vel, atol=1e-3)
+  assert np.allclose(solutions['clock_drift'][valid], 1e-6, atol=1e-11)
+
+  # The solutions of each epoch do not depend on the others
+  single = pvt.solve_pvt(pr[1500], sat_pos[1500])
+  assert np.allclose(single['pos_ecef'], solutions['pos_ecef'][1500])
+  assert np.all(np.isnan(single['vel_ecef']))
+
+  # Noisy pseudoranges starting near the previous solutions
+  noisy = pvt.solve_pvt(pr + np.random.RandomState(1).normal(0, 3, pr.shape),
+                        sat_pos, x0=np.append(pos[0], 0.))
+  errors = np.linalg.norm(noisy['pos_ecef'][valid] - pos[valid], axis=1)
+  assert np.median(errors) < 15.
+
+  assert len(pvt.solve_pvt(np.zeros((0, 8)), np.zeros((0, 8, 3)))) == 0
@@ -10,6 +10,7 @@
 # WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
 
 from peregrine.gps_constants import l1, l2, L1CA, L2C
+from peregrine.gps_constants import l1ca_code_period, l1ca_code_length
 from test_common import generate_sample_file, fileformat_to_bands,\
                         get_skip_params, run_peregrine
 from test_acquisition import get_acq_result_file_name
@@ -17,10 +18,18 @@ from peregrine.analysis import tracking_loop
 from peregrine.tracking import TrackingLoop, NavBitSync, NavBitSyncSBAS,\
                                NBSLibSwiftNav, NBSSBAS, NBSMatchBit,\
                                NBSHistogram, NBSMatchEdge
+from peregrine.tracking_file_utils import loadTrackingResults
+from peregrine.tracking_file_utils import removeTrackingOutputFiles
+from peregrine.tracking_file_utils import createTrackingCheckpointFileName
+from peregrine.acquisition import Acquisition, AcquisitionResult
+from peregrine.samples import load_samples
+from peregrine import defaults
+from peregrine import tracking
 
-import cPickle
 import csv
+import numpy as np
 import os
+import pytest
 import sys
 
 from mock import patch
@@ -120,26 +129,17 @@ def check_per_track_results(expected_lock_ratio, filename, prn, bands,
   print "Peregrine tracking:"
   for band in bands:
     ret[band] = {}
-    with open(get_peregrine_tr_res_file_name(filename, prn, band), 'rb') as f:
-      lock_detect_outp_sum = 0
-      lock_detect_outp_len = 0
-      while True:
-        try:
-          track_results = cPickle.load(f)
-          assert (track_results.prn + 1) == prn
-          assert track_results.status == 'T'
-          assert track_results == track_results
-          lock_detect_outp_sum += (track_results.lock_detect_outp == 1).sum()
-          lock_detect_outp_len += len(track_results.lock_detect_outp)
-          assert track_results.resize(1) == track_results.resize(1)
-        except EOFError:
-          break
-      print "band =", band
-      lock_ratio = float(lock_detect_outp_sum) / lock_detect_outp_len
-      print "lock_ratio =", lock_ratio
-      if (not short_long_cycles and not pipelining) or band != L2C:
-        assert lock_ratio >= expected_lock_ratio
-      ret[band]['lock_ratio'] = lock_ratio
+    track_results = loadTrackingResults(
+        get_peregrine_tr_res_file_name(filename, prn, band))
+    assert np.all(track_results['status'] == 'T')
+    lock_detect_outp_sum = (track_results['lock_detect_outp'] == 1).sum()
+    lock_detect_outp_len = len(track_results)
+    print "band =", band
+    lock_ratio = float(lock_detect_outp_sum) / lock_detect_outp_len
+    print "lock_ratio =", lock_ratio
+    if (not short_long_cycles and not pipelining) or band != L2C:
+      assert lock_ratio >= expected_lock_ratio
+    ret[band]['lock_ratio'] = lock_ratio
   return ret
 
 
@@ -233,5 +233,330 @@ def test_tracking():
   assert NBSMatchEdge()
 
 
+def test_nav_bit_sync_block():
+  """
+  Test bit sync updates with arrays of correlations
+  """
+  rng = np.random.RandomState(0)
+  bits = rng.randint(0, 2, 1000) * 2 - 1
+  corr = np.roll(np.repeat(bits, 20), 7) * 100. + rng.randint(-30, 31, 20000)
+  splits = np.cumsum(rng.randint(1, 700, 100))
+  splits = splits[splits < len(corr)]
+
+  for nbs in (NBSMatchBit, NBSHistogram, NBSMatchEdge, NBSLibSwiftNav):
+    serial = nbs()
+    serial_ends = [i for i, c in enumerate(corr) if serial.update(c, 1)[0]]
+    block = nbs()
+    block_ends = []
+    for offset, chunk in zip(np.r_[0, splits], np.split(corr, splits)):
+      ends, bits_ = block.update_block(chunk)
+      assert list(bits_) == block.bits[len(block.bits) - len(bits_):]
+      block_ends += list(offset + ends)
+    assert serial_ends == block_ends
+    if nbs is NBSLibSwiftNav:
+      # The decoders are compared by identity
+      assert serial.bits == block.bits and serial.count == block.count
+    else:
+      assert serial.synced
+      assert serial == block
+
+
+def test_tracking_pool():
+  """
+  Test GPS L1C/A and L2C tracking in the worker pool
+  """
+  prn = 1
+  init_doppler = 555
+  freq_profile = defaults.freq_profile_low_rate
+  samples_file = generate_sample_file(prn, init_doppler, 0, '2bits_x2',
+                                      'low_rate', generate=1)
+
+  results = {}
+  for multi in (False, True):
+    output_file = 'test_output_%s.bin' % multi
+    samples = {L1CA: {'IF': freq_profile['GPS_L1_IF']},
+               L2C: {'IF': freq_profile['GPS_L2_IF']},
+               'samples_total': -1,
+               'sample_index': 0}
+    load_samples(samples, samples_file, file_format='2bits_x2')
+    acq = AcquisitionResult(prn - 1, freq_profile['GPS_L1_IF'] + init_doppler,
+                            init_doppler, 0., 100., 'A', L1CA, 0)
+    with patch.object(tracking.mp, 'cpu_count', return_value=2):
+      tracker = tracking.Tracker(samples=samples, channels=[acq],
+                                 ms_to_track=-1,
+                                 sampling_freq=freq_profile['sampling_freq'],
+                                 multi=multi, output_file=output_file,
+                                 analysis_output=False)
+      tracker.start()
+      tracker.run_channels(samples)
+      if multi:
+        # The L2C channel handed over to is created in the pool
+        assert tracker.tracking_channels == []
+        assert sorted(tracker.pool_channels.values()) == [(0, L1CA), (0, L2C)]
+      fn_results = tracker.stop()
+    results[multi] = [loadTrackingResults(fn) for fn in sorted(fn_results)]
+    removeTrackingOutputFiles(output_file)
+
+  assert len(results[True]) == len(results[False]) == 2
+  for serial, pool in zip(results[False], results[True]):
+    assert len(serial) > 0
+    assert serial.tostring() == pool.tostring()
+  os.remove(samples_file)
+
+
+def test_tracking_reacquisition():
+  """
+  Test re-acquiring and restarting a GPS L1C/A channel that lost the lock
+  in a gap of the signal, in this process and in the worker pool
+  """
+  prn = 1
+  init_doppler = 555
+  freq_profile = defaults.freq_profile_low_rate
+  fs = freq_profile['sampling_freq']
+  samples_file = generate_sample_file(prn, init_doppler, 0, '2bits_x2',
+                                      'low_rate', generate=3)
+  # Noise only from 0.9 s to 1.7 s, after the L2C handover, two samples per
+  # byte
+  with open(samples_file, 'r+b') as f:
+    f.seek(int(0.9 * fs / 2))
+    f.write(np.random.RandomState(0).randint(0, 256, int(0.8 * fs / 2))
+            .astype(np.uint8).tostring())
+  batch_size = 500000
+
+  reacq = Acquisition(L1CA, None, fs, freq_profile['GPS_L1_IF'],
+                      l1ca_code_period * fs, l1ca_code_length,
+                      wisdom_file=None)
+
+  for multi in (False, True):
+    samples = {L1CA: {'IF': freq_profile['GPS_L1_IF']},
+               L2C: {'IF': freq_profile['GPS_L2_IF']},
+               'samples_total': -1,
+               'sample_index': 0}
+    load_samples(samples, samples_file, batch_size, '2bits_x2')
+    acq = AcquisitionResult(prn - 1, freq_profile['GPS_L1_IF'] + init_doppler,
+                            init_doppler, 0., 100., 'A', L1CA, 0)
+    removeTrackingOutputFiles('test_output.bin')
+    with patch.object(tracking.mp, 'cpu_count', return_value=2):
+      tracker = tracking.Tracker(samples=samples, channels=[acq],
+                                 ms_to_track=-1, sampling_freq=fs,
+                                 multi=multi, output_file='test_output.bin',
+                                 analysis_output=False)
+      tracker.start()
+      restarts = []
+      while True:
+        sample_index = tracker.run_channels(samples)
+        if sample_index == samples['sample_index']:
+          break
+        samples['sample_index'] = sample_index
+        load_samples(samples, samples_file, batch_size, '2bits_x2')
+        if tracker.reacquire_channels(reacq, samples):
+          restarts.append(sample_index)
+      if multi:
+        channels = sorted(tracker.pool_channels.values())
+      else:
+        channels = sorted((chan.prn, chan.signal)
+                          for chan in tracker.tracking_channels)
+      fn_results = tracker.stop()
+
+    # Lost after the timeout, restarted once the signal is back
+    assert len(restarts) == 1
+    assert (0.9 + 1e-3 * defaults.lost_lock_timeout_ms) * fs < restarts[0] < \
+        2.2 * fs
+    # The L2C channel is not handed over to again
+    assert channels == [(0, L1CA), (0, L2C)]
+    records = loadTrackingResults([fn for fn in fn_results if L1CA in fn][0])
+    assert np.all(np.diff(records['absolute_sample']) > 0)
+    assert records['lock_detect_outo'][-1]
+    removeTrackingOutputFiles('test_output.bin')
+  os.remove(samples_file)
+
+
+class ToWNavMsg(object):
+  """
+  Stand-in L1C/A navigation message decoder giving the ToW of the 10th bit.
+  """
+
+  def __init__(self):
+    self.bits = 0
+
+  def update(self, bit):
+    self.bits += 1
+    return 60000 if self.bits == 10 else -1
+
+  def subframe_ready(self):
+    return False
+
+
+@pytest.mark.parametrize('l1ca_profile', [None, 'slow'])
+def test_tracking_tow(l1ca_profile):
+  """
+  Test the ToW continues over the results dumped at the end of each batch
+  """
+  prn = 1
+  init_doppler = 555
+  freq_profile = defaults.freq_profile_low_rate
+  samples_file = generate_sample_file(prn, init_doppler, 0, '2bits',
+                                      'low_rate', generate=1)
+  batch_size = 500000
+
+  samples = {L1CA: {'IF': freq_profile['GPS_L1_IF']},
+             L2C: {'IF': freq_profile['GPS_L2_IF']},
+             'samples_total': -1,
+             'sample_index': 0}
+  load_samples(samples, samples_file, batch_size, '2bits')
+  acq = AcquisitionResult(prn - 1, freq_profile['GPS_L1_IF'] + init_doppler,
+                          init_doppler, 0., 100., 'A', L1CA, 0)
+  if l1ca_profile:
+    stage2 = defaults.l1ca_stage_profiles[l1ca_profile][1]
+  else:
+    stage2 = {'coherent_ms': None, 'loop_filter_params': None}
+  removeTrackingOutputFiles('test_output.bin')
+  with patch.object(tracking, 'NavMsg', ToWNavMsg), \
+          patch.object(tracking.NavBitSync, 'update_block', autospec=True,
+                       side_effect=tracking.NavBitSync.update_block) \
+          as update_block:
+    tracker = tracking.Tracker(
+        samples=samples, channels=[acq], ms_to_track=-1,
+        sampling_freq=freq_profile['sampling_freq'],
+        stage2_coherent_ms=stage2['coherent_ms'],
+        stage2_loop_filter_params=stage2['loop_filter_params'],
+        output_file='test_output.bin', analysis_output=False)
+    tracker.start()
+    batches = 0
+    while True:
+      sample_index = tracker.run_channels(samples)
+      if sample_index == samples['sample_index']:
+        break
+      samples['sample_index'] = sample_index
+      load_samples(samples, samples_file, batch_size, '2bits')
+      batches += 1
+    fn_results = tracker.stop()
+
+  assert batches > 2
+  # The bits of the stage 2 integrations are synchronized over their 1 ms
+  # correlations
+  assert update_block.called == bool(l1ca_profile)
+  assert all(len(args[1]) == stage2['coherent_ms']
+             for args, _ in update_block.call_args_list)
+  records = loadTrackingResults(fn_results[0])
+  known = np.flatnonzero(~np.isnan(records['tow']))
+  assert len(known) > 0 and known[-1] == len(records) - 1
+  assert np.all(np.diff(known) == 1)
+  assert records['tow'][known[0]] == 60000
+  assert np.all(np.diff(records['tow'][known]) ==
+                records['coherent_ms'][known[1:]])
+  removeTrackingOutputFiles('test_output.bin')
+  os.remove(samples_file)
+
+
+class CountingCNavMsg(object):
+  """
+  Stand-in CNAV message.
+  """
+  tow = 0
+
+  def getPrn(self):
+    return 0
+
+  def getMsgId(self):
+    return 0
+
+  def getTow(self):
+    return self.tow
+
+  def getAlert(self):
+    return 0
+
+
+class CountingCNavMsgDecoder(object):
+  """
+  Stand-in CNAV message decoder decoding a message every 4th symbol, with
+  the number of symbols fed to it as the ToW.
+  """
+
+  def __init__(self):
+    self.symbols = 0
+
+  def decode(self, symbol, msg):
+    self.symbols += 1
+    msg.tow = self.symbols
+    return self.symbols % 4 == 0, 0
+
+
+@patch.object(tracking, 'CNavMsgDecoder', CountingCNavMsgDecoder)
+@patch.object(tracking, 'CNavMsg', CountingCNavMsg)
+def test_tracking_checkpoint():
+  """
+  Test resuming GPS L1C/A and L2C tracking from a checkpoint
+  """
+  prn = 1
+  init_doppler = 555
+  freq_profile = defaults.freq_profile_low_rate
+  samples_file = generate_sample_file(prn, init_doppler, 0, '2bits_x2',
+                                      'low_rate', generate=1)
+  checkpoint_file = createTrackingCheckpointFileName('test_output.bin')
+  batch_size = 500000
+
+  def create_tracker(output_file):
+    samples = {L1CA: {'IF': freq_profile['GPS_L1_IF']},
+               L2C: {'IF': freq_profile['GPS_L2_IF']},
+               'samples_total': -1,
+               'sample_index': 0}
+    load_samples(samples, samples_file, batch_size, '2bits_x2')
+    acq = AcquisitionResult(prn - 1, freq_profile['GPS_L1_IF'] + init_doppler,
+                            init_doppler, 0., 100., 'A', L1CA, 0)
+    tracker = tracking.Tracker(samples=samples, channels=[acq],
+                               ms_to_track=-1,
+                               sampling_freq=freq_profile['sampling_freq'],
+                               output_file=output_file,
+                               analysis_output=False)
+    tracker.start()
+    return tracker, samples
+
+  def run(tracker, samples, batches=-1):
+    while batches != 0:
+      sample_index = tracker.run_channels(samples)
+      if sample_index == samples['sample_index']:
+        break
+      samples['sample_index'] = sample_index
+      load_samples(samples, samples_file, batch_size, '2bits_x2')
+      if sample_index > 1700000 and not os.path.isfile(checkpoint_file):
+        tracker.checkpoint(checkpoint_file, sample_index)
+      batches -= 1
+    return sorted(tracker.stop())
+
+  # Uninterrupted tracking
+  tracker, samples = create_tracker('test_output_ref.bin')
+  expected = [loadTrackingResults(fn) for fn in run(tracker, samples)]
+  removeTrackingOutputFiles('test_output_ref.bin')
+
+  # Tracking interrupted after the checkpoint and resumed
+  removeTrackingOutputFiles('test_output.bin')
+  tracker, samples = create_tracker('test_output.bin')
+  fn_results = run(tracker, samples, batches=5)
+  assert os.path.isfile(checkpoint_file)
+  interrupted = [len(loadTrackingResults(fn)) for fn in fn_results]
+  tracker, samples = create_tracker('test_output.bin')
+  samples['sample_index'] = tracker.resume(checkpoint_file)
+  resumed = [len(loadTrackingResults(fn)) for fn in fn_results]
+  assert all(n < m for n, m in zip(resumed, interrupted))
+  load_samples(samples, samples_file, batch_size, '2bits_x2')
+  assert sorted(chan.signal for chan in tracker.tracking_channels) == \
+      [L1CA, L2C]
+  results = [loadTrackingResults(fn) for fn in run(tracker, samples)]
+
+  assert len(results) == len(expected) == 2
+  for result, reference in zip(results, expected):
+    assert len(reference) > 0
+    assert result.tostring() == reference.tostring()
+  # The CNAV message decoder continues after the checkpoint
+  l2c_tow = results[1]['tow']
+  assert np.sum(~np.isnan(l2c_tow)) > 4
+  np.testing.assert_array_equal(l2c_tow, expected[1]['tow'])
+  removeTrackingOutputFiles('test_output.bin')
+  assert not os.path.isfile(checkpoint_file)
+  os.remove(samples_file)
+
+
 if __name__ == '__main__':
   test_tracking()
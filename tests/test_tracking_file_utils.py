@@ -15,8 +15,17 @@ from peregrine.tracking_file_utils import PickleLoadObject
 from peregrine.tracking_file_utils import removeTrackingOutputFiles
 from peregrine.tracking_file_utils import TrackingResults
 from peregrine.tracking_file_utils import TrackResultFile
+from peregrine.tracking_file_utils import appendTrackingResults
+from peregrine.tracking_file_utils import loadTrackingResults
+from peregrine.tracking_file_utils import exportTrackingAnalysis
+from peregrine.tracking_file_utils import searchTrackingResults
+from peregrine.tracking_file_utils import TrackingResultsWriter
 from peregrine.tracking import TrackResults
 
+import cPickle
+import numpy as np
+import os
+
 
 def __testSetup():
   '''
@@ -115,14 +124,15 @@ def test_PickleLoadObject():
   Test for PickleLoadObject object
   '''
   tr = TrackResults(500, 1, 'l1ca')
-  for i in range(500):
-    tr.ms_tracked[i] = i
-    tr.absolute_sample[i] = i
-  tr.dump('test_output.bin', 500)
-  for i in range(500):
-    tr.ms_tracked[i] = i + 500
-    tr.absolute_sample[i] = i + 500
-  tr.dump('test_output.bin', 500)
+  with open('test_output.PRN-2.l1ca.bin.track_results', 'wb') as f:
+    for i in range(500):
+      tr.ms_tracked[i] = i
+      tr.absolute_sample[i] = i
+    cPickle.dump(tr, f, protocol=cPickle.HIGHEST_PROTOCOL)
+    for i in range(500):
+      tr.ms_tracked[i] = i + 500
+      tr.absolute_sample[i] = i + 500
+    cPickle.dump(tr, f, protocol=cPickle.HIGHEST_PROTOCOL)
   loadObj = PickleLoadObject('test_output.PRN-2.l1ca.bin.track_results')
   it = iter(loadObj)
   o0 = it.next()
@@ -152,16 +162,17 @@ def test_TrackResultsFile():
   Test for TrackResults object
   '''
   tr = TrackResults(500, 1, 'l1ca')
-  for i in range(500):
-    tr.ms_tracked[i] = i
-    tr.absolute_sample[i] = i
-  tr.status = 'A'
-  tr.dump('test_output.bin', 500)
-  for i in range(500):
-    tr.ms_tracked[i] = i + 500
-    tr.absolute_sample[i] = i + 500
-  tr.status = 'B'
-  tr.dump('test_output.bin', 500)
+  with open('test_output.PRN-2.l1ca.bin.track_results', 'wb') as f:
+    for i in range(500):
+      tr.ms_tracked[i] = i
+      tr.absolute_sample[i] = i
+    tr.status = 'A'
+    cPickle.dump(tr, f, protocol=cPickle.HIGHEST_PROTOCOL)
+    for i in range(500):
+      tr.ms_tracked[i] = i + 500
+      tr.absolute_sample[i] = i + 500
+    tr.status = 'B'
+    cPickle.dump(tr, f, protocol=cPickle.HIGHEST_PROTOCOL)
   obj = TrackResultFile(
       PickleLoadObject('test_output.PRN-2.l1ca.bin.track_results'))
   it = iter(obj)
@@ -285,3 +296,136 @@ def test_TrackResultsObj_dump():
   tr.dump()
 
   removeTrackingOutputFiles("test_output.bin")
+
+
+def test_TrackResultsObj_window():
+  '''
+  Test for combined channel data windows.
+  '''
+  __testSetup()
+  tr = TrackingResults('test_output.bin')
+
+  records = tr.channelRecords(1)
+  assert len(records) == 500
+  assert np.all(searchTrackingResults(records, 'absolute_sample',
+                                      [-1, 1, 2, 998, 999, 1000]) ==
+                [0, 0, 1, 499, 499, 500])
+
+  w = tr.window()
+  assert len(w) == 1000
+  combined = [(tr_.prn, tr_.absolute_sample[idx])
+              for tr_, idx in tr.combinedResult()]
+  assert zip(w['channel'], w['absolute_sample']) == combined
+
+  w = tr.window(100, 110, fields=['ms_tracked', 'status'])
+  assert w.dtype.names == ('channel', 'ms_tracked', 'status')
+  assert np.all(w['ms_tracked'] == np.arange(100, 110))
+  assert np.all(w['channel'] == [0, 1] * 5)
+  assert np.all(w['status'] == ['A', 'B'] * 5)
+
+  w = tr.window(stop=51, column='ms_tracked')
+  assert np.all(w['ms_tracked'] == np.arange(51))
+
+  # Pickled results give the same records
+  fileName = tr.getEntries()[0]['filename']
+  trackResults = TrackResults(500, 0, 'l1ca')
+  trackResults.status = 'A'
+  trackResults.absolute_sample[:] = trackResults.ms_tracked[:] = \
+      np.arange(0, 1000, 2)
+  with open(fileName, 'wb') as f:
+    cPickle.dump(trackResults, f)
+  pickled = tr.channelRecords(0)
+  assert pickled.dtype == records.dtype
+  assert np.all(pickled['absolute_sample'] == np.arange(0, 1000, 2))
+  assert np.all(pickled['status'] == 'A')
+  assert np.all(tr.window()['ms_tracked'] == np.arange(1000))
+
+  removeTrackingOutputFiles("test_output.bin")
+
+
+def test_TrackingResultsFile():
+  '''
+  Test for appending to and loading tracking results files
+  '''
+  removeTrackingOutputFiles("test_output.bin")
+  tr = TrackResults(500, 1, 'l1ca')
+  tr.IF = 1000.
+  tr.status = 'T'
+  for i in range(500):
+    tr.ms_tracked[i] = i
+    tr.absolute_sample[i] = i * 16
+    tr.P[i] = i + 1j
+  tr.dump('test_output.bin', 500)
+  tr.ms_tracked += 500
+  tr.dump('test_output.bin', 200)
+  aName, rName = createTrackingOutputFileNames("test_output.bin", 2, "l1ca")
+
+  results = loadTrackingResults(rName)
+  assert isinstance(results, np.memmap)
+  assert len(results) == 700
+  assert np.all(results['ms_tracked'] == np.r_[0:500, 500:700])
+  assert np.all(results['P'][:500] == np.arange(500) + 1j)
+  assert np.all(results['status'] == 'T')
+  assert np.all(results['IF'] == 1000.)
+  assert np.all(np.load(rName)['absolute_sample'][500:] ==
+                np.arange(200) * 16)
+
+  # Restarting the file
+  tr.dump('test_output.bin', 0)
+  tr.print_start = 1
+  tr.dump('test_output.bin', 0)
+  assert len(loadTrackingResults(rName)) == 0
+
+  # Read like the pickled results
+  appendTrackingResults(rName, tr.records(3), create=True)
+  channel = iter(TrackingResults('test_output.bin').channelResult(0))
+  for i in range(3):
+    o, idx = channel.next()
+    assert idx == i
+    assert o.ms_tracked[idx] == 500 + i
+    assert o.status == 'T' and o.IF == 1000. and o.prn == 1
+  try:
+    channel.next()
+    assert False
+  except StopIteration:
+    pass
+
+  # The analysis file has one line per tracking result
+  exportTrackingAnalysis(rName, aName)
+  with open(aName) as f:
+    lines = f.readlines()
+  assert len(lines) == 4
+  assert lines[0].startswith('sample_index,ms_tracked,')
+  assert lines[1].startswith('0,500.0,0.0,1000.0,')
+  removeTrackingOutputFiles("test_output.bin")
+
+
+def test_TrackingResultsWriter():
+  '''
+  Test for writing tracking results on the writer thread
+  '''
+  removeTrackingOutputFiles("test_output.bin")
+  tr = TrackResults(100, 1, 'l1ca')
+  tr.ms_tracked[:] = np.arange(100)
+  writer = TrackingResultsWriter(queue_size=2)
+  for i in range(10):
+    tr.dump('test_output.bin', 100, writer)
+    tr.ms_tracked += 100
+  writer.flush()
+  aName, rName = createTrackingOutputFileNames("test_output.bin", 2, "l1ca")
+  assert np.all(loadTrackingResults(rName)['ms_tracked'] == np.arange(1000))
+
+  stats = writer.close()
+  assert stats['blocks'] == 10
+  assert stats['records'] == 1000
+  assert stats['max_pending'] <= 2
+  assert writer.thread is None
+
+  # Write errors are raised on the next call
+  writer.append(os.path.join('no such dir', 'x'), tr.records(1))
+  try:
+    writer.close()
+    assert False
+  except IOError:
+    pass
+  removeTrackingOutputFiles("test_output.bin")
@@ -0,0 +1,120 @@
+# Copyright (C) 2016 Swift Navigation Inc.
+#
+# This source is subject to the license found in the file 'LICENSE' which must
+# be be distributed together with this source. All other rights reserved.
+#
+# THIS CODE AND INFORMATION IS PROVIDED "AS IS" WITHOUT WARRANTY OF ANY KIND,
+# EITHER EXPRESSED OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND/OR FITNESS FOR A PARTICULAR PURPOSE.
+
+from peregrine.gps_constants import L1CA, L2C
+from peregrine.acquisition import AcquisitionResult
+from peregrine.samples import load_samples
+from peregrine.tracking import Tracker, TrackResults
+from peregrine.tracking_file_utils import loadTrackingResults
+from peregrine.tracking_file_utils import removeTrackingOutputFiles
+from peregrine.tracking_segments import plan_segments, stitch_segments
+from peregrine.tracking_segments import track_segments, _segment_output_file
+from peregrine import defaults
+from test_common import generate_sample_file
+
+import numpy as np
+import os
+
+
+def test_plan_segments():
+  """
+  Test splitting the samples into segments
+  """
+  assert plan_segments(0, 100, 1) == [0, 100]
+  assert plan_segments(10, 100, 3) == [10, 40, 70, 100]
+
+
+def test_stitch_segments():
+  """
+  Test stitching the tracking results of overlapping segments
+  """
+  n = np.arange(2000)
+  bits = np.where((n // 20) % 3, 1., -1.)
+  segments = [n[:1000], n[600:]]
+  for i, s in enumerate(segments):
+    tr = TrackResults(len(s), 0, L1CA)
+    tr.status = 'T'
+    tr.absolute_sample[:] = tr.ms_tracked[:] = s
+    tr.carr_phase_acc[:] = 0.5 * (s - s[0])
+    tr.code_phase_acc[:] = 2. * (s - s[0])
+    tr.P[:] = bits[s] * (-1) ** i
+    tr.E[:] = tr.L[:] = 0.5 * tr.P
+    if i == 0:
+      tr.tow[100:] = s[100:] + 5000.
+    tr.dump(_segment_output_file('test_output.bin', i), len(s))
+
+  removeTrackingOutputFiles('test_output.bin')
+  fn_results = stitch_segments([_segment_output_file('test_output.bin', i)
+                                for i in range(2)],
+                               'test_output.bin', [0, 1000, 2000], 400)
+  assert len(fn_results) == 1
+  records = loadTrackingResults(fn_results[0])
+  assert np.all(records['absolute_sample'] == n)
+  assert np.allclose(records['carr_phase_acc'], 0.5 * n)
+  assert np.allclose(records['code_phase_acc'], 2. * n)
+  assert np.all(records['P'] == bits)
+  assert np.all(records['E'] == 0.5 * bits)
+  assert np.all(np.isnan(records['tow'][:100]))
+  assert np.all(records['tow'][100:] == n[100:] + 5000.)
+
+  for i in range(2):
+    removeTrackingOutputFiles(_segment_output_file('test_output.bin', i))
+  removeTrackingOutputFiles('test_output.bin')
+
+
+def test_track_segments():
+  """
+  Test tracking two segments of a file in parallel against tracking it at once
+  """
+  prn = 1
+  init_doppler = 555
+  freq_profile = defaults.freq_profile_low_rate
+  samples_file = generate_sample_file(prn, init_doppler, 0, '2bits_x2',
+                                      'low_rate', generate=1)
+  acq = AcquisitionResult(prn - 1, freq_profile['GPS_L1_IF'] + init_doppler,
+                          init_doppler, 0., 100., 'A', L1CA, 0)
+
+  samples = {L1CA: {'IF': freq_profile['GPS_L1_IF']},
+             L2C: {'IF': freq_profile['GPS_L2_IF']},
+             'samples_total': -1,
+             'sample_index': 0}
+  load_samples(samples, samples_file, file_format='2bits_x2')
+  tracker = Tracker(samples=samples, channels=[acq], ms_to_track=-1,
+                    sampling_freq=freq_profile['sampling_freq'],
+                    output_file='test_output_serial.bin',
+                    analysis_output=False)
+  tracker.start()
+  tracker.run_channels(samples)
+  serial = loadTrackingResults([fn for fn in tracker.stop()
+                                if L1CA in fn][0])
+
+  fn_results = track_segments(samples_file, '2bits_x2', freq_profile, [acq],
+                              2, overlap_ms=300, output_file='test_output.bin',
+                              nprocs=2, analysis_output=False)
+  stitched = loadTrackingResults([fn for fn in fn_results if L1CA in fn][0])
+
+  assert abs(len(stitched) - len(serial)) <= 1
+  assert np.all(np.diff(stitched['absolute_sample']) > 0)
+  # The second segment continues the first one after the boundary
+  boundary = samples['samples_total'] // 2
+  after = (stitched['absolute_sample'] >= boundary) & \
+      (stitched['absolute_sample'] <= serial['absolute_sample'][-1])
+  carr = np.interp(stitched['absolute_sample'][after],
+                   serial['absolute_sample'], serial['carr_phase_acc'])
+  diff = np.abs(stitched['carr_phase_acc'][after] - carr)
+  assert np.all(diff[:10] < 0.05)
+  # No cycle slips, only the drift of loops locked at different times
+  assert np.all(diff < 0.25)
+  j = np.searchsorted(serial['ms_tracked'], stitched['ms_tracked'][after] - .5)
+  assert np.mean(np.sign(stitched['P'][after].real) ==
+                 np.sign(serial['P'][j].real)) > 0.99
+
+  removeTrackingOutputFiles('test_output_serial.bin')
+  removeTrackingOutputFiles('test_output.bin')
+  os.remove(samples_file)